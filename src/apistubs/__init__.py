@@ -2,7 +2,9 @@ import os
 
 from contextlib import contextmanager
 
+from django.apps import apps as app_registry
 from django.conf import settings as app_settings
+from django.core.exceptions import ImproperlyConfigured
 from django.test.utils import override_settings
 
 __all__ = (
@@ -19,6 +21,7 @@ default_settings = {
     'MIDDLEWARE_STUB_COOKIE_MARKER': None,
     'MIDDLEWARE_STUB_COOKIE_MARKER_DEFAULT': 'middleware_stubs_env',
     'SPEC_FILES': {},
+    'SPEC_MATCHERS': {},
     'AUTHORIZATION_URL': None,
     'TOKEN_URL': None,
     'EXTERNAL_DOCS': None,
@@ -27,10 +30,54 @@ default_settings = {
     'STUB_FORCE_ENABLED': False,
     'DB_PRESET_ENABLED': False,
     'PRINT_INFO': True,
+    'RESOLUTION_CACHE_SIZE': 1024,
+    'DB_PRESET_CACHE_SIZE': 1024,
+    'DB_PRESET_LOCAL_TTL': 2,
+    'PRESET_STORE': 'apistubs.presets.ORMPresetStore',
+    'PRESET_STORE_OPTIONS': {},
+    'ENV_TTL': None,
+    'ENV_TOUCH_INTERVAL': 60,
+    'ENV_SWEEP_INTERVAL': 0,
+    'ENV_SWEEP_BATCH_SIZE': 100,
+    'REQUEST_LOG_BUFFER': 'apistubs.logging.CacheLogBuffer',
+    'REQUEST_LOG_BUFFER_OPTIONS': {},
+    'REQUEST_LOG_SIZE': 20,
+    'REQUEST_LOG_ENV_SIZES': {},
+    'REQUEST_LOG_ASYNC': False,
+    'REQUEST_LOG_QUEUE_SIZE': 10000,
+    'REQUEST_LOG_BATCH_SIZE': 100,
+    'REQUEST_LOG_FLUSH_INTERVAL': 0.1,
+    'REQUEST_LOG_DROP_POLICY': 'newest',
+    'REQUEST_LOG_POLL_INTERVAL': 0.5,
+    'REQUEST_LOG_WAIT_MAX': 30,
+    'REQUEST_LOG_STREAM_TIMEOUT': 300,
+    'CACHE_DIR': None,
+    'CHECK_INTERVAL': 0,
+    'WATCH_FILES': False,
+    'LAZY_SPECS': None,
+    'WARMUP': False,
+    'WARMUP_WORKERS': None,
+    'WARMUP_EXECUTOR': 'thread',
+    'JSON_STYLE': 'pretty',
+    'JSON_SERIALIZER': None,
+    'COMPRESSION': None,
+    'COMPRESSION_MIN_SIZE': 512,
+    'TEMPLATE_CACHE_SIZE': 256,
+    'TEMPLATE_BODIES': False,
 }
 
 
 class Settings(object):
+    """
+    APISTUBS_<KEY> Django settings over `default_settings`.
+
+    DB presets, env parents and resolved stubs are cached per worker and
+    reused until a Generation counter in the default Django cache changes.
+    With several workers it has to be a shared cache (Redis, Memcached,
+    database): a process-local one (the LocMemCache default) only sees
+    the writes of its own worker, the others read the DB again once
+    its counters expire after DB_PRESET_LOCAL_TTL seconds
+    """
     app_name = __name__
     app_config = '%s.apps.APIStubsConfig' % __name__
 
@@ -42,6 +89,8 @@ class Settings(object):
         self.reload()
 
     def reload(self):
+        # resolved stubs are keyed on it, see apistubs.stubs
+        self.revision = getattr(self, 'revision', 0) + 1
         for k, v in self.get_settings().items():
             if hasattr(app_settings, self.prefix + k):
                 value = getattr(app_settings, self.prefix + k, None)
@@ -54,6 +103,33 @@ class Settings(object):
                 os.path.dirname(__file__), 'data', 'specs', 'ministubs.openapi.yaml'
             )),
         })
+        # the modules checked against import these settings, ready() checks the first load
+        if app_registry.ready:
+            self.check()
+
+    def check(self):
+        """
+        Raises ImproperlyConfigured for values that would otherwise fail a request
+        """
+        from apistubs.serializers import JSON_STYLES, SERIALIZERS, load_serializer, orjson
+        from apistubs.spec import ROUTE_INDEXES
+        for spec_key, matcher in (self.SPEC_MATCHERS or {}).items():
+            if matcher not in ROUTE_INDEXES:
+                raise ImproperlyConfigured('APISTUBS_SPEC_MATCHERS: %r of %r is not one of %s' % (
+                    matcher, spec_key, ', '.join(ROUTE_INDEXES)
+                ))
+        if self.JSON_STYLE not in JSON_STYLES:
+            raise ImproperlyConfigured('APISTUBS_JSON_STYLE: %r is not one of %s' % (
+                self.JSON_STYLE, ', '.join(JSON_STYLES)
+            ))
+        if self.JSON_SERIALIZER == 'orjson' and orjson is None:
+            raise ImproperlyConfigured('APISTUBS_JSON_SERIALIZER: orjson is not installed')
+        try:
+            load_serializer(self.JSON_SERIALIZER)
+        except ImportError as e:
+            raise ImproperlyConfigured('APISTUBS_JSON_SERIALIZER: %r is not one of %s or a dotted path (%s)' % (
+                self.JSON_SERIALIZER, ', '.join(SERIALIZERS), e
+            ))
 
     @contextmanager
     def override(self, **kwargs):
@@ -76,7 +152,13 @@ class Settings(object):
         return getattr(app_settings, self.prefix + key, self.defaults[key])
 
     def ready(self):
-        pass
+        self.check()
+        if self.ENABLED and self.WARMUP:
+            from apistubs.warmup import warmup
+            warmup()
+        if self.ENABLED and self.DB_PRESET_ENABLED and self.ENV_TTL and self.ENV_SWEEP_INTERVAL:
+            from apistubs.sweep import start_sweeper
+            start_sweeper()
 
 
 
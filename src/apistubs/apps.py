@@ -7,3 +7,7 @@ __all__ = (
 
 class APIStubsConfig(AppConfig):
     name = 'apistubs'
+
+    def ready(self):
+        from apistubs import settings
+        settings.ready()
@@ -0,0 +1,69 @@
+import hashlib
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+ENDPOINT_FIELDS = ('env', 'spec_name', 'method', 'pattern')
+HASH_BATCH_SIZE = 1000
+
+
+def remove_duplicates(apps, schema_editor):
+    # DBSettings applies rows in `index` order, so the last one is what was served
+    Mock = apps.get_model('dbpreset', 'Mock')
+    objects = Mock.objects.using(schema_editor.connection.alias)
+    duplicates = objects.values(*ENDPOINT_FIELDS).annotate(count=Count('id')).filter(count__gt=1)
+    for duplicate in duplicates:
+        rows = objects.filter(**{field: duplicate[field] for field in ENDPOINT_FIELDS})
+        keep = rows.order_by('-index', '-id').values_list('id', flat=True)[0]
+        rows.exclude(id=keep).delete()
+
+
+def hash_patterns(apps, schema_editor):
+    Mock = apps.get_model('dbpreset', 'Mock')
+    objects = Mock.objects.using(schema_editor.connection.alias)
+    batch = []
+    for mock in objects.only('id', 'pattern').iterator(chunk_size=HASH_BATCH_SIZE):
+        mock.pattern_hash = hashlib.sha1(mock.pattern.encode('utf-8')).hexdigest()
+        batch.append(mock)
+        if len(batch) >= HASH_BATCH_SIZE:
+            objects.bulk_update(batch, ['pattern_hash'])
+            batch = []
+    objects.bulk_update(batch, ['pattern_hash'])
+
+
+class Migration(migrations.Migration):
+    """
+    The unique endpoint key holds a sha1 of the pattern and not the pattern itself:
+    with a varchar(1000) pattern it is over the 3072 bytes InnoDB index limit on
+    MySQL/utf8mb4, and a long pattern may not fit a PostgreSQL btree row
+    """
+
+    dependencies = [
+        ('dbpreset', '0002_auto_20240630_1641'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='mock',
+            name='env',
+            field=models.CharField(default='', max_length=100),
+        ),
+        migrations.AddField(
+            model_name='mock',
+            name='pattern_hash',
+            field=models.CharField(default='', max_length=40),
+        ),
+        migrations.RunPython(hash_patterns, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='mock',
+            index=models.Index(fields=['env', 'spec_name', 'index'], name='dbpreset_mock_env_spec_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='mock',
+            constraint=models.UniqueConstraint(
+                fields=('env', 'spec_name', 'method', 'pattern_hash'), name='dbpreset_mock_unique_endpoint'
+            ),
+        ),
+    ]
@@ -0,0 +1,38 @@
+from django.db import migrations, models
+from django.utils import timezone
+
+
+DOCUMENT_ENV_PREFIX = 'storage:'
+
+
+def create_envs(apps, schema_editor):
+    # envs saved before Env rows existed start their TTL now
+    Env = apps.get_model('dbpreset', 'Env')
+    Mock = apps.get_model('dbpreset', 'Mock')
+    alias = schema_editor.connection.alias
+    now = timezone.now()
+    Env.objects.using(alias).filter(used_at__isnull=True).update(used_at=now)
+    known = set(Env.objects.using(alias).values_list('name', flat=True))
+    names = Mock.objects.using(alias).exclude(
+        env__startswith=DOCUMENT_ENV_PREFIX
+    ).values_list('env', flat=True).distinct()
+    Env.objects.using(alias).bulk_create(
+        [Env(name=name, used_at=now) for name in names if name not in known],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dbpreset', '0004_env'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='env',
+            name='used_at',
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+        migrations.RunPython(create_envs, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dbpreset', '0006_logentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LogLock',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('env', models.CharField(max_length=100, unique=True)),
+            ],
+        ),
+    ]
@@ -1,3 +1,6 @@
+import hashlib
+
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
 
 
@@ -8,10 +11,27 @@ class Mock(models.Model):
     status = models.IntegerField()
     method = models.CharField(max_length=6)
     pattern = models.CharField(max_length=1000)
+    # sha1 of the pattern, unique with env/spec/method in an index of a size every backend takes
+    pattern_hash = models.CharField(max_length=40, default='')
     spec_name = models.CharField(db_index=True, max_length=100)
-    env = models.CharField(db_index=True, max_length=100, default='')
+    env = models.CharField(max_length=100, default='')
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            # presets of an env/spec in order (DBSettings), env prefix for whole env reads
+            models.Index(fields=['env', 'spec_name', 'index'], name='dbpreset_mock_env_spec_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['env', 'spec_name', 'method', 'pattern_hash'], name='dbpreset_mock_unique_endpoint'
+            ),
+        ]
+
+    @staticmethod
+    def hash_pattern(pattern):
+        return hashlib.sha1(pattern.encode('utf-8')).hexdigest()
+
     def get_content(self):
         if isinstance(self.content, list):
             return dict(self.content)
@@ -22,3 +42,36 @@ class Mock(models.Model):
         if isinstance(content, dict):
             return [list(i) for i in content.items()]
         return content
+
+
+class Env(models.Model):
+    """
+    Env of saved presets. With a `parent` its Mock rows hold only the endpoints
+    it overrides, without one it sits on the YAML baseline. Envs not used for
+    ENV_TTL are swept, see apistubs.sweep
+    """
+    name = models.CharField(max_length=100, unique=True)
+    parent = models.CharField(max_length=100, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    used_at = models.DateTimeField(null=True, db_index=True)
+
+
+class LogEntry(models.Model):
+    """
+    Request log of an env for apistubs.logging.DBLogBuffer, the id is the sequence
+    """
+    env = models.CharField(max_length=100)
+    data = models.JSONField(encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['env', '-id'], name='dbpreset_logentry_env_idx'),
+        ]
+
+
+class LogLock(models.Model):
+    """
+    Row locked by apistubs.logging.DBLogBuffer while it writes log entries of the env
+    """
+    env = models.CharField(max_length=100, unique=True)
@@ -1,22 +1,85 @@
+import hashlib
+import logging
 import os
+import pickle
+import threading
+import time
 import yaml
 
+from collections import OrderedDict
+
 from urllib.parse import (
     urlparse,
     urlunparse,
 )
 import json
-from jinja2 import Environment, BaseLoader
+from jinja2 import BaseLoader
+from jinja2.sandbox import SandboxedEnvironment
+
+from apistubs import settings as su_settings
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
 
 __all__ = (
     'get_path',
+    'replace_path',
+    'freeze',
+    'FrozenDict',
+    'FrozenList',
+    'LazyMapping',
     'replace_host',
     'render_params',
+    'render_content',
     'parse_preset_response',
     'clear_comments',
     'load_apistubs_yaml',
+    'get_apistubs_yaml_generation',
+    'LRUCache',
+    'FileWatcher',
 )
 
+logger = logging.getLogger('apistubs')
+
+
+class LRUCache:
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                self.data.move_to_end(key)
+            except KeyError:
+                return default
+            return self.data[key]
+
+    def set(self, key, value):
+        if not self.maxsize:
+            return
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            return self.data.pop(key, default)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
 
 def get_path(data, *args):
     attr = data
@@ -30,6 +93,187 @@ def get_path(data, *args):
     return attr
 
 
+def replace_path(data, value, *args):
+    # copy-on-write: only the containers along the path are copied
+    if not args:
+        return value
+    if isinstance(data, LazyMapping):
+        # the other values stay pickled
+        value = value if len(args) == 1 else replace_path(data[args[0]], value, *args[1:])
+        return data.replace(args[0], value)
+    if isinstance(data, list):
+        result = list(data)
+    else:
+        result = dict(data)
+    if len(args) == 1:
+        result[args[0]] = value
+    else:
+        result[args[0]] = replace_path(data[args[0]], value, *args[1:])
+    return result
+
+
+def read_only(self, *args, **kwargs):
+    raise TypeError('%s is read-only, use replace_path()' % type(self).__name__)
+
+
+class FrozenDict(dict):
+    __setitem__ = __delitem__ = __ior__ = read_only
+    clear = pop = popitem = setdefault = update = read_only
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+
+class FrozenList(list):
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = read_only
+    append = extend = insert = pop = remove = clear = sort = reverse = read_only
+
+    def __reduce__(self):
+        return (FrozenList, (list(self),))
+
+
+yaml.SafeDumper.add_representer(FrozenDict, yaml.SafeDumper.represent_dict)
+yaml.SafeDumper.add_representer(FrozenList, yaml.SafeDumper.represent_list)
+
+
+def chain_transforms(first, second):
+    if first is None or second is None:
+        return first or second
+    return lambda value: second(first(value))
+
+
+class LazyMapping(FrozenDict):
+    """
+    Read-only mapping of pickled values, each one is unpickled, frozen and
+    passed to `transform` on first access. Iterating items/values does not keep them.
+    """
+    def __init__(self, blobs, transform=None):
+        super().__init__(blobs)
+        self.loaded = set()
+        self.transform = transform
+
+    def load(self, key):
+        value = freeze(pickle.loads(dict.__getitem__(self, key)))
+        if self.transform is not None:
+            value = self.transform(value)
+        return value
+
+    def __getitem__(self, key):
+        if key in self.loaded:
+            return dict.__getitem__(self, key)
+        value = self.load(key)
+        dict.__setitem__(self, key, value)
+        self.loaded.add(key)
+        return value
+
+    def derive(self, transform=None, values=None):
+        """
+        A LazyMapping of the same pickles, `transform` applies on top of
+        this one's and `values` ({key: value}) replace loaded ones
+        """
+        # loaded first, a key loaded meanwhile already has its value in the dict
+        loaded = set(self.loaded)
+        items = dict(dict.items(self))
+        result = LazyMapping(items, transform=chain_transforms(self.transform, transform))
+        for key in loaded:
+            result.set_loaded(key, transform(items[key]) if transform is not None else items[key])
+        for key, value in (values or {}).items():
+            result.set_loaded(key, value)
+        return result
+
+    def set_loaded(self, key, value):
+        dict.__setitem__(self, key, value)
+        self.loaded.add(key)
+
+    def replace(self, key, value):
+        return self.derive(values={key: value})
+
+    # also makes dict(...) go through keys() and __getitem__
+    def __iter__(self):
+        return dict.__iter__(self)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def value(self, key):
+        if key in self.loaded:
+            return dict.__getitem__(self, key)
+        return self.load(key)
+
+    def values(self):
+        return [self.value(key) for key in self.keys()]
+
+    def items(self):
+        return [(key, self.value(key)) for key in self.keys()]
+
+    def copy(self):
+        return dict(self.items())
+
+    def __eq__(self, other):
+        return dict(self.items()) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self.items()),))
+
+
+yaml.SafeDumper.add_representer(LazyMapping, yaml.SafeDumper.represent_dict)
+
+
+def pack_lazy(data):
+    # split `paths` and `components/*` into per-item pickles
+    rest = {}
+    blobs = {}
+    for key, value in data.items():
+        if key == 'paths' and isinstance(value, dict):
+            blobs[(key,)] = value
+        elif key == 'components' and isinstance(value, dict):
+            rest[key] = {}
+            for section, items in value.items():
+                if isinstance(items, dict):
+                    blobs[(key, section)] = items
+                else:
+                    rest[key][section] = items
+        else:
+            rest[key] = value
+    for path, items in blobs.items():
+        blobs[path] = {
+            name: pickle.dumps(item, protocol=pickle.HIGHEST_PROTOCOL)
+            for name, item in items.items()
+        }
+    return rest, blobs
+
+
+def unpack_lazy(packed):
+    rest, blobs = packed
+    data = dict(rest)
+    lazy = {}
+    for path, items in blobs.items():
+        if len(path) == 1:
+            lazy[path[0]] = LazyMapping(items)
+        else:
+            lazy.setdefault(path[0], dict(data.pop(path[0], {})))
+            lazy[path[0]][path[1]] = LazyMapping(items)
+    data = freeze(data)
+    for key, value in lazy.items():
+        dict.__setitem__(data, key, freeze(value))
+    return data
+
+
+def freeze(data):
+    if isinstance(data, LazyMapping):
+        return data
+    if isinstance(data, dict):
+        return FrozenDict([(key, freeze(value)) for key, value in data.items()])
+    if isinstance(data, list):
+        return FrozenList([freeze(value) for value in data])
+    return data
+
+
 def replace_host(url, netloc, scheme=None):
     parsed_url = list(urlparse(url.strip()))
     parsed_url[1] = netloc
@@ -38,12 +282,30 @@ def replace_host(url, netloc, scheme=None):
     return urlunparse(parsed_url)
 
 
-def render_params(value, request):
-    if '{{' not in value or '}}' not in value:
-        return value
+template_environment = SandboxedEnvironment(loader=BaseLoader())
+templates = LRUCache(su_settings.TEMPLATE_CACHE_SIZE)
+
+
+def get_template(value):
+    template = templates.get(value)
+    if template is None:
+        template = template_environment.from_string(value)
+        templates.set(value, template)
+    return template
+
+
+def get_template_context(request):
     context = {}
     context.update(request.GET.dict())
     context.update(request.POST.dict())
+    return context
+
+
+def render_params(value, request, context=None):
+    if '{{' not in value or '}}' not in value:
+        return value
+    if context is None:
+        context = get_template_context(request)
 
     """
     fixed = {}
@@ -55,8 +317,45 @@ def render_params(value, request):
     context.update(fixed)
     """
 
-    template = Environment(loader=BaseLoader).from_string(value)
-    return template.render(**context)
+    return get_template(value).render(**context)
+
+
+def render_content(content, request, context=None):
+    """
+    Renders templated strings of a response body, other values are kept
+    """
+    if context is None:
+        context = get_template_context(request)
+    if isinstance(content, str):
+        return render_params(content, request, context)
+    if isinstance(content, dict):
+        return {key: render_content(value, request, context) for key, value in content.items()}
+    if isinstance(content, list):
+        return [render_content(value, request, context) for value in content]
+    return content
+
+
+# (payload, content, headers) by the preset payload object, the content keeps its identity
+preset_payloads = LRUCache(256)
+
+
+def split_headers(payload):
+    """
+    (content, HEADERS) of a preset payload, the same content object for a frozen one
+    """
+    if 'HEADERS' not in payload:
+        return (payload if isinstance(payload, FrozenDict) else payload.copy()), None
+    if not isinstance(payload, FrozenDict):
+        payload = payload.copy()
+        return payload, payload.pop('HEADERS')
+    cached = preset_payloads.get(id(payload))
+    if cached is not None and cached[0] is payload:
+        return cached[1], cached[2]
+    content = dict(payload)
+    headers = content.pop('HEADERS')
+    content = FrozenDict(content)
+    preset_payloads.set(id(payload), (payload, content, headers))
+    return content, headers
 
 
 def parse_preset_response(value, prompt=None):
@@ -81,8 +380,7 @@ def parse_preset_response(value, prompt=None):
         else:
             requested_status = status_alias
         if isinstance(payload, dict):
-            payload = payload.copy()
-            requested_headers = payload.pop('HEADERS', None)
+            payload, requested_headers = split_headers(payload)
         requested_content = payload
     else:
         try:
@@ -131,21 +429,215 @@ def clear_comments(data, dep=0):
         data.pop(app)
 
 
-__file_cache = {}
-__file_cache_timestamp = {}
-
-
-def load_apistubs_yaml(path):
-    modefied = os.path.getctime(path)
-    if __file_cache_timestamp.get(path) == modefied and path in __file_cache:
-        return __file_cache[path]
-    with open(path, 'r', encoding='utf-8') as f:
-        if path.endswith('.json'):
-            data = json.loads(f.read())
-        else:
-            data = yaml.safe_load(f)
+def parse_apistubs_yaml(path, content):
+    if path.endswith('.json'):
+        data = json.loads(content)
+    else:
+        data = yaml.load(content, Loader=SafeLoader)
     data.pop('apistubs', None)
     clear_comments(data)
-    __file_cache[path] = data
-    __file_cache_timestamp[path] = modefied
     return data
+
+
+def get_disk_cache_path(path, lazy=False):
+    name = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()
+    if lazy:
+        name += '.lazy'
+    return os.path.join(su_settings.CACHE_DIR, name + '.pickle')
+
+
+def read_disk_cache(path, stat, lazy=False):
+    # NOTE: pickles are trusted, CACHE_DIR must not be writable by others
+    try:
+        with open(get_disk_cache_path(path, lazy=lazy), 'rb') as f:
+            cached = pickle.load(f)
+    except Exception:
+        # unreadable, truncated or written by another version: parse the file again
+        return None, None
+    if not isinstance(cached, dict) or 'data' not in cached:
+        return None, None
+    if cached.get('path') != path:
+        return None, cached
+    if cached.get('size') == stat.st_size and cached.get('mtime') == stat.st_mtime_ns:
+        return cached['data'], cached
+    return None, cached
+
+
+def write_disk_cache(path, stat, digest, data, lazy=False):
+    cache_path = get_disk_cache_path(path, lazy=lazy)
+    tmp_path = '%s.%s.tmp' % (cache_path, os.getpid())
+    try:
+        os.makedirs(su_settings.CACHE_DIR, exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({
+                'path': path,
+                'size': stat.st_size,
+                'mtime': stat.st_mtime_ns,
+                'hash': digest,
+                'data': data,
+            }, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        pass
+
+
+def read_apistubs_yaml(path, lazy=False):
+    """
+    Parsed and cleaned file, `pack_lazy`-ed for lazy loading
+    """
+    if not su_settings.CACHE_DIR:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = parse_apistubs_yaml(path, f.read())
+        return pack_lazy(data) if lazy else data
+
+    stat = os.stat(path)
+    data, cached = read_disk_cache(path, stat, lazy=lazy)
+    if data is not None:
+        return data
+
+    with open(path, 'rb') as f:
+        content = f.read()
+    digest = hashlib.sha1(content).hexdigest()
+    # touched but not changed, e.g. a fresh checkout
+    if cached is not None and cached.get('path') == path and cached.get('hash') == digest:
+        data = cached['data']
+    else:
+        data = parse_apistubs_yaml(path, content.decode('utf-8'))
+        if lazy:
+            data = pack_lazy(data)
+    write_disk_cache(path, stat, digest, data, lazy=lazy)
+    return data
+
+
+class FileEntry:
+    __slots__ = ('data', 'stamp', 'generation', 'checked_at')
+
+    def __init__(self, data, stamp, generation, checked_at):
+        self.data = data
+        self.stamp = stamp
+        self.generation = generation
+        self.checked_at = checked_at
+
+
+class FileWatcher:
+    """
+    Loaded files with their change detection.
+
+    A file is stat'ed at most once per CHECK_INTERVAL seconds. With
+    WATCH_FILES and inotify_simple installed, an inotify thread marks
+    changed files instead and unchanged files are not stat'ed at all.
+    If the thread dies, files are stat'ed again until the next load starts another.
+    Every (re)load gets a new generation number, caches built on top of
+    a file key on it.
+    """
+    def __init__(self):
+        self.entries = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.inotify = None
+        self.watches = {}
+
+    def get_lock(self, path):
+        with self.lock:
+            return self.locks.setdefault(path, threading.Lock())
+
+    def is_fresh(self, entry, now):
+        if entry.checked_at is None:
+            return False
+        if self.inotify is not None and su_settings.WATCH_FILES:
+            return True
+        return now - entry.checked_at < su_settings.CHECK_INTERVAL
+
+    def load(self, path, lazy=False):
+        key = (path, lazy)
+        now = time.monotonic()
+        entry = self.entries.get(key)
+        if entry is not None and self.is_fresh(entry, now):
+            return entry
+
+        with self.get_lock(key):
+            entry = self.entries.get(key)
+            if entry is not None and self.is_fresh(entry, now):
+                return entry
+            self.watch(path)
+            try:
+                stamp = os.path.getctime(path)
+            except FileNotFoundError:
+                self.entries.pop(key, None)
+                raise
+            if entry is not None and entry.stamp == stamp:
+                entry.checked_at = now
+                return entry
+
+            # shared between requests and threads
+            data = read_apistubs_yaml(path, lazy=lazy)
+            data = unpack_lazy(data) if lazy else freeze(data)
+            with self.lock:
+                self.generation += 1
+                generation = self.generation
+            entry = FileEntry(data, stamp, generation, now)
+            self.entries[key] = entry
+            return entry
+
+    def invalidate(self, path=None):
+        for key, entry in list(self.entries.items()):
+            if path is None or key[0] == path:
+                entry.checked_at = None
+
+    def watch(self, path):
+        if not su_settings.WATCH_FILES or INotify is None:
+            return
+        with self.lock:
+            if self.inotify is None:
+                self.inotify = INotify()
+                self.watches = {}
+                threading.Thread(
+                    target=self.run, args=(self.inotify,), name='apistubs-file-watcher', daemon=True
+                ).start()
+            directory = os.path.dirname(os.path.abspath(path))
+            if directory in self.watches.values():
+                return
+            mask = (
+                inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO | inotify_flags.MOVED_FROM |
+                inotify_flags.CREATE | inotify_flags.DELETE | inotify_flags.ATTRIB
+            )
+            try:
+                self.watches[self.inotify.add_watch(directory, mask)] = directory
+            except OSError:
+                pass
+
+    def run(self, inotify):
+        try:
+            while True:
+                for event in inotify.read():
+                    directory = self.watches.get(event.wd)
+                    if directory is None:
+                        continue
+                    changed = os.path.join(directory, event.name)
+                    for path, lazy in list(self.entries):
+                        if os.path.abspath(path) == changed:
+                            self.invalidate(path)
+        except Exception:
+            logger.warning('apistubs file watcher stopped', exc_info=True)
+        finally:
+            # back to the stat/interval check, changes may have been missed meanwhile
+            inotify.close()
+            self.invalidate()
+            with self.lock:
+                if self.inotify is inotify:
+                    self.inotify = None
+
+
+file_watcher = FileWatcher()
+
+
+def load_apistubs_yaml(path, lazy=False):
+    return file_watcher.load(path, lazy=lazy).data
+
+
+def get_apistubs_yaml_generation(path, lazy=False):
+    try:
+        return file_watcher.load(path, lazy=lazy).generation
+    except FileNotFoundError:
+        return None
@@ -1,45 +1,503 @@
+import atexit
+import logging
 import sys
 import json
+import threading
+import time
+
+from collections import deque
+from fnmatch import fnmatchcase
+from itertools import takewhile
 
 from django.core.cache import cache
+from django.db import transaction
+from django.utils.module_loading import import_string
 
 from apistubs import settings as su_settings
+from apistubs.presets import get_redis_client
+from apistubs.serializers import dumps
 
 __all__ = (
     'RequestLog',
+    'BaseLogBuffer',
+    'CacheLogBuffer',
+    'LocalLogBuffer',
+    'RedisLogBuffer',
+    'DBLogBuffer',
+    'LogWriter',
+    'get_log_buffer',
+    'get_log_writer',
 )
 
+logger = logging.getLogger('apistubs')
+
 
 BRIGHT_YELLOW = '\033[93m'
 BRIGHT_RED = '\033[91m'
 RESET = '\033[0m'
 
 
-def _get_request_body(request):
+def _read_request_body(request):
+    # read in the request, the stream is gone once the response is out
+    try:
+        return request.body
+    except Exception:
+        return None
+
+
+def _get_request_body(body):
     try:
         # TODO: set-up proper Exceptions
-        body = json.loads(request.body)
+        body = json.loads(body)
     except:
         return None
     return body
 
 
+def take_since(entries, since):
+    # entries are the newest first
+    if since is None:
+        return entries
+    return list(takewhile(lambda entry: entry[0] > since, entries))
+
+
+class BaseLogBuffer:
+    """
+    The last `capacity` log items of every env, appended atomically
+    with the older ones trimmed, each one numbered by a growing sequence
+    """
+    def append(self, env, item, capacity):
+        """
+        Returns the sequence of the item
+        """
+        raise NotImplementedError
+
+    def extend(self, env, items, capacity):
+        """
+        Appends a batch of items in order, returns the sequence of the last one
+        """
+        sequence = None
+        for item in items:
+            sequence = self.append(env, item, capacity)
+        return sequence
+
+    def entries(self, env, capacity, since=None):
+        """
+        [(sequence, item), ...] the newest first, only after `since` if given
+        """
+        raise NotImplementedError
+
+    def clear(self, env):
+        raise NotImplementedError
+
+    def delete(self, env, capacity):
+        """
+        Drops everything stored for the env, its sequence starts over
+        """
+        self.clear(env)
+
+
+class CacheLogBuffer(BaseLogBuffer):
+    """
+    A ring of `capacity` slots in the Django cache: an append is an incr of the
+    env sequence and a set of its slot, nothing is read back or lost to a concurrent
+    worker, and only the new item is pickled.
+    A sequence taken but not stored yet ends the entries, so a reader never moves past
+    it; after PENDING_TIMEOUT seconds of newer entries its writer is gone and it is skipped
+    """
+    TIMEOUT = 60 * 60 * 24 * 30
+    PENDING_TIMEOUT = 2
+
+    def __init__(self, prefix='LOG'):
+        self.prefix = prefix
+
+    def get_key(self, env, name):
+        return '%s%s:%s' % (self.prefix, env, name)
+
+    def next_sequence(self, env, count=1):
+        key = self.get_key(env, 'seq')
+        try:
+            return cache.incr(key, count)
+        except ValueError:
+            # start from a new value, an evicted sequence never goes back
+            start = time.time_ns() // 1000
+            if cache.add(key, start, timeout=self.TIMEOUT):
+                # nothing up to the start is written, not even pending
+                cache.set(self.get_key(env, 'floor'), start, timeout=self.TIMEOUT)
+            return cache.incr(key, count)
+
+    def append(self, env, item, capacity):
+        sequence = self.next_sequence(env)
+        cache.set(self.get_key(env, sequence % capacity), (sequence, item, time.time()), timeout=self.TIMEOUT)
+        return sequence
+
+    def extend(self, env, items, capacity):
+        if not items:
+            return None
+        last = self.next_sequence(env, len(items))
+        first = last - len(items) + 1
+        written_at = time.time()
+        # a later item of the same slot overwrites an earlier one
+        cache.set_many({
+            self.get_key(env, sequence % capacity): (sequence, item, written_at)
+            for sequence, item in zip(range(first, last + 1), items)
+        }, timeout=self.TIMEOUT)
+        return last
+
+    def entries(self, env, capacity, since=None):
+        seq_key, floor_key = self.get_key(env, 'seq'), self.get_key(env, 'floor')
+        values = cache.get_many([seq_key, floor_key])
+        sequence = values.get(seq_key)
+        if sequence is None:
+            return []
+        sequences = range(sequence, max(sequence - capacity, values.get(floor_key, 0), since or 0), -1)
+        if not sequences:
+            return []
+        slots = cache.get_many([self.get_key(env, i % capacity) for i in sequences])
+        entries, written_at = [], 0
+        pending_since = time.time() - self.PENDING_TIMEOUT
+        for i in sequences:
+            entry = slots.get(self.get_key(env, i % capacity))
+            if entry is not None and entry[0] == i:
+                entries.append(entry[:2])
+                written_at = entry[2]
+            elif written_at > pending_since:
+                # the slot is not written yet, the newer entries come after it
+                entries = []
+            # else it holds a lap before or its item is lost
+        return entries
+
+    def clear(self, env):
+        seq_key = self.get_key(env, 'seq')
+        sequence = cache.get(seq_key)
+        if sequence is None:
+            return
+        # the sequence goes on, entries up to the floor are gone
+        cache.set(self.get_key(env, 'floor'), sequence, timeout=self.TIMEOUT)
+
+    def delete(self, env, capacity):
+        # a new sequence starts after the time it is taken at, above this one
+        cache.delete_many(
+            [self.get_key(env, 'seq'), self.get_key(env, 'floor')] +
+            [self.get_key(env, i) for i in range(capacity)]
+        )
+
+
+class LocalLogBuffer(BaseLogBuffer):
+    """
+    A deque per env in the process, for a single worker
+    """
+    def __init__(self):
+        self.logs = {}
+        self.sequences = {}
+        self.lock = threading.Lock()
+
+    def append(self, env, item, capacity):
+        with self.lock:
+            sequence = self.sequences.get(env, 0) + 1
+            self.sequences[env] = sequence
+            log = self.logs.get(env)
+            if log is None or log.maxlen != capacity:
+                log = self.logs[env] = deque(log or (), maxlen=capacity)
+            log.appendleft((sequence, item))
+            return sequence
+
+    def entries(self, env, capacity, since=None):
+        with self.lock:
+            entries = list(self.logs.get(env, ()))[:capacity]
+        return take_since(entries, since)
+
+    def clear(self, env):
+        with self.lock:
+            self.logs.pop(env, None)
+
+    def delete(self, env, capacity):
+        with self.lock:
+            self.logs.pop(env, None)
+            self.sequences.pop(env, None)
+
+
+class RedisLogBuffer(BaseLogBuffer):
+    """
+    A list per env in a Redis-protocol server, the sequence, LPUSH and LTRIM
+    in one transaction
+    """
+    def __init__(self, client=None, url=None, prefix='apistubs:'):
+        self.client = get_redis_client(client, url)
+        self.prefix = prefix
+
+    def get_key(self, env):
+        return '%slog:%s' % (self.prefix, env)
+
+    def append(self, env, item, capacity):
+        return self.extend(env, [item], capacity)
+
+    def extend(self, env, items, capacity):
+        if not items:
+            return None
+        key = self.get_key(env)
+        seq_key = key + ':seq'
+
+        def push(pipeline):
+            first = int(pipeline.get(seq_key) or 0) + 1
+            last = first + len(items) - 1
+            pipeline.multi()
+            pipeline.set(seq_key, last)
+            pipeline.lpush(key, *[
+                dumps([sequence, item], 'compact')
+                for sequence, item in zip(range(first, last + 1), items)
+            ])
+            pipeline.ltrim(key, 0, capacity - 1)
+            return last
+
+        # the sequence is taken with the push, the list never shows a newer one first
+        return self.client.transaction(push, seq_key, value_from_callable=True)
+
+    def entries(self, env, capacity, since=None):
+        values = self.client.lrange(self.get_key(env), 0, capacity - 1)
+        return take_since([tuple(json.loads(value)) for value in values], since)
+
+    def clear(self, env):
+        self.client.delete(self.get_key(env))
+
+    def delete(self, env, capacity):
+        key = self.get_key(env)
+        self.client.delete(key, key + ':seq')
+
+
+class DBLogBuffer(BaseLogBuffer):
+    """
+    dbpreset.LogEntry rows, the row id is the sequence. Writes of an env hold
+    its dbpreset.LogLock row, so ids of the env are committed in order
+    """
+    @property
+    def model(self):
+        from apistubs.dbpreset.models import LogEntry
+        return LogEntry
+
+    @property
+    def lock_model(self):
+        from apistubs.dbpreset.models import LogLock
+        return LogLock
+
+    def append(self, env, item, capacity):
+        return self.extend(env, [item], capacity)
+
+    def extend(self, env, items, capacity):
+        if not items:
+            return None
+        with transaction.atomic():
+            self.lock(env)
+            entries = self.model.objects.bulk_create([self.model(env=env, data=item) for item in items])
+            self.trim(env, capacity)
+        return entries[-1].id
+
+    def lock(self, env):
+        # writers of the env take ids and commit one at a time, so a reader
+        # never sees an id before a smaller one of the env is committed
+        locks = self.lock_model.objects.select_for_update().filter(env=env)
+        if not list(locks.values_list('env', flat=True)):
+            self.lock_model.objects.bulk_create([self.lock_model(env=env)], ignore_conflicts=True)
+            list(locks.values_list('env', flat=True))
+
+    def trim(self, env, capacity):
+        # everything from the first row past the capacity
+        cutoff = self.model.objects.filter(env=env).order_by('-id').values_list('id', flat=True)
+        cutoff = list(cutoff[capacity:capacity + 1])
+        if cutoff:
+            self.model.objects.filter(env=env, id__lte=cutoff[0]).delete()
+
+    def entries(self, env, capacity, since=None):
+        queryset = self.model.objects.filter(env=env).order_by('-id').values_list('id', 'data')
+        entries = list(queryset[:capacity])
+        return take_since(entries, since)
+
+    def clear(self, env):
+        self.model.objects.filter(env=env).delete()
+
+    def delete(self, env, capacity):
+        self.clear(env)
+        self.lock_model.objects.filter(env=env).delete()
+
+
+log_buffers = {}
+log_buffers_lock = threading.Lock()
+
+
+def get_log_buffer():
+    key = (su_settings.REQUEST_LOG_BUFFER, repr(su_settings.REQUEST_LOG_BUFFER_OPTIONS))
+    log_buffer = log_buffers.get(key)
+    if log_buffer is None:
+        with log_buffers_lock:
+            log_buffer = log_buffers.get(key)
+            if log_buffer is None:
+                log_buffer = import_string(su_settings.REQUEST_LOG_BUFFER)(
+                    **(su_settings.REQUEST_LOG_BUFFER_OPTIONS or {})
+                )
+                log_buffers[key] = log_buffer
+    return log_buffer
+
+
+class LogWriter:
+    """
+    Bounded queue of log records drained by a daemon thread in batches.
+    When full, the `drop_policy` drops the `newest` record (the one being added)
+    or the `oldest` queued one, `dropped` counts them.
+    """
+    DROP_POLICIES = ('newest', 'oldest')
+
+    def __init__(self, size=10000, batch_size=100, interval=0.1, drop_policy='newest'):
+        if drop_policy not in self.DROP_POLICIES:
+            raise ValueError('Unknown drop policy: %s' % drop_policy)
+        self.size = size
+        self.batch_size = batch_size
+        self.interval = interval
+        self.drop_policy = drop_policy
+        self.queue = deque()
+        self.condition = threading.Condition()
+        self.write_lock = threading.Lock()
+        self.dropped = 0
+        self.stopped = False
+        self.thread = None
+
+    def put(self, record):
+        with self.condition:
+            if len(self.queue) >= self.size:
+                self.dropped += 1
+                if self.drop_policy == 'newest':
+                    return False
+                self.queue.popleft()
+            self.queue.append(record)
+            if len(self.queue) >= self.batch_size:
+                self.condition.notify()
+        return True
+
+    def start(self):
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='apistubs-log-writer', daemon=True)
+                self.thread.start()
+                atexit.register(self.stop)
+        return self.thread
+
+    def run(self):
+        while True:
+            with self.condition:
+                if not self.stopped and len(self.queue) < self.batch_size:
+                    # let a batch gather
+                    self.condition.wait(self.interval)
+                if self.stopped:
+                    return
+            self.flush(self.batch_size)
+
+    def take(self, count=None):
+        with self.condition:
+            count = len(self.queue) if count is None else min(count, len(self.queue))
+            return [self.queue.popleft() for _ in range(count)]
+
+    def flush(self, count=None):
+        """
+        Writes the queued records, at most `count` of them
+        """
+        with self.write_lock:
+            records = self.take(count)
+            if not records:
+                return 0
+            try:
+                RequestLog.write(records)
+            except Exception:
+                logger.exception('apistubs request log: %d records lost', len(records))
+            return len(records)
+
+    def stop(self, timeout=5):
+        """
+        Stops the thread and writes what is left in the queue
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(timeout)
+        while self.flush(self.batch_size):
+            pass
+
+
+log_writer = None
+log_writer_lock = threading.Lock()
+# notified on every write of the process, waiting readers check their env
+log_written = threading.Condition()
+
+
+def get_log_writer():
+    global log_writer
+    if log_writer is None:
+        with log_writer_lock:
+            if log_writer is None:
+                writer = LogWriter(
+                    size=su_settings.REQUEST_LOG_QUEUE_SIZE,
+                    batch_size=su_settings.REQUEST_LOG_BATCH_SIZE,
+                    interval=su_settings.REQUEST_LOG_FLUSH_INTERVAL,
+                    drop_policy=su_settings.REQUEST_LOG_DROP_POLICY,
+                )
+                writer.start()
+                log_writer = writer
+    return log_writer
+
+
 class RequestLog:
-    MAX = 20
-    CACHE_KEY = 'LOG'
+    @classmethod
+    def get_capacity(cls, env):
+        # REQUEST_LOG_ENV_SIZES: {env pattern: size}, the first match wins
+        for pattern, size in (su_settings.REQUEST_LOG_ENV_SIZES or {}).items():
+            if fnmatchcase(env, pattern):
+                return size
+        return su_settings.REQUEST_LOG_SIZE
+
+    @classmethod
+    def get_entries(cls, env, since=None):
+        return get_log_buffer().entries(env, cls.get_capacity(env), since=since)
+
+    @classmethod
+    def wait(cls, env, since=None, timeout=0):
+        """
+        Entries after `since`, waiting up to `timeout` seconds for the first ones.
+        Writes of the process wake it up at once, the others (workers, hosts)
+        are seen within REQUEST_LOG_POLL_INTERVAL
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            entries = cls.get_entries(env, since=since)
+            remaining = deadline - time.monotonic()
+            if entries or remaining <= 0:
+                return entries
+            with log_written:
+                log_written.wait(min(remaining, su_settings.REQUEST_LOG_POLL_INTERVAL))
+
+    @classmethod
+    def notify(cls):
+        with log_written:
+            log_written.notify_all()
 
     @classmethod
     def get(cls, env):
-        value = cache.get(cls.CACHE_KEY + env)
-        if not value:
-            value = []
-        return value
+        return [item for _, item in cls.get_entries(env)]
 
     @classmethod
     def add_success(
         cls, service='default', method='get', path='/',
         pattern=None, status=200, content={}, prompt=None, data={}, headers={},
         response_headers={}, params={}, env='', request=None
+    ):
+        cls.submit(cls.build_success, env, dict(
+            service=service, method=method, path=path, pattern=pattern, status=status,
+            content=content, prompt=prompt, data=data, headers=headers,
+            response_headers=response_headers, params=params, body=_read_request_body(request),
+        ))
+
+    @classmethod
+    def build_success(
+        cls, service, method, path, pattern, status, content, prompt, data, headers,
+        response_headers, params, body
     ):
         msg = {
             'result': 'success',
@@ -55,14 +513,13 @@ class RequestLog:
             'data': data,
             'headers': headers,
             'params': params,
-            'body': _get_request_body(request),
+            'body': _get_request_body(body),
         }
         msg['response'] = {
             'status': status,
             'content': content,
             'headers': response_headers,
         }
-        cls.add(msg, env)
 
         if su_settings.PRINT_INFO:
             sys.stdout.write(
@@ -70,12 +527,20 @@ class RequestLog:
                 '[STUB] {}: {}#{}\n'.format(service, method.lower(), pattern) +
                 RESET
             )
+        return msg
 
     @classmethod
     def add_not_specified(
         cls, service='default', method='get', path='/', data={},
         headers={}, params={}, env='', request=None
     ):
+        cls.submit(cls.build_not_specified, env, dict(
+            service=service, method=method, path=path, data=data, headers=headers,
+            params=params, body=_read_request_body(request),
+        ))
+
+    @classmethod
+    def build_not_specified(cls, service, method, path, data, headers, params, body):
         msg = {
             'result': 'not_specified',
             'service': service,
@@ -85,10 +550,9 @@ class RequestLog:
                 'data': data,
                 'headers': headers,
                 'params': params,
-                'body': _get_request_body(request),
+                'body': _get_request_body(body),
             }
         }
-        cls.add(msg, env)
 
         if su_settings.PRINT_INFO:
             sys.stdout.write((
@@ -99,14 +563,44 @@ class RequestLog:
                 '$ ministubs sample --snapshots [ANY] --service {s} --path {p}' +
                 RESET + '\n'
             ).format(s=service, m=method.lower(), p=path))
+        return msg
+
+    @classmethod
+    def submit(cls, build, env, kwargs):
+        """
+        Builds and stores the item in the request or, with REQUEST_LOG_ASYNC,
+        queues it for the background writer
+        """
+        if su_settings.REQUEST_LOG_ASYNC:
+            get_log_writer().put((build, env, kwargs))
+            return
+        cls.add(build(**kwargs), env)
+
+    @classmethod
+    def write(cls, records):
+        # a batch of queued records, stored an env at a time
+        items = {}
+        for build, env, kwargs in records:
+            items.setdefault(env, []).append(build(**kwargs))
+        log_buffer = get_log_buffer()
+        for env, env_items in items.items():
+            log_buffer.extend(env, env_items, cls.get_capacity(env))
+        cls.notify()
+
+    @classmethod
+    def get_dropped(cls):
+        return log_writer.dropped if log_writer is not None else 0
 
     @classmethod
     def add(cls, item, env):
-        value = cls.get(env)
-        value.insert(0, item)
-        value = value[:cls.MAX]
-        cache.set(cls.CACHE_KEY + env, value, timeout=60 * 60 * 24 * 30)
+        sequence = get_log_buffer().append(env, item, cls.get_capacity(env))
+        cls.notify()
+        return sequence
 
     @classmethod
     def clear(cls, env):
-        cache.delete(cls.CACHE_KEY + env)
+        get_log_buffer().clear(env)
+
+    @classmethod
+    def delete(cls, env):
+        get_log_buffer().delete(env, cls.get_capacity(env))
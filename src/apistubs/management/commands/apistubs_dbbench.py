@@ -0,0 +1,63 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from apistubs.dbpreset.models import Mock
+
+
+class Command(BaseCommand):
+    help = (
+        'Seed dbpreset.Mock inside a rolled back transaction, '
+        'print query plans and timings of the preset lookups'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--envs', type=int, default=200)
+        parser.add_argument('--specs', type=int, default=5)
+        parser.add_argument('--patterns', type=int, default=50)
+        parser.add_argument('--repeat', type=int, default=200)
+
+    def get_queries(self):
+        env, spec_name = 'bench-0', 'spec-0'
+        return [
+            ('env+spec ordered', Mock.objects.order_by('index').filter(spec_name=spec_name, env=env)),
+            ('env ordered', Mock.objects.order_by('index').filter(env=env)),
+            ('endpoint', Mock.objects.filter(
+                env=env, spec_name=spec_name, method='get', pattern_hash=Mock.hash_pattern('/items/0/')
+            )),
+            ('spec', Mock.objects.filter(spec_name=spec_name)),
+        ]
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            Mock.objects.bulk_create([
+                Mock(
+                    index=index,
+                    env='bench-%s' % env,
+                    spec_name='spec-%s' % spec,
+                    method='get',
+                    pattern='/items/%s/' % index,
+                    pattern_hash=Mock.hash_pattern('/items/%s/' % index),
+                    status=0,
+                    content={'index': index},
+                    headers={},
+                )
+                for env in range(options['envs'])
+                for spec in range(options['specs'])
+                for index in range(options['patterns'])
+            ], batch_size=1000)
+            if connection.vendor == 'postgresql':
+                with connection.cursor() as cursor:
+                    cursor.execute('ANALYZE %s' % Mock._meta.db_table)
+
+            self.stdout.write('%s, %s rows' % (connection.vendor, Mock.objects.count()))
+            for name, queryset in self.get_queries():
+                started = time.perf_counter()
+                for _ in range(options['repeat']):
+                    list(queryset.all())
+                elapsed = (time.perf_counter() - started) / options['repeat']
+                self.stdout.write('\n%s: %.3fms' % (name, elapsed * 1000))
+                self.stdout.write(queryset.explain())
+
+            transaction.set_rollback(True)
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from apistubs.sweep import sweep_envs
+
+
+class Command(BaseCommand):
+    help = 'Delete the preset envs not used for ENV_TTL seconds'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ttl', type=int, default=None)
+        parser.add_argument('--batch-size', type=int, default=None)
+        parser.add_argument('--limit', type=int, default=None)
+
+    def handle(self, *args, **options):
+        envs = sweep_envs(ttl=options['ttl'], batch_size=options['batch_size'], limit=options['limit'])
+        for env in envs:
+            self.stdout.write(env)
+        self.stdout.write('%d envs deleted' % len(envs))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from apistubs.warmup import warmup
+
+
+class Command(BaseCommand):
+    help = 'Load specs and presets, build route indexes and openapi finders'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None)
+        parser.add_argument('--executor', choices=['thread', 'process'], default=None)
+
+    def handle(self, *args, **options):
+        timings = warmup(workers=options['workers'], executor=options['executor'])
+        for name, seconds in sorted(timings.items(), key=lambda item: -item[1]):
+            self.stdout.write('%8.3fs  %s' % (seconds, name))
@@ -1,14 +1,14 @@
-import json
 import sys
 
 from django.conf import settings as app_settings
 from django.utils.deprecation import MiddlewareMixin
-from django.http import HttpResponse, JsonResponse
+from django.http import JsonResponse
 
 from apistubs import VERSION
 from apistubs import settings as su_settings
 from apistubs.stubs import get_stub_response
 from apistubs.logging import RequestLog
+from apistubs.payload import payload_response
 
 __all__ = (
     'APIStubsMiddleware',
@@ -58,12 +58,10 @@ class APIStubsMiddleware(MiddlewareMixin):
                 response_headers=headers, request=request
             )
 
-            if not isinstance(payload, str):
-                payload = json.dumps(payload, indent=4, ensure_ascii=False)
-
-            response = HttpResponse(payload, status=status, content_type='application/json')
-            for header in headers:
-                response[header] = headers[header]
+            # the app's own middleware stack decides on compression here
+            response = payload_response(
+                request, stub_response.render(request), status=int(status), headers=headers, compress=False
+            )
 
             request.has_staff_ip = False
             response['X-Stub-Mocked'] = 'on'
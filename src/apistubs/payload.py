@@ -0,0 +1,138 @@
+import gzip
+import hashlib
+
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_etags
+
+from apistubs import settings as su_settings
+from apistubs.serializers import dumps
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+__all__ = (
+    'Payload',
+    'payload_response',
+)
+
+
+def gzip_compress(body):
+    # mtime=0 keeps the output and so the ETag stable
+    return gzip.compress(body, compresslevel=9, mtime=0)
+
+
+def brotli_compress(body):
+    return brotli.compress(body, quality=8)
+
+
+COMPRESSORS = {
+    'gzip': gzip_compress,
+}
+if brotli is not None:
+    COMPRESSORS['br'] = brotli_compress
+
+
+class Payload:
+    """
+    Serialized response body with its strong ETag, compressed
+    variants are computed on first use and kept with it
+    """
+    def __init__(self, body):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.body = body
+        self.etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        self.variants = {}
+        self.is_template = b'{{' in body
+
+    @classmethod
+    def from_content(cls, content):
+        if not isinstance(content, str):
+            content = dumps(content)
+        return cls(content)
+
+    def encode(self, encoding):
+        """
+        Returns (body, etag) for the content-coding, None is identity
+        """
+        if encoding is None:
+            return self.body, self.etag
+        variant = self.variants.get(encoding)
+        if variant is None:
+            variant = (COMPRESSORS[encoding](self.body), '"%s-%s"' % (self.etag.strip('"'), encoding))
+            self.variants[encoding] = variant
+        return variant
+
+
+def get_accepted_encodings(request):
+    accepted = {}
+    for item in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        name, _, params = item.partition(';')
+        name = name.strip().lower()
+        if not name:
+            continue
+        quality = 1.0
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[name] = quality
+    return accepted
+
+
+def select_encoding(request, payload):
+    if len(payload.body) < su_settings.COMPRESSION_MIN_SIZE:
+        return None
+    accepted = get_accepted_encodings(request)
+    for encoding in su_settings.COMPRESSION or ():
+        if encoding in COMPRESSORS and accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return None
+
+
+def is_not_modified(request, etag):
+    if request.method not in ('GET', 'HEAD'):
+        return False
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if not if_none_match:
+        return False
+    etags = [value[2:] if value.startswith('W/') else value for value in parse_etags(if_none_match)]
+    return '*' in etags or etag in etags
+
+
+def payload_response(request, payload, status=200, headers=None, content_type='application/json', compress=True):
+    """
+    Response for a cached payload, 304 when the client already has it.
+    Preset ETag and Content-Encoding headers take precedence, `compress`
+    negotiates an encoding of APISTUBS_COMPRESSION (off by default).
+    """
+    headers = headers or {}
+    header_names = {key.lower() for key in headers}
+    use_etag = 200 <= status < 300 and 'etag' not in header_names
+
+    encoding = None
+    compressible = compress and su_settings.COMPRESSION and 'content-encoding' not in header_names
+    if compressible:
+        encoding = select_encoding(request, payload)
+    body, etag = payload.encode(encoding)
+
+    if use_etag and is_not_modified(request, etag):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(body, status=status, content_type=content_type)
+        if encoding:
+            response['Content-Encoding'] = encoding
+
+    for key in headers:
+        response[key] = headers[key]
+    if use_etag:
+        response['ETag'] = etag
+    if compressible:
+        patch_vary_headers(response, ('Accept-Encoding',))
+    return response
@@ -0,0 +1,526 @@
+import json
+import threading
+import uuid
+
+from django.db import transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from apistubs import settings as su_settings
+from apistubs.serializers import dumps
+
+__all__ = (
+    'BasePresetStore',
+    'ORMPresetStore',
+    'RedisPresetStore',
+    'FakeRedis',
+    'get_redis_client',
+    'get_preset_store',
+)
+
+
+class BasePresetStore:
+    """
+    Presets saved through the API: per env {spec_name: {`method#pattern`: content}}
+    in the order they were saved, and the documents of the spec storage.
+    """
+    def get(self, env, spec_name):
+        return self.get_env(env).get(spec_name, {})
+
+    def get_env(self, env):
+        presets = {}
+        for spec_name, key, content in self.iter_env(env):
+            presets.setdefault(spec_name, {})[key] = content
+        return presets
+
+    def iter_env(self, env):
+        """
+        (spec_name, `method#pattern`, content) ordered by spec and index
+        """
+        raise NotImplementedError
+
+    def save(self, env, entries, replace=False, batch_size=None):
+        """
+        Writes (spec_name, method, pattern, content) entries, each one takes
+        the index of its position, `replace` drops the rest of the env
+        """
+        raise NotImplementedError
+
+    def delete_env(self, env):
+        raise NotImplementedError
+
+    def touch(self, envs, used_at):
+        """
+        Marks saved envs as used at `used_at`, a datetime
+        """
+        raise NotImplementedError
+
+    def get_expired_envs(self, before, limit):
+        """
+        At most `limit` saved envs not used since `before`, the oldest first.
+        The default env is never expired
+        """
+        raise NotImplementedError
+
+    def get_parent(self, env):
+        """
+        Env the presets of `env` are inherited from, None for the YAML baseline
+        """
+        raise NotImplementedError
+
+    def set_parent(self, env, parent):
+        raise NotImplementedError
+
+    def get_document(self, name):
+        raise NotImplementedError
+
+    def set_document(self, name, value):
+        raise NotImplementedError
+
+    def get_document_names(self):
+        raise NotImplementedError
+
+
+class ORMPresetStore(BasePresetStore):
+    """
+    dbpreset.Mock rows, spec storage documents are rows of `storage:<name>` envs
+    """
+    UNIQUE_FIELDS = ['env', 'spec_name', 'method', 'pattern_hash']
+    UPDATE_FIELDS = ['index', 'status', 'content', 'headers']
+    DOCUMENT_ENV_PREFIX = 'storage:'
+    DOCUMENT_METHOD = 'spec'
+    CHUNK_SIZE = 2000
+    DELETE_CHUNK_SIZE = 1000
+
+    @property
+    def model(self):
+        from apistubs.dbpreset.models import Mock
+        return Mock
+
+    @property
+    def env_model(self):
+        from apistubs.dbpreset.models import Env
+        return Env
+
+    def get(self, env, spec_name):
+        values = {}
+        for response in self.model.objects.order_by('index').filter(spec_name=spec_name, env=env):
+            values['#'.join([response.method, response.pattern])] = response.get_content()
+        return values
+
+    def get_env(self, env):
+        presets = {}
+        for response in self.model.objects.order_by('index').filter(env=env):
+            presets.setdefault(response.spec_name, {})[
+                '#'.join([response.method, response.pattern])
+            ] = response.get_content()
+        return presets
+
+    def iter_env(self, env):
+        # a server-side cursor where the backend has one
+        queryset = self.model.objects.filter(env=env).order_by('spec_name', 'index').only(
+            'spec_name', 'method', 'pattern', 'content'
+        )
+        for response in queryset.iterator(chunk_size=self.CHUNK_SIZE):
+            yield response.spec_name, '#'.join([response.method, response.pattern]), response.get_content()
+
+    def save(self, env, entries, replace=False, batch_size=None):
+        Mock = self.model
+        with transaction.atomic():
+            if replace:
+                Mock.objects.filter(env=env).delete()
+
+            # one row per endpoint, the last one wins
+            mocks = {}
+            for index, (spec_name, method, pattern, content) in enumerate(entries):
+                mocks[(spec_name, method, pattern)] = Mock(
+                    index=index,
+                    spec_name=spec_name,
+                    method=method,
+                    pattern=pattern,
+                    pattern_hash=Mock.hash_pattern(pattern),
+                    status=0,
+                    content=Mock.prep_content(content),
+                    headers={},
+                    env=env
+                )
+                if batch_size and len(mocks) >= batch_size:
+                    self.upsert(mocks.values())
+                    mocks = {}
+            self.upsert(mocks.values())
+            self.env_model.objects.bulk_create(
+                [self.env_model(name=env, used_at=timezone.now())],
+                update_conflicts=True,
+                unique_fields=['name'],
+                update_fields=['used_at'],
+            )
+
+    def upsert(self, mocks):
+        if not mocks:
+            return
+        self.model.objects.bulk_create(
+            mocks,
+            update_conflicts=True,
+            unique_fields=self.UNIQUE_FIELDS,
+            update_fields=self.UPDATE_FIELDS,
+        )
+
+    def delete_env(self, env):
+        # a swept env can hold millions of rows, short transactions keep the table writable
+        queryset = self.model.objects.filter(env=env)
+        while True:
+            ids = list(queryset.values_list('id', flat=True)[:self.DELETE_CHUNK_SIZE])
+            if not ids:
+                break
+            self.model.objects.filter(id__in=ids).delete()
+        self.env_model.objects.filter(name=env).delete()
+
+    def touch(self, envs, used_at):
+        self.env_model.objects.filter(name__in=envs).update(used_at=used_at)
+
+    def get_expired_envs(self, before, limit):
+        return list(
+            self.env_model.objects.filter(used_at__lt=before).exclude(name='').order_by('used_at')
+            .values_list('name', flat=True)[:limit]
+        )
+
+    def get_parent(self, env):
+        return self.env_model.objects.filter(name=env).values_list('parent', flat=True).first()
+
+    def set_parent(self, env, parent):
+        self.env_model.objects.bulk_create(
+            [self.env_model(name=env, parent=parent, used_at=timezone.now())],
+            update_conflicts=True,
+            unique_fields=['name'],
+            update_fields=['parent', 'used_at'],
+        )
+
+    def get_document(self, name):
+        item = self.model.objects.filter(env=self.DOCUMENT_ENV_PREFIX + name).first()
+        if item is None:
+            return None
+        return item.content
+
+    def set_document(self, name, value):
+        env = self.DOCUMENT_ENV_PREFIX + name
+        if not value:
+            self.model.objects.filter(env=env).delete()
+            return
+        self.model.objects.update_or_create(
+            env=env,
+            spec_name='',
+            method=self.DOCUMENT_METHOD,
+            pattern='',
+            defaults={'index': -1, 'headers': {}, 'status': 0, 'content': value},
+        )
+
+    def get_document_names(self):
+        envs = self.model.objects.filter(env__startswith=self.DOCUMENT_ENV_PREFIX).values_list('env', flat=True)
+        return [env[len(self.DOCUMENT_ENV_PREFIX):] for env in envs]
+
+
+class RedisPresetStore(BasePresetStore):
+    """
+    Presets in a Redis-protocol server, one hash per env so an env is a single
+    HGETALL: field `[spec_name, "method#pattern"]`, value `[index, content]`.
+    Without `url` or `client` it runs on an in-process FakeRedis.
+    """
+    def __init__(self, client=None, url=None, prefix='apistubs:'):
+        self.client = get_redis_client(client, url)
+        self.prefix = prefix
+
+    def get_key(self, env):
+        return '%spresets:%s' % (self.prefix, env)
+
+    def get_documents_key(self):
+        return '%sdocuments' % self.prefix
+
+    def get_parents_key(self):
+        return '%sparents' % self.prefix
+
+    def get_used_key(self):
+        return '%sused' % self.prefix
+
+    def get(self, env, spec_name):
+        return dict(
+            (key, content) for entry_spec_name, key, content in self.iter_env(env)
+            if entry_spec_name == spec_name
+        )
+
+    def iter_env(self, env):
+        entries = []
+        for field, value in self.client.hgetall(self.get_key(env)).items():
+            spec_name, key = json.loads(field)
+            index, content = json.loads(value)
+            entries.append((spec_name, index, key, content))
+        entries.sort(key=lambda entry: entry[:2])
+        for spec_name, index, key, content in entries:
+            yield spec_name, key, content
+
+    def save(self, env, entries, replace=False, batch_size=None):
+        key = self.get_key(env)
+        target = key
+        if replace:
+            # filled aside and renamed over the env, readers never see half of it
+            target = '%s:%s' % (key, uuid.uuid4().hex)
+
+        written = False
+        mapping = {}
+        for index, (spec_name, method, pattern, content) in enumerate(entries):
+            field = json.dumps([spec_name, '#'.join([method, pattern])])
+            mapping[field] = dumps([index, content], 'compact')
+            if batch_size and len(mapping) >= batch_size:
+                self.client.hset(target, mapping=mapping)
+                written, mapping = True, {}
+        if mapping:
+            self.client.hset(target, mapping=mapping)
+            written = True
+
+        if replace:
+            if written:
+                self.client.rename(target, key)
+            else:
+                self.client.delete(key)
+        self.client.zadd(self.get_used_key(), {env: timezone.now().timestamp()})
+
+    def delete_env(self, env):
+        self.client.delete(self.get_key(env))
+        self.client.hdel(self.get_parents_key(), env)
+        self.client.zrem(self.get_used_key(), env)
+
+    def touch(self, envs, used_at):
+        # only envs that are saved already
+        timestamp = used_at.timestamp()
+        self.client.zadd(self.get_used_key(), {env: timestamp for env in envs}, xx=True)
+
+    def get_expired_envs(self, before, limit):
+        names = self.client.zrangebyscore(
+            self.get_used_key(), '-inf', '(%r' % before.timestamp(), start=0, num=limit + 1
+        )
+        return [name.decode('utf-8') for name in names if name][:limit]
+
+    def get_parent(self, env):
+        value = self.client.hget(self.get_parents_key(), env)
+        if value is None:
+            return None
+        return value.decode('utf-8')
+
+    def set_parent(self, env, parent):
+        self.client.zadd(self.get_used_key(), {env: timezone.now().timestamp()})
+        if parent is None:
+            self.client.hdel(self.get_parents_key(), env)
+            return
+        self.client.hset(self.get_parents_key(), env, parent)
+
+    def get_document(self, name):
+        value = self.client.hget(self.get_documents_key(), name)
+        if value is None:
+            return None
+        return value.decode('utf-8')
+
+    def set_document(self, name, value):
+        if not value:
+            self.client.hdel(self.get_documents_key(), name)
+            return
+        self.client.hset(self.get_documents_key(), name, value)
+
+    def get_document_names(self):
+        return [name.decode('utf-8') for name in self.client.hkeys(self.get_documents_key())]
+
+
+def get_redis_client(client=None, url=None):
+    if client is not None:
+        return client
+    if url:
+        import redis
+        return redis.Redis.from_url(url)
+    return FakeRedis()
+
+
+class FakeRedis:
+    """
+    In-process stand-in for the redis-py hash, sorted set and list commands
+    the stores use, keys and values come back as bytes like from a server
+    """
+    def __init__(self):
+        self.data = {}
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def encode(value):
+        if isinstance(value, bytes):
+            return value
+        return str(value).encode('utf-8')
+
+    def hgetall(self, key):
+        with self.lock:
+            return dict(self.data.get(self.encode(key), {}))
+
+    def hget(self, key, field):
+        with self.lock:
+            return self.data.get(self.encode(key), {}).get(self.encode(field))
+
+    def hkeys(self, key):
+        with self.lock:
+            return list(self.data.get(self.encode(key), {}))
+
+    def hset(self, key, field=None, value=None, mapping=None):
+        items = dict(mapping or {})
+        if field is not None:
+            items[field] = value
+        with self.lock:
+            values = self.data.setdefault(self.encode(key), {})
+            added = 0
+            for item_field, item_value in items.items():
+                item_field = self.encode(item_field)
+                added += item_field not in values
+                values[item_field] = self.encode(item_value)
+            return added
+
+    def hdel(self, key, *fields):
+        with self.lock:
+            values = self.data.get(self.encode(key), {})
+            removed = 0
+            for field in fields:
+                removed += values.pop(self.encode(field), None) is not None
+            if not values:
+                self.data.pop(self.encode(key), None)
+            return removed
+
+    def rename(self, src, dst):
+        with self.lock:
+            self.data[self.encode(dst)] = self.data.pop(self.encode(src))
+            return True
+
+    def delete(self, *keys):
+        with self.lock:
+            return sum(self.data.pop(self.encode(key), None) is not None for key in keys)
+
+    def zadd(self, key, mapping, xx=False):
+        with self.lock:
+            scores = self.data.setdefault(self.encode(key), {})
+            added = 0
+            for member, score in mapping.items():
+                member = self.encode(member)
+                if xx and member not in scores:
+                    continue
+                added += member not in scores
+                scores[member] = float(score)
+            if not scores:
+                self.data.pop(self.encode(key), None)
+            return added
+
+    def zrem(self, key, *members):
+        return self.hdel(key, *members)
+
+    @staticmethod
+    def parse_score(value):
+        value = str(value)
+        if value.startswith('('):
+            return float(value[1:]), True
+        return float(value), False
+
+    def zrangebyscore(self, key, min, max, start=None, num=None):
+        low, low_exclusive = self.parse_score(min)
+        high, high_exclusive = self.parse_score(max)
+        with self.lock:
+            scores = self.data.get(self.encode(key), {})
+            members = [
+                member for member, score in sorted(scores.items(), key=lambda item: (item[1], item[0]))
+                if (score > low if low_exclusive else score >= low)
+                and (score < high if high_exclusive else score <= high)
+            ]
+        if start is not None:
+            members = members[start:start + num]
+        return members
+
+    def get(self, key):
+        with self.lock:
+            return self.data.get(self.encode(key))
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[self.encode(key)] = self.encode(value)
+            return True
+
+    def incr(self, key, amount=1):
+        with self.lock:
+            value = int(self.data.get(self.encode(key), 0)) + amount
+            self.data[self.encode(key)] = self.encode(value)
+            return value
+
+    def lpush(self, key, *values):
+        with self.lock:
+            items = self.data.setdefault(self.encode(key), [])
+            for value in values:
+                items.insert(0, self.encode(value))
+            return len(items)
+
+    def ltrim(self, key, start, end):
+        with self.lock:
+            items = self.data.get(self.encode(key))
+            if items is not None:
+                items[:] = items[start:end + 1 or None]
+            return True
+
+    def lrange(self, key, start, end):
+        with self.lock:
+            return list(self.data.get(self.encode(key), [])[start:end + 1 or None])
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def transaction(self, func, *watches, value_from_callable=False):
+        # nothing else runs under the lock, the watched keys never change meanwhile
+        with self.lock:
+            pipeline = self.pipeline()
+            pipeline.watch(*watches)
+            value = func(pipeline)
+            result = pipeline.execute()
+        return value if value_from_callable else result
+
+
+class FakePipeline:
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+        self.buffered = True
+
+    def watch(self, *keys):
+        # commands run at once until multi() like on a watching redis-py pipeline
+        self.buffered = False
+
+    def multi(self):
+        self.buffered = True
+
+    def __getattr__(self, name):
+        method = getattr(self.client, name)
+        if not self.buffered:
+            return method
+
+        def command(*args, **kwargs):
+            self.commands.append((method, args, kwargs))
+            return self
+        return command
+
+    def execute(self):
+        # a MULTI/EXEC stand-in, run under the lock so no other command interleaves
+        commands, self.commands = self.commands, []
+        with self.client.lock:
+            return [method(*args, **kwargs) for method, args, kwargs in commands]
+
+
+preset_stores = {}
+preset_stores_lock = threading.Lock()
+
+
+def get_preset_store():
+    key = (su_settings.PRESET_STORE, repr(su_settings.PRESET_STORE_OPTIONS))
+    store = preset_stores.get(key)
+    if store is None:
+        with preset_stores_lock:
+            store = preset_stores.get(key)
+            if store is None:
+                store = import_string(su_settings.PRESET_STORE)(**(su_settings.PRESET_STORE_OPTIONS or {}))
+                preset_stores[key] = store
+    return store
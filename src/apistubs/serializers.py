@@ -0,0 +1,80 @@
+import json
+
+from functools import lru_cache
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse
+from django.utils.module_loading import import_string
+
+from apistubs import settings as su_settings
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+__all__ = (
+    'dumps',
+    'get_serializer',
+    'json_response',
+)
+
+
+JSON_STYLES = {
+    'pretty': True,
+    'compact': False,
+}
+
+
+def json_dumps(data, pretty=False):
+    if pretty:
+        content = json.dumps(data, indent=4, ensure_ascii=False, cls=DjangoJSONEncoder)
+    else:
+        content = json.dumps(data, separators=(',', ':'), ensure_ascii=False, cls=DjangoJSONEncoder)
+    return content.encode('utf-8')
+
+
+def orjson_dumps(data, pretty=False):
+    # orjson only knows indent=2, pretty output stays with the stdlib
+    if pretty:
+        return json_dumps(data, pretty)
+    try:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+    except TypeError:
+        # lazy spec sections, Decimal etc.
+        return json_dumps(data, pretty)
+
+
+SERIALIZERS = {
+    'json': json_dumps,
+    'orjson': orjson_dumps,
+}
+
+
+@lru_cache
+def load_serializer(name):
+    if name is None:
+        name = 'orjson' if orjson is not None else 'json'
+    if name in SERIALIZERS:
+        return SERIALIZERS[name]
+    return import_string(name)
+
+
+def get_serializer():
+    """
+    Callable `(data, pretty) -> bytes`, either one of SERIALIZERS
+    or a dotted path; by default orjson when it is installed
+    """
+    return load_serializer(su_settings.JSON_SERIALIZER)
+
+
+def dumps(data, style=None):
+    pretty = JSON_STYLES[style or su_settings.JSON_STYLE]
+    content = get_serializer()(data, pretty)
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    return content
+
+
+def json_response(data, style=None, content_type='application/json', **kwargs):
+    return HttpResponse(dumps(data, style), content_type=content_type, **kwargs)
@@ -1,10 +1,24 @@
-from parse import Parser
+from functools import lru_cache
+import re
+import threading
+
+from parse import Parser, PARSE_RE
 from urllib.parse import parse_qs
 
 from apistubs import settings as su_settings
-from apistubs.helpers import get_path, replace_host, load_apistubs_yaml
+from apistubs.helpers import (
+    get_path,
+    replace_host,
+    load_apistubs_yaml,
+    get_apistubs_yaml_generation,
+    LazyMapping,
+)
 
 __all__ = (
+    'RouteIndex',
+    'RegexRouteIndex',
+    'ParserRouteIndex',
+    'ExampleTable',
     'oas_find_path',
     'spec_point',
 )
@@ -29,11 +43,16 @@ class PathParameter:
 parse_path_parameter = PathParameter()
 
 
-def search(path_pattern, full_url_pattern) :
+@lru_cache(maxsize=4096)
+def get_parser(path_pattern):
     extra_types = {parse_path_parameter.name: parse_path_parameter}
     p = ExtendedParser(path_pattern, extra_types)
     p._expression = '^' + p._expression + '$'
-    return p.search(full_url_pattern)
+    return p
+
+
+def search(path_pattern, full_url_pattern) :
+    return get_parser(path_pattern).search(full_url_pattern)
 
 
 def params_match(request, params):
@@ -82,59 +101,376 @@ def select_path(paths, path, request=None):
     return result
 
 
-def oas_find_path(spec_name, path):
-    spec_file = spec_point.get_spec_file(spec_name)
-    spec = spec_point.get_data(spec_file)
-    spec_paths = spec.get('paths', {}).keys()
-    return select_path(spec_paths, path)
+class RouteNode:
+    __slots__ = ('literals', 'templates', 'routes')
 
+    def __init__(self):
+        self.literals = {}
+        self.templates = []
+        self.routes = []
 
-def response_from_spec(request, spec_name, pattern, requested_status, example_number):
-    spec_file = spec_point.get_spec_file(spec_name)
-    spec = spec_point.get_data(spec_file)
-    responses = get_path(spec, 'paths', pattern, request.method.lower(), 'responses')
-    if responses:
-        for status in sorted(responses.keys()):
-            if requested_status and int(status) != requested_status:
+
+def compile_segment(segment):
+    # same rules as ExtendedParser, but for a single path segment
+    names = []
+    expression = []
+    for part in PARSE_RE.split(segment):
+        if not part:
+            continue
+        elif part == '{{':
+            expression.append(r'\{')
+        elif part == '}}':
+            expression.append(r'\}')
+        elif part[0] == '{' and part[-1] == '}':
+            names.append(part[1:-1])
+            expression.append('(%s)' % PathParameter.pattern)
+        else:
+            expression.append(re.escape(part))
+    if not names:
+        return None, names
+    return re.compile(''.join(expression), re.IGNORECASE | re.DOTALL), names
+
+
+class RouteIndex:
+    """
+    Segment trie over path patterns.
+
+    Gives the same answer as `select_path`: the longest matching pattern plus
+    matching query params wins, the first declared pattern wins a tie.
+    Lookup walks the path segments, so it does not depend on the number of
+    patterns.
+    """
+    def __init__(self, paths=()):
+        self.root = RouteNode()
+        self.size = 0
+        for path_pattern in paths:
+            self.add(path_pattern)
+
+    def add(self, path_pattern):
+        params = path_pattern.split('?')
+        pattern = params[0]
+        params = params[1] if len(params) > 1 else None
+
+        node = self.root
+        for segment in pattern.split('/'):
+            regex, names = compile_segment(segment)
+            if regex is None:
+                node = node.literals.setdefault(segment.lower(), RouteNode())
+                continue
+            for template_regex, _, child in node.templates:
+                if template_regex.pattern == regex.pattern:
+                    node = child
+                    break
+            else:
+                child = RouteNode()
+                node.templates.append((regex, names, child))
+                node = child
+
+        node.routes.append((self.size, path_pattern, pattern, params))
+        self.size += 1
+
+    def walk(self, path):
+        segments = path.split('/')
+        lowered = path.lower().split('/')
+        depth = len(segments)
+        stack = [(self.root, 0, {})]
+        while stack:
+            node, index, variables = stack.pop()
+            if index == depth:
+                if node.routes:
+                    yield node, variables
                 continue
+            child = node.literals.get(lowered[index])
+            if child is not None:
+                stack.append((child, index + 1, variables))
+            for regex, names, child in node.templates:
+                match = regex.fullmatch(segments[index])
+                if match:
+                    values = variables.copy()
+                    values.update(zip(names, match.groups()))
+                    stack.append((child, index + 1, values))
+
+    def match(self, path, request=None):
+        best = None
+        for node, variables in self.walk(path):
+            for order, path_pattern, pattern, params in node.routes:
+                params_match_score = params_match(request, params)
+                if not params_match_score:
+                    continue
+                path_size = len(pattern) + params_match_score
+                if best is None or (path_size, -order) > (best[0], -best[1]):
+                    best = (path_size, order, path_pattern, variables)
+        if best is None:
+            return None
+        return best[2], best[3]
+
+    def find(self, path, request=None):
+        result = self.match(path, request=request)
+        if result is None:
+            return None
+        return result[0]
+
+
+class RegexRouteIndex:
+    """
+    All path templates compiled into one alternation regex.
+
+    Templates are ordered by specificity (longest first, then declaration
+    order), so the first alternative that matches is the winning pattern and
+    its named groups hold the path variables.
+    Query params can change the ranking between templates, so lookups with a
+    request against patterns that carry params go through `RouteIndex`.
+    """
+    def __init__(self, paths=()):
+        self.routes = {}
+        self.has_params = False
+        self.fallback = None
+        self.paths = list(paths)
+        for order, path_pattern in enumerate(self.paths):
+            params = path_pattern.split('?')
+            pattern = params[0]
+            params = params[1] if len(params) > 1 else None
+            if params is not None:
+                self.has_params = True
+            self.routes.setdefault(pattern, []).append((order, path_pattern, params))
+
+        templates = sorted(self.routes, key=lambda pattern: (-len(pattern), self.routes[pattern][0][0]))
+        self.templates = {}
+        expression = []
+        for index, pattern in enumerate(templates):
+            group = 'r%s' % index
+            names = []
+            parts = []
+            for part in PARSE_RE.split(pattern):
+                if not part:
+                    continue
+                elif part == '{{':
+                    parts.append(r'\{')
+                elif part == '}}':
+                    parts.append(r'\}')
+                elif part[0] == '{' and part[-1] == '}':
+                    parts.append('(?P<%s_%s>%s)' % (group, len(names), PathParameter.pattern))
+                    names.append(part[1:-1])
+                else:
+                    parts.append(re.escape(part))
+            expression.append('(?P<%s>%s)' % (group, ''.join(parts)))
+            self.templates[group] = (pattern, names)
+        self.regex = re.compile('(?:%s)' % '|'.join(expression), re.IGNORECASE | re.DOTALL)
+
+    def match(self, path, request=None):
+        if request is not None and self.has_params:
+            if self.fallback is None:
+                self.fallback = RouteIndex(self.paths)
+            return self.fallback.match(path, request=request)
+
+        match = self.regex.fullmatch(path)
+        if match is None:
+            return None
+        # the template group closes after its variables
+        group = match.lastgroup
+        pattern, names = self.templates[group]
+        variables = {
+            name: match.group('%s_%s' % (group, index))
+            for index, name in enumerate(names)
+        }
+        for order, path_pattern, params in self.routes[pattern]:
+            if params_match(request, params):
+                return path_pattern, variables
+        return None
+
+    def find(self, path, request=None):
+        result = self.match(path, request=request)
+        if result is None:
+            return None
+        return result[0]
+
+
+class ParserRouteIndex:
+    """
+    The plain `select_path` loop, kept as a baseline for benchmarks.
+    """
+    def __init__(self, paths=()):
+        self.paths = list(paths)
+
+    def match(self, path, request=None):
+        path_pattern = select_path(self.paths, path, request=request)
+        if path_pattern is None:
+            return None
+        result = search(path_pattern.split('?')[0], path)
+        return path_pattern, dict(result.named) if result else {}
+
+    def find(self, path, request=None):
+        return select_path(self.paths, path, request=request)
+
+
+ROUTE_INDEXES = {
+    'trie': RouteIndex,
+    'regex': RegexRouteIndex,
+    'parser': ParserRouteIndex,
+}
 
-            examples = get_path(responses, status, 'content',  'application/json', 'examples')
+
+def oas_find_path(spec_name, path):
+    return spec_point.get_route_index(spec_name).find(path)
+
+
+def resolve_ref(spec, node, depth=10):
+    # local references only, e.g. {"$ref": "#/components/examples/ok"}
+    while depth and isinstance(node, dict) and isinstance(node.get('$ref'), str):
+        ref = node['$ref']
+        if not ref.startswith('#/'):
+            break
+        node = get_path(spec, *[
+            part.replace('~1', '/').replace('~0', '~')
+            for part in ref[2:].split('/')
+        ])
+        depth -= 1
+    return node
+
+
+class ExampleTable:
+    """
+    Spec examples compiled once per loaded document.
+
+    Maps (pattern, method, status) to the operation's first response with
+    examples and keeps the examples both by name and by position, so
+    `response_from_spec` only has to pick one and fill in the Location host.
+    Lazily loaded specs are compiled pattern by pattern on first lookup.
+    """
+    def __init__(self, spec=None):
+        self.responses = {}
+        self.spec = spec or {}
+        self.paths = self.spec.get('paths') or {}
+        self.loaded = set()
+        self.lock = threading.Lock()
+        if not isinstance(self.paths, LazyMapping):
+            for pattern in self.paths:
+                self.load(pattern)
+
+    def load(self, pattern):
+        operations = self.paths.get(pattern)
+        if isinstance(operations, dict):
+            for method, operation in operations.items():
+                responses = get_path(operation, 'responses')
+                if isinstance(responses, dict):
+                    self.add(pattern, method, responses)
+        # last, a concurrent lookup of the pattern never sees it half compiled
+        self.loaded.add(pattern)
+
+    def add(self, pattern, method, responses):
+        for status in sorted(responses.keys(), key=str):
+            response = resolve_ref(self.spec, responses[status])
+            examples = get_path(response, 'content',  'application/json', 'examples')
             if not examples:
-                example = get_path(responses, status, 'content',  'application/json', 'example')
+                example = get_path(response, 'content',  'application/json', 'example')
                 if example is not None:
                     examples = {'default': {'value': example}}
+            if not examples:
+                continue
 
-            if examples:
-                headers = {}
-                if status == '202':
-                    location = get_path(responses, status, 'headers',  'Location', 'schema', 'example')
-                    if location:
-                        location = replace_host(location, request.get_host(), scheme=request.scheme)
-                        headers['Location'] = location
-
-                examples_keys = list(examples.keys())
-
-                if isinstance(example_number, int):
-                    if example_number + 1 > len(examples_keys):
-                        example_number = 1
-                    example = examples[examples_keys[example_number]]
-                elif example_number is None:
-                    example = list(examples.values())[0]
-                else:
-                    example = examples.get(example_number, {})
+            location = None
+            if status == '202':
+                location = get_path(response, 'headers',  'Location', 'schema', 'example')
+
+            contents = {}
+            for name, example in examples.items():
+                example = resolve_ref(self.spec, example)
+                contents[name] = example.get('value', {}) if isinstance(example, dict) else {}
+            entry = (status, contents, tuple(contents.values()), location)
+
+            try:
+                code = int(status)
+            except ValueError:
+                code = None
+            self.responses.setdefault((pattern, method, None), entry)
+            if code is not None:
+                self.responses.setdefault((pattern, method, code), entry)
+
+    def get(self, pattern, method, requested_status=None, example_number=None):
+        if pattern not in self.loaded:
+            with self.lock:
+                if pattern not in self.loaded:
+                    self.load(pattern)
+        entry = self.responses.get((pattern, method, requested_status or None))
+        if entry is None:
+            return None
+
+        status, contents, ordered, location = entry
+        if isinstance(example_number, int):
+            if example_number + 1 > len(ordered):
+                example_number = 1
+            content = ordered[example_number]
+        elif example_number is None:
+            content = ordered[0]
+        else:
+            content = contents.get(example_number, {})
+        return status, content, location
 
-                content = example.get('value', {})
-                return status, content, headers
+
+def response_from_spec(request, spec_name, pattern, requested_status, example_number):
+    example = spec_point.get_example_table(spec_name).get(
+        pattern, request.method.lower(), requested_status, example_number
+    )
+    if example is None:
+        return None
+
+    status, content, location = example
+    headers = {}
+    if location:
+        headers['Location'] = replace_host(location, request.get_host(), scheme=request.scheme)
+    return status, content, headers
 
 
 class Spec():
     def __init__(self):
         self.data = {}
+        self.route_indexes = {}
+        self.example_tables = {}
+
+    def is_lazy(self, spec_file):
+        lazy_specs = su_settings.LAZY_SPECS
+        if lazy_specs is True:
+            return True
+        return any(
+            self.get_spec_file(spec_key) == spec_file
+            for spec_key in lazy_specs or ()
+        )
 
     def get_data(self, spec_file):
         if spec_file is None:
             return {}
-        return load_apistubs_yaml(spec_file)
+        return load_apistubs_yaml(spec_file, lazy=self.is_lazy(spec_file))
+
+    def get_generation(self, spec_file):
+        if spec_file is None:
+            return None
+        return get_apistubs_yaml_generation(spec_file, lazy=self.is_lazy(spec_file))
+
+    def get_example_table(self, spec_key):
+        spec_file = self.get_spec_file(spec_key)
+        generation = self.get_generation(spec_file)
+        cached = self.example_tables.get(spec_file)
+        if cached is None or cached[0] != generation:
+            cached = (generation, ExampleTable(self.get_data(spec_file)))
+            if spec_file is not None:
+                self.example_tables[spec_file] = cached
+        return cached[1]
+
+    def get_matcher(self, spec_key):
+        return su_settings.SPEC_MATCHERS.get(spec_key, 'trie')
+
+    def get_route_index(self, spec_key):
+        spec_file = self.get_spec_file(spec_key)
+        matcher = self.get_matcher(spec_key)
+        generation = self.get_generation(spec_file)
+        key = (spec_file, matcher)
+        cached = self.route_indexes.get(key)
+        if cached is None or cached[0] != generation:
+            paths = self.get_data(spec_file).get('paths') or {}
+            cached = (generation, ROUTE_INDEXES[matcher](paths))
+            if spec_file is not None:
+                self.route_indexes[key] = cached
+        return cached[1]
 
     def get_spec_file(self, spec_key):
         spec = su_settings.SPEC_FILES.get(spec_key)
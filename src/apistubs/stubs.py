@@ -1,25 +1,46 @@
 import json
+import time
+from urllib.parse import parse_qs
 
-from django.core.cache import cache
+from django.core.cache import DEFAULT_CACHE_ALIAS, cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.utils import timezone
 
 from apistubs import settings as su_settings
 from apistubs.constants import METHODS
-from apistubs.helpers import parse_preset_response, load_apistubs_yaml
+from apistubs.helpers import (
+    parse_preset_response,
+    freeze,
+    load_apistubs_yaml,
+    get_apistubs_yaml_generation,
+    render_content,
+    FrozenDict,
+    FrozenList,
+    LRUCache,
+)
+from apistubs.payload import Payload
+from apistubs.presets import get_preset_store
 from apistubs.spec import (
+    RouteIndex,
     oas_find_path,
     select_path,
     response_from_spec,
+    spec_point,
 )
 
-if su_settings.DB_PRESET_ENABLED:
-    from apistubs.dbpreset.models import Mock
-
 __all__ = (
     'StubResponse',
     'YamlSettings',
     'HeadersSettings',
     'DBSettings',
     'ComboSettings',
+    'PresetSnapshot',
+    'Generation',
+    'EnvUsage',
+    'get_payload',
+    'get_env_chain',
+    'get_preset_snapshot',
     'get_stub_response',
 )
 
@@ -28,6 +49,7 @@ class Prompt:
     def __init__(self, value, env=False):
         self.value = value
         self.env = env
+        self.changed = False
 
     def use_alias(self, status_aliases):
         selected_alias = None
@@ -46,6 +68,7 @@ class Prompt:
         if selected_alias_count > 1 and self.env is not None:
             self.value.pop(selected_alias_index)
             self.set_value(self.env, ' '.join(self.value))
+            self.changed = True
 
         return selected_alias
 
@@ -62,6 +85,98 @@ class Prompt:
         return cache.delete('PROMPT' + env)
 
 
+class Generation:
+    """
+    Version of the DB presets of an env, bumped on every write.
+    Other workers only see a bump through a shared cache: counters of a
+    process-local one expire after DB_PRESET_LOCAL_TTL seconds instead
+    """
+    CACHE_KEY = 'GENERATION'
+    LOCAL_CACHES = (LocMemCache, DummyCache)
+
+    @classmethod
+    def get_timeout(cls):
+        if isinstance(caches[DEFAULT_CACHE_ALIAS], cls.LOCAL_CACHES):
+            return su_settings.DB_PRESET_LOCAL_TTL
+        return None
+
+    @classmethod
+    def get_value(cls, env):
+        key = cls.CACHE_KEY + env
+        value = cache.get(key)
+        if value is None:
+            # start from a new value, so an evicted or expired counter
+            # never matches a version cached by the workers before
+            cache.add(key, time.time_ns(), timeout=cls.get_timeout())
+            value = cache.get(key, 0)
+        return value
+
+    @classmethod
+    def bump(cls, env):
+        key = cls.CACHE_KEY + env
+        cache.add(key, time.time_ns(), timeout=cls.get_timeout())
+        try:
+            return cache.incr(key)
+        except ValueError:
+            # evicted between add and incr
+            value = time.time_ns()
+            cache.set(key, value, timeout=cls.get_timeout())
+            return value
+
+
+class EnvUsage:
+    """
+    Last use of the saved envs for the ENV_TTL sweeper, written at most once
+    per ENV_TOUCH_INTERVAL: per worker by `touched`, across workers by the cache key
+    """
+    CACHE_KEY = 'USED'
+    touched = LRUCache(su_settings.DB_PRESET_CACHE_SIZE)
+
+    @classmethod
+    def touch(cls, env):
+        interval = su_settings.ENV_TOUCH_INTERVAL
+        now = time.monotonic()
+        touched_at = cls.touched.get(env)
+        if touched_at is not None and now - touched_at < interval:
+            return False
+        cls.touched.set(env, now)
+        if interval and not cache.add(cls.CACHE_KEY + env, 1, timeout=interval):
+            return False
+        cls.touch_chain(env)
+        return True
+
+    @classmethod
+    def touch_chain(cls, env):
+        # the parents are in use as long as the children are
+        envs = [chain_env for chain_env, _ in get_env_chain(env)]
+        get_preset_store().touch(envs, timezone.now())
+
+    @classmethod
+    def delete_value(cls, env):
+        cls.touched.pop(env)
+        return cache.delete(cls.CACHE_KEY + env)
+
+
+# (content, Payload) by the content object: presets (split_headers keeps their
+# content object) and examples are shared frozen values, so a body is encoded
+# once per preset version and not per URL
+payloads = LRUCache(su_settings.RESOLUTION_CACHE_SIZE or 1024)
+
+
+def get_payload(content):
+    if isinstance(content, (dict, list)) and not isinstance(content, (FrozenDict, FrozenList)):
+        # built for the request, nothing else shares it
+        return Payload.from_content(content)
+    key = (su_settings.revision, id(content))
+    cached = payloads.get(key)
+    # the entry holds the content, so its id is not reused while it is cached
+    if cached is not None and cached[0] is content:
+        return cached[1]
+    payload = Payload.from_content(content)
+    payloads.set(key, (content, payload))
+    return payload
+
+
 class StubResponse:
     def __init__(
         self, status=200, content={}, headers=None, db_id=None, pattern=None, prompt=None
@@ -75,6 +190,24 @@ class StubResponse:
         self._db_id = db_id
         self.pattern = pattern
         self.prompt = prompt
+        self._payload = None
+
+    @property
+    def payload(self):
+        # shared by every response with the same content
+        if self._payload is None:
+            self._payload = get_payload(self.content)
+        return self._payload
+
+    def render(self, request):
+        """
+        Payload for the request, bodies with templates are rendered
+        per request when TEMPLATE_BODIES is on
+        """
+        payload = self.payload
+        if su_settings.TEMPLATE_BODIES and payload.is_template:
+            payload = Payload.from_content(render_content(self.content, request))
+        return payload
 
 
 class BaseSettingsSource:
@@ -149,11 +282,69 @@ class HeadersSettings(BaseSettingsSource):
         return StubResponse(status=int(status), content=content, headers=headers)
 
 
+MAX_ENV_DEPTH = 16
+
+# (generation, parent) by env
+env_parents = LRUCache(su_settings.DB_PRESET_CACHE_SIZE)
+
+
+def get_env_parent(env, generation):
+    cached = env_parents.get(env)
+    if cached is not None and cached[0] == generation:
+        return cached[1]
+    parent = get_preset_store().get_parent(env)
+    env_parents.set(env, (generation, parent))
+    return parent
+
+
+def get_env_chain(env):
+    """
+    ((env, generation), (parent, generation), ...) up to the env on the YAML baseline,
+    a parent is set with the env generation bumped so the chain is read level by level
+    """
+    chain = []
+    seen = set()
+    while env is not None and env not in seen and len(chain) < MAX_ENV_DEPTH:
+        seen.add(env)
+        generation = Generation.get_value(env)
+        chain.append((env, generation))
+        env = get_env_parent(env, generation)
+    return tuple(chain)
+
+
 class DBSettings(BaseSettingsSource):
+    # (chain, values) by (env, spec_name), reused until a Generation of the env chain changes
+    presets = LRUCache(su_settings.DB_PRESET_CACHE_SIZE)
+    # (generation, values) of an env alone, a parent is read once for all of its children
+    own_presets = LRUCache(su_settings.DB_PRESET_CACHE_SIZE)
+
     def load(self):
-        values = {}
-        for response in Mock.objects.order_by('index').filter(spec_name=self.spec_name, env=self.env):
-            values['#'.join([response.method, response.pattern])] = response.get_content()
+        key = (self.env, self.spec_name)
+        # read before the query, so a concurrent write is never missed
+        chain = get_env_chain(self.env)
+        cached = self.presets.get(key)
+        if cached is not None and cached[0] == chain:
+            return cached[1]
+
+        if len(chain) == 1:
+            values = self.load_own(*chain[0])
+        else:
+            # own overrides first, then what is left of every parent
+            values = {}
+            for env, generation in chain:
+                for preset_key, value in self.load_own(env, generation).items():
+                    values.setdefault(preset_key, value)
+            values = freeze(values)
+        self.presets.set(key, (chain, values))
+        return values
+
+    def load_own(self, env, generation):
+        key = (env, self.spec_name)
+        cached = self.own_presets.get(key)
+        if cached is not None and cached[0] == generation:
+            return cached[1]
+        values = freeze(get_preset_store().get(env, self.spec_name))
+        self.own_presets.set(key, (generation, values))
         return values
 
 
@@ -171,7 +362,6 @@ class CookiesSettings(BaseSettingsSource):
             for method in METHODS:
                 if cookie_name.startswith('%s#' % method):
                     paths[cookie_name] = self.request.COOKIES[cookie_name]
-                    paths.append(cookie_name.split('#')[-1])
 
         prompt = self.request.COOKIES.get('STUBS_PROMPT')
         if prompt:
@@ -182,6 +372,62 @@ class CookiesSettings(BaseSettingsSource):
         return paths
 
 
+class PresetSnapshot:
+    """
+    STUBS_CONFIG presets of a spec merged once per config generations:
+    the pattern list, a lookup by `method#path`/`method#pattern` and the prompt
+    """
+    def __init__(self, spec_name, stubs_configs):
+        self.patterns = []
+        self.presets = {}
+        self.prompt = None
+        for order, stubs_config in enumerate(stubs_configs):
+            source = YamlSettings(spec_name, path=stubs_config)
+            self.patterns += source.patterns
+            for key, value in source.values.items():
+                # the first config with the key wins
+                self.presets.setdefault(key, (order, value))
+            if self.prompt is None and source.prompt:
+                self.prompt = source.prompt
+        self.route_index = RouteIndex(self.patterns)
+
+    def get(self, method, pattern, path):
+        # configs are probed in order, the path before the pattern of each one
+        by_path = self.presets.get('#'.join([method, path]))
+        by_pattern = self.presets.get('#'.join([method, pattern]))
+        if by_pattern is not None and (by_path is None or by_pattern[0] < by_path[0]):
+            return by_pattern[1]
+        if by_path is not None:
+            return by_path[1]
+
+
+preset_snapshots = LRUCache(64)
+
+
+def get_stubs_configs():
+    stubs_configs = su_settings.STUBS_CONFIG
+    if not isinstance(stubs_configs, list):
+        stubs_configs = [stubs_configs]
+    return stubs_configs
+
+
+def get_preset_snapshot(spec_name):
+    stubs_configs = get_stubs_configs()
+    key = (
+        su_settings.revision,
+        spec_name,
+        tuple(
+            (stubs_config, stubs_config and get_apistubs_yaml_generation(stubs_config))
+            for stubs_config in stubs_configs
+        ),
+    )
+    snapshot = preset_snapshots.get(key)
+    if snapshot is None:
+        snapshot = PresetSnapshot(spec_name, stubs_configs)
+        preset_snapshots.set(key, snapshot)
+    return snapshot
+
+
 class ComboSettings:
     def __init__(self, spec_name, request, env=''):
         self.request = request
@@ -189,17 +435,10 @@ class ComboSettings:
         self.use_db = su_settings.DB_PRESET_ENABLED
         self.prompt = None
 
-        stubs_configs = su_settings.STUBS_CONFIG
-        if not isinstance(stubs_configs, list):
-            stubs_configs = [stubs_configs]
-        self.yamls = [
-            YamlSettings(spec_name, path=stubs_config)
-            for stubs_config in stubs_configs
-        ]
-        for item in self.yamls:
-            if item.prompt:
-                self.prompt = Prompt(item.prompt)
-                break
+        self.snapshot = get_preset_snapshot(spec_name)
+        if self.snapshot.prompt:
+            # use_alias consumes words, the snapshot is shared
+            self.prompt = Prompt(list(self.snapshot.prompt))
 
         self.headers = HeadersSettings(request)
         self.cookies = CookiesSettings(request, env=env)
@@ -210,45 +449,152 @@ class ComboSettings:
             self.db = DBSettings(spec_name, env=env)
 
     @property
-    def patterns(self):
+    def overlay_patterns(self):
         pattens = []
         if self.use_db:
             pattens += self.db.patterns
-
         pattens += self.cookies.patterns
-        for source in self.yamls:
-            pattens += source.patterns
-
         return pattens
 
+    @property
+    def patterns(self):
+        return self.overlay_patterns + self.snapshot.patterns
+
+    def select_path(self, path):
+        pattern = self.snapshot.route_index.find(path, request=self.request)
+        overlay_patterns = self.overlay_patterns
+        if not overlay_patterns:
+            return pattern
+        # overlays come first, so they keep winning ties as in `patterns`
+        candidates = [select_path(overlay_patterns, path, request=self.request), pattern]
+        return select_path([item for item in candidates if item], path, request=self.request)
+
     def get_preset_response(self, pattern, path):
+        method = self.request.method.lower()
         sources = []
         if self.use_db:
             sources.append(self.db.values)
         sources.append(self.cookies.values)
 
-        for source in self.yamls:
-            sources.append(source.values)
-
         for source in sources:
-            mp = '#'.join([self.request.method.lower(), path])
+            mp = '#'.join([method, path])
             if mp in source:
                 return source[mp]
-            mp = '#'.join([self.request.method.lower(), pattern])
+            mp = '#'.join([method, pattern])
             if mp in source:
                 return source[mp]
 
+        return self.snapshot.get(method, pattern, path)
+
+
+resolution_cache = LRUCache(su_settings.RESOLUTION_CACHE_SIZE)
+MISSING = object()
+
+
+def get_resolution_scope(spec_name, request, env=''):
+    """
+    Everything except the request itself that a resolved stub depends on.
+    Returns None when the request carries its own presets or prompt.
+    """
+    for cookie_name in request.COOKIES:
+        if cookie_name == 'STUBS_PROMPT' or cookie_name.split('#')[0] in METHODS:
+            return None
+
+    stubs_configs = get_stubs_configs()
+
+    spec_file = spec_point.get_spec_file(spec_name)
+    return (
+        su_settings.revision,
+        spec_name,
+        env,
+        spec_point.get_generation(spec_file),
+        tuple(
+            stubs_config and get_apistubs_yaml_generation(stubs_config)
+            for stubs_config in stubs_configs
+        ),
+        su_settings.DB_PRESET_ENABLED and get_env_chain(env),
+        Prompt.get_value(env),
+    )
+
+
+def get_resolution_key(scope, param_names, request, path, explicit):
+    data_names, header_names = param_names
+    return scope + (
+        request.method,
+        path,
+        explicit,
+        request.scheme,
+        # what get_host() reads, it raises DisallowedHost outside ALLOWED_HOSTS
+        request.META.get('HTTP_X_FORWARDED_HOST'),
+        request.META.get('HTTP_HOST'),
+        request.META.get('SERVER_NAME'),
+        request.META.get('SERVER_PORT'),
+        request.META.get('QUERY_STRING', ''),
+        data_names and tuple(request.POST.get(name) for name in data_names),
+        header_names and tuple(request.headers.get(name) for name in header_names),
+    )
+
+
+def get_param_names(patterns):
+    # request data and headers referenced by `?DATA.x=...&HEADER.y=...` patterns
+    data_names = set()
+    header_names = set()
+    for pattern in patterns:
+        params = pattern.split('?')
+        if len(params) < 2:
+            continue
+        for key in parse_qs(params[1]):
+            if key.startswith('DATA.'):
+                data_names.add(key[len('DATA.'):])
+            elif key.startswith('HEADER.'):
+                header_names.add(key[len('HEADER.'):])
+    return tuple(sorted(data_names)), tuple(sorted(header_names))
+
 
 def get_stub_response(spec_name, request, path, explicit=False, env=''):
-    settings = ComboSettings(spec_name, request, env=env)
+    if su_settings.DB_PRESET_ENABLED and su_settings.ENV_TTL:
+        EnvUsage.touch(env)
 
-    response = settings.headers.response
+    response = HeadersSettings(request).response
     if response:
         return response
 
+    scope = None
+    if su_settings.RESOLUTION_CACHE_SIZE:
+        scope = get_resolution_scope(spec_name, request, env=env)
+
+    if scope is not None:
+        param_names = resolution_cache.get(scope, MISSING)
+        if param_names is not MISSING:
+            response = resolution_cache.get(
+                get_resolution_key(scope, param_names, request, path, explicit),
+                MISSING
+            )
+            if response is not MISSING:
+                return response
+
+    settings = ComboSettings(spec_name, request, env=env)
+    response = resolve_stub_response(settings, spec_name, request, path, explicit=explicit)
+
+    # a consumed prompt alias changes the next answer
+    if scope is not None and not (settings.prompt and settings.prompt.changed):
+        param_names = get_param_names(settings.patterns)
+        if response is not None:
+            # shared by every request of the key
+            response.headers = freeze(response.headers)
+        resolution_cache.set(scope, param_names)
+        resolution_cache.set(
+            get_resolution_key(scope, param_names, request, path, explicit),
+            response
+        )
+
+    return response
+
+
+def resolve_stub_response(settings, spec_name, request, path, explicit=False):
     pattern = oas_find_path(spec_name, path)
     if not pattern:
-        pattern = select_path(settings.patterns, path, request=request)
+        pattern = settings.select_path(path)
 
     if not pattern:
         return
@@ -0,0 +1,82 @@
+import logging
+import threading
+import time
+
+from datetime import timedelta
+
+from django.utils import timezone
+
+from apistubs import settings as su_settings
+from apistubs.logging import RequestLog
+from apistubs.presets import get_preset_store
+from apistubs.stubs import EnvUsage, Generation, Prompt
+
+__all__ = (
+    'sweep_envs',
+    'start_sweeper',
+)
+
+logger = logging.getLogger('apistubs')
+
+
+def delete_env(env):
+    get_preset_store().delete_env(env)
+    Prompt.delete_value(env)
+    RequestLog.delete(env)
+    EnvUsage.delete_value(env)
+    # workers drop what they cached for the env
+    Generation.bump(env)
+
+
+def sweep_envs(ttl=None, batch_size=None, limit=None):
+    """
+    Deletes the saved envs not used for `ttl` seconds (ENV_TTL) with their
+    presets, prompt and request log, `batch_size` envs at a time.
+    Returns the deleted envs.
+    """
+    ttl = ttl or su_settings.ENV_TTL
+    batch_size = batch_size or su_settings.ENV_SWEEP_BATCH_SIZE
+    if not ttl:
+        return []
+
+    store = get_preset_store()
+    before = timezone.now() - timedelta(seconds=ttl)
+    deleted = []
+    while limit is None or len(deleted) < limit:
+        size = batch_size if limit is None else min(batch_size, limit - len(deleted))
+        envs = store.get_expired_envs(before, size)
+        for env in envs:
+            delete_env(env)
+            logger.info('apistubs sweep: %s', env)
+        deleted += envs
+        if len(envs) < size:
+            break
+    return deleted
+
+
+sweeper = None
+sweeper_lock = threading.Lock()
+
+
+def run_sweeper(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            sweep_envs()
+        except Exception:
+            logger.exception('apistubs sweep failed')
+
+
+def start_sweeper():
+    """
+    Sweeps every ENV_SWEEP_INTERVAL seconds in a daemon thread of the process
+    """
+    global sweeper
+    with sweeper_lock:
+        if sweeper is None:
+            sweeper = threading.Thread(
+                target=run_sweeper, args=(su_settings.ENV_SWEEP_INTERVAL,),
+                name='apistubs-sweeper', daemon=True
+            )
+            sweeper.start()
+    return sweeper
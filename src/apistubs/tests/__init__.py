@@ -3,4 +3,11 @@ from .test_views_settings import *
 from .test_helpers import *
 from .test_views_prompt import *
 from .test_views_specification import *
+from .test_spec import *
 
+from .test_stubs import *
+from .test_serializers import *
+from .test_presets import *
+from .test_sweep import *
+from .test_logging import *
+from .test_views_logging import *
@@ -1,15 +1,38 @@
+import os
 import yaml
 import json
-from django.test import SimpleTestCase, TestCase, override_settings
+import pickle
+import tempfile
+import time
+
+from jinja2.exceptions import SecurityError
+
+from mock import MagicMock, patch
+
+from django.test import SimpleTestCase, TestCase, RequestFactory, override_settings
 from django.urls import reverse
 
+from apistubs import settings as su_settings
 from apistubs import urls
-from apistubs.helpers import parse_preset_response
+from apistubs.helpers import (
+    parse_preset_response,
+    read_apistubs_yaml,
+    FileWatcher,
+    freeze,
+    replace_path,
+    render_params,
+    render_content,
+    templates,
+)
 from apistubs.stubs import Prompt
 
 __all__ = (
     'ParsePresetResponseTests',
     'PromptTests',
+    'DiskCacheTests',
+    'FileWatcherTests',
+    'FreezeTests',
+    'RenderTests',
 )
 
 
@@ -57,6 +80,125 @@ class ParsePresetResponseTests(SimpleTestCase):
         )
 
 
+class DiskCacheTests(SimpleTestCase):
+    def test_ok(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            path = os.path.join(cache_dir, 'tests.stubs.yaml')
+            with open(path, 'w') as f:
+                f.write(APISTUBS)
+
+            with su_settings.override(APISTUBS_CACHE_DIR=os.path.join(cache_dir, 'cache')):
+                data = read_apistubs_yaml(path)
+                self.assertEqual(data, yaml.safe_load(APISTUBS.replace('apistubs: 1.0.0', '')))
+                self.assertEqual(len(os.listdir(su_settings.CACHE_DIR)), 1)
+
+                with patch('apistubs.helpers.parse_apistubs_yaml') as parse:
+                    self.assertEqual(read_apistubs_yaml(path), data)
+                    # touched, same content
+                    os.utime(path, ns=(0, 0))
+                    self.assertEqual(read_apistubs_yaml(path), data)
+                    parse.assert_not_called()
+
+                with open(path, 'a') as f:
+                    f.write('other: {}\n')
+                self.assertEqual(read_apistubs_yaml(path)['other'], {})
+
+    def test_invalid(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            path = os.path.join(cache_dir, 'tests.stubs.yaml')
+            with open(path, 'w') as f:
+                f.write(APISTUBS)
+
+            with su_settings.override(APISTUBS_CACHE_DIR=os.path.join(cache_dir, 'cache')):
+                data = read_apistubs_yaml(path)
+                cache_path = os.path.join(su_settings.CACHE_DIR, os.listdir(su_settings.CACHE_DIR)[0])
+                # a class gone in this version, then a pickle of another shape
+                for content in (b'\x80\x04\x95\x0e\x00\x00\x00\x00\x00\x00\x00\x8c\x07missing\x94\x8c\x01X\x94\x93\x94.',
+                                pickle.dumps(['data'])):
+                    with open(cache_path, 'wb') as f:
+                        f.write(content)
+                    self.assertEqual(read_apistubs_yaml(path), data)
+
+
+class FileWatcherTests(SimpleTestCase):
+    def test_check_interval(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'tests.stubs.yaml')
+            with open(path, 'w') as f:
+                f.write('account: {}\n')
+
+            watcher = FileWatcher()
+            with su_settings.override(APISTUBS_CHECK_INTERVAL=60):
+                entry = watcher.load(path)
+                self.assertEqual(entry.data, {'account': {}})
+
+                with open(path, 'w') as f:
+                    f.write('other: {}\n')
+                os.utime(path, ns=(0, 0))
+                self.assertIs(watcher.load(path), entry)
+
+                watcher.invalidate(path)
+                reloaded = watcher.load(path)
+                self.assertEqual(reloaded.data, {'other': {}})
+                self.assertGreater(reloaded.generation, entry.generation)
+
+    def test_watcher_died(self):
+        inotify = MagicMock()
+        inotify.read.side_effect = OSError('closed')
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'tests.stubs.yaml')
+            with open(path, 'w') as f:
+                f.write('account: {}\n')
+
+            watcher = FileWatcher()
+            with patch('apistubs.helpers.INotify', return_value=inotify), \
+                    patch('apistubs.helpers.inotify_flags', MagicMock(), create=True), \
+                    patch('apistubs.helpers.logger') as logger, \
+                    su_settings.override(APISTUBS_WATCH_FILES=True, APISTUBS_CHECK_INTERVAL=0):
+                entry = watcher.load(path)
+                self.wait_stopped(watcher)
+                inotify.close.assert_called_once_with()
+                logger.warning.assert_called_once()
+                # stat'ed again instead of trusting the dead watcher
+                self.assertFalse(watcher.is_fresh(entry, time.monotonic()))
+
+                with open(path, 'w') as f:
+                    f.write('other: {}\n')
+                os.utime(path, ns=(1, 1))
+                self.assertEqual(watcher.load(path).data, {'other': {}})
+                # the load started another watcher
+                self.wait_stopped(watcher)
+
+    def wait_stopped(self, watcher):
+        deadline = time.monotonic() + 5
+        while watcher.inotify is not None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertIsNone(watcher.inotify)
+
+
+class FreezeTests(SimpleTestCase):
+    def test_read_only(self):
+        data = freeze({'servers': [{'url': 'http://a/'}], 'paths': {'/': {}}})
+        with self.assertRaises(TypeError):
+            data['servers'][0]['url'] = 'http://b/'
+        with self.assertRaises(TypeError):
+            data['servers'].append({})
+        with self.assertRaises(TypeError):
+            data.pop('paths')
+
+        self.assertEqual(json.loads(json.dumps(data)), data)
+        self.assertEqual(yaml.safe_load(yaml.safe_dump(data)), data)
+        with self.assertRaises(TypeError):
+            pickle.loads(pickle.dumps(data))['paths']['/'] = {}
+
+    def test_replace_path(self):
+        data = freeze({'servers': [{'url': 'http://a/'}], 'paths': {'/': {}}})
+        overlay = replace_path(data, {'url': 'http://b/'}, 'servers', 0)
+        self.assertEqual(overlay['servers'], [{'url': 'http://b/'}])
+        self.assertEqual(data['servers'], [{'url': 'http://a/'}])
+        self.assertIs(overlay['paths'], data['paths'])
+
+
 @override_settings(ROOT_URLCONF=urls, PROJECT=PROJECT)
 class PromptTests(TestCase):
     def test_ok(self):
@@ -159,3 +301,25 @@ class PromptTests(TestCase):
 
     def test_full_flow_env(self):
         self._test_full_flow(env_url=True)
+
+
+class RenderTests(SimpleTestCase):
+    def test_render_params(self):
+        request = RequestFactory().get('/?name=one')
+        self.assertEqual(render_params('plain', request), 'plain')
+        self.assertEqual(render_params('{{ name }}-{{ missing }}', request), 'one-')
+        self.assertIsNotNone(templates.get('{{ name }}-{{ missing }}'))
+
+        request = RequestFactory().get('/?name=two')
+        self.assertEqual(render_params('{{ name }}-{{ missing }}', request), 'two-')
+
+    def test_render_content(self):
+        request = RequestFactory().post('/', data={'id': '7'})
+        content = {'items': [{'id': '{{ id }}', 'count': 1}], 'name': None}
+        self.assertEqual(render_content(content, request), {'items': [{'id': '7', 'count': 1}], 'name': None})
+        self.assertEqual(content['items'][0]['id'], '{{ id }}')
+
+    def test_sandboxed(self):
+        request = RequestFactory().get('/')
+        with self.assertRaises(SecurityError):
+            render_params('{{ "".__class__.__mro__ }}', request)
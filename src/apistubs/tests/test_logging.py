@@ -0,0 +1,216 @@
+import threading
+
+from django.core.cache import cache
+from django.test import TestCase
+
+from apistubs import settings as su_settings
+from apistubs.logging import (
+    RequestLog,
+    CacheLogBuffer,
+    LocalLogBuffer,
+    RedisLogBuffer,
+    DBLogBuffer,
+    LogWriter,
+    get_log_buffer,
+    get_log_writer,
+)
+from apistubs.presets import FakeRedis
+
+__all__ = (
+    'CacheLogBufferTests',
+    'LocalLogBufferTests',
+    'RedisLogBufferTests',
+    'DBLogBufferTests',
+    'RequestLogTests',
+    'LogWriterTests',
+)
+
+
+class LogBufferTestsMixin:
+    def get_buffer(self):
+        raise NotImplementedError
+
+    def setUp(self):
+        cache.clear()
+        self.buffer = self.get_buffer()
+
+    def test_ring(self):
+        sequences = [self.buffer.append('test', {'n': n}, 3) for n in range(5)]
+        self.assertEqual(sequences, sorted(sequences))
+        self.assertEqual(len(set(sequences)), 5)
+        entries = self.buffer.entries('test', 3)
+        self.assertEqual([item for _, item in entries], [{'n': 4}, {'n': 3}, {'n': 2}])
+        self.assertEqual([sequence for sequence, _ in entries], sequences[:1:-1])
+        self.assertEqual(self.buffer.entries('other', 3), [])
+
+    def test_extend(self):
+        first = self.buffer.append('test', {'n': 0}, 3)
+        last = self.buffer.extend('test', [{'n': n} for n in range(1, 5)], 3)
+        entries = self.buffer.entries('test', 3)
+        self.assertEqual([item for _, item in entries], [{'n': 4}, {'n': 3}, {'n': 2}])
+        self.assertEqual(entries[0][0], last)
+        self.assertGreater(entries[2][0], first)
+
+    def test_clear(self):
+        first = self.buffer.append('test', {'n': 1}, 3)
+        self.buffer.clear('test')
+        self.assertEqual(self.buffer.entries('test', 3), [])
+        second = self.buffer.append('test', {'n': 2}, 3)
+        self.assertGreater(second, first)
+        self.assertEqual(self.buffer.entries('test', 3), [(second, {'n': 2})])
+
+    def test_delete(self):
+        self.buffer.append('test', {'n': 1}, 3)
+        self.buffer.append('other', {'n': 1}, 3)
+        self.buffer.delete('test', 3)
+        self.assertEqual(self.buffer.entries('test', 3), [])
+        self.assertEqual(len(self.buffer.entries('other', 3)), 1)
+        sequence = self.buffer.append('test', {'n': 2}, 3)
+        self.assertEqual(self.buffer.entries('test', 3), [(sequence, {'n': 2})])
+
+    def test_concurrent(self):
+        def append(thread):
+            for n in range(25):
+                self.buffer.append('test', {'thread': thread, 'n': n}, 1000)
+
+        threads = [threading.Thread(target=append, args=(thread,)) for thread in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.buffer.entries('test', 1000)), 100)
+
+
+class CacheLogBufferTests(LogBufferTestsMixin, TestCase):
+    def get_buffer(self):
+        return CacheLogBuffer()
+
+    def test_evicted(self):
+        first = self.buffer.append('test', {'n': 1}, 3)
+        cache.delete(self.buffer.get_key('test', 'seq'))
+        second = self.buffer.append('test', {'n': 2}, 3)
+        self.assertGreater(second, first)
+        self.assertEqual(self.buffer.entries('test', 3), [(second, {'n': 2})])
+
+    def test_pending(self):
+        first = self.buffer.append('test', {'n': 1}, 5)
+        # taken by a writer that has not stored its item yet
+        pending = self.buffer.next_sequence('test')
+        third = self.buffer.append('test', {'n': 3}, 5)
+        self.assertEqual(self.buffer.entries('test', 5), [(first, {'n': 1})])
+        self.assertEqual(self.buffer.entries('test', 5, since=first), [])
+
+        cache.set(self.buffer.get_key('test', pending % 5), (pending, {'n': 2}, 0))
+        self.assertEqual(self.buffer.entries('test', 5, since=first), [(third, {'n': 3}), (pending, {'n': 2})])
+
+    def test_lost(self):
+        first = self.buffer.append('test', {'n': 1}, 5)
+        self.buffer.next_sequence('test')
+        second = self.buffer.append('test', {'n': 2}, 5)
+        self.buffer.PENDING_TIMEOUT = -1
+        self.assertEqual(self.buffer.entries('test', 5, since=first), [(second, {'n': 2})])
+
+
+class LocalLogBufferTests(LogBufferTestsMixin, TestCase):
+    def get_buffer(self):
+        return LocalLogBuffer()
+
+
+class RedisLogBufferTests(LogBufferTestsMixin, TestCase):
+    def get_buffer(self):
+        return RedisLogBuffer(client=FakeRedis())
+
+
+class DBLogBufferTests(LogBufferTestsMixin, TestCase):
+    def get_buffer(self):
+        return DBLogBuffer()
+
+    def setUp(self):
+        if not su_settings.DB_PRESET_ENABLED:
+            self.skipTest('DB presets are disabled')
+        super().setUp()
+
+    def test_concurrent(self):
+        self.skipTest('the test database is not shared with other threads')
+
+
+class RequestLogTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_capacity(self):
+        with su_settings.override(APISTUBS_REQUEST_LOG_SIZE=2, APISTUBS_REQUEST_LOG_ENV_SIZES={'ci-*': 4}):
+            for n in range(5):
+                RequestLog.add({'n': n}, 'test')
+                RequestLog.add({'n': n}, 'ci-1')
+            self.assertEqual(RequestLog.get('test'), [{'n': 4}, {'n': 3}])
+            self.assertEqual(len(RequestLog.get('ci-1')), 4)
+            RequestLog.clear('ci-1')
+            self.assertEqual(RequestLog.get('ci-1'), [])
+
+    def test_buffer(self):
+        with su_settings.override(APISTUBS_REQUEST_LOG_BUFFER='apistubs.logging.LocalLogBuffer'):
+            self.assertIsInstance(get_log_buffer(), LocalLogBuffer)
+            self.assertIs(get_log_buffer(), get_log_buffer())
+        self.assertIsInstance(get_log_buffer(), CacheLogBuffer)
+
+
+class LogWriterTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def add(self, writer, n, env='test'):
+        return writer.put((RequestLog.build_not_specified, env, dict(
+            service='account', method='GET', path='/%s/' % n, data={}, headers={}, params={}, body=b'{"n": %d}' % n,
+        )))
+
+    def get_paths(self, env='test'):
+        return [item['request']['path'] for item in RequestLog.get(env)]
+
+    def test_batches(self):
+        writer = LogWriter(size=10, batch_size=3)
+        for n in range(5):
+            self.add(writer, n)
+        self.add(writer, 5, env='other')
+        with su_settings.override(APISTUBS_PRINT_INFO=False):
+            self.assertEqual(writer.flush(3), 3)
+            self.assertEqual(self.get_paths(), ['/2/', '/1/', '/0/'])
+            self.assertEqual(writer.flush(), 3)
+        self.assertEqual(self.get_paths(), ['/4/', '/3/', '/2/', '/1/', '/0/'])
+        self.assertEqual(self.get_paths('other'), ['/5/'])
+        self.assertEqual(RequestLog.get('test')[0]['request']['body'], {'n': 4})
+
+    def test_drop_newest(self):
+        writer = LogWriter(size=2)
+        self.assertEqual([self.add(writer, n) for n in range(4)], [True, True, False, False])
+        self.assertEqual(writer.dropped, 2)
+        with su_settings.override(APISTUBS_PRINT_INFO=False):
+            writer.flush()
+        self.assertEqual(self.get_paths(), ['/1/', '/0/'])
+
+    def test_drop_oldest(self):
+        writer = LogWriter(size=2, drop_policy='oldest')
+        for n in range(4):
+            self.add(writer, n)
+        self.assertEqual(writer.dropped, 2)
+        with su_settings.override(APISTUBS_PRINT_INFO=False):
+            writer.flush()
+        self.assertEqual(self.get_paths(), ['/3/', '/2/'])
+
+    def test_thread(self):
+        writer = LogWriter(size=100, batch_size=10, interval=0.01)
+        writer.start()
+        with su_settings.override(APISTUBS_PRINT_INFO=False):
+            for n in range(25):
+                self.add(writer, n)
+            writer.stop()
+        self.assertFalse(writer.thread.is_alive())
+        self.assertEqual(len(self.get_paths()), 20)
+        self.assertEqual(self.get_paths()[0], '/24/')
+
+    def test_async(self):
+        with su_settings.override(APISTUBS_REQUEST_LOG_ASYNC=True, APISTUBS_PRINT_INFO=False):
+            writer = get_log_writer()
+            RequestLog.add_success(service='account', path='/users/', env='test')
+            writer.flush()
+            self.assertEqual(self.get_paths(), ['/users/'])
@@ -0,0 +1,175 @@
+import json
+import yaml
+
+from datetime import timedelta
+
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from apistubs import settings as su_settings
+from apistubs import urls
+from apistubs.presets import (
+    ORMPresetStore,
+    RedisPresetStore,
+    FakeRedis,
+    get_preset_store,
+)
+
+__all__ = (
+    'ORMPresetStoreTests',
+    'RedisPresetStoreTests',
+    'PresetStoreSettingsTests',
+)
+
+
+ENTRIES = [
+    ('account', 'get', '/users', {'300': {'id': 1}}),
+    ('billing', 'get', '/bills', '200-ok'),
+    ('account', 'post', '/users', 201),
+]
+
+
+class PresetStoreTestsMixin:
+    def get_store(self):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.store = self.get_store()
+
+    def test_save(self):
+        self.store.save('test', ENTRIES)
+        self.assertEqual(self.store.get_env('test'), {
+            'account': {'get#/users': {'300': {'id': 1}}, 'post#/users': 201},
+            'billing': {'get#/bills': '200-ok'},
+        })
+        self.assertEqual(list(self.store.get('test', 'account')), ['get#/users', 'post#/users'])
+        self.assertEqual(self.store.get('other', 'account'), {})
+        self.assertEqual([entry[:2] for entry in self.store.iter_env('test')], [
+            ('account', 'get#/users'),
+            ('account', 'post#/users'),
+            ('billing', 'get#/bills'),
+        ])
+
+    def test_patch(self):
+        self.store.save('test', ENTRIES)
+        self.store.save('test', [('account', 'get', '/users', 404), ('account', 'get', '/new', 200)])
+        self.assertEqual(self.store.get('test', 'account'), {'get#/users': 404, 'post#/users': 201, 'get#/new': 200})
+        self.assertEqual(self.store.get('test', 'billing'), {'get#/bills': '200-ok'})
+
+    def test_replace(self):
+        self.store.save('test', ENTRIES)
+        self.store.save('test', [('account', 'get', '/new', 200)], replace=True)
+        self.assertEqual(self.store.get_env('test'), {'account': {'get#/new': 200}})
+        self.store.save('test', [], replace=True)
+        self.assertEqual(self.store.get_env('test'), {})
+
+    def test_batches(self):
+        entries = [('account', 'get', '/users/%s' % index, index) for index in range(7)]
+        self.store.save('test', entries + [('account', 'get', '/users/0', 'last')], batch_size=3)
+        values = self.store.get('test', 'account')
+        self.assertEqual(len(values), 7)
+        self.assertEqual(values['get#/users/0'], 'last')
+        self.assertEqual(list(values)[-1], 'get#/users/0')
+
+    def test_delete_env(self):
+        self.store.save('test', ENTRIES)
+        self.store.save('other', ENTRIES)
+        self.store.delete_env('test')
+        self.assertEqual(self.store.get_env('test'), {})
+        self.assertEqual(len(list(self.store.iter_env('other'))), 3)
+
+    def test_parent(self):
+        self.assertIsNone(self.store.get_parent('test'))
+        self.store.set_parent('test', 'base')
+        self.store.set_parent('test', 'ci')
+        self.assertEqual(self.store.get_parent('test'), 'ci')
+        self.store.set_parent('test', None)
+        self.assertIsNone(self.store.get_parent('test'))
+        self.store.set_parent('test', 'ci')
+        self.store.delete_env('test')
+        self.assertIsNone(self.store.get_parent('test'))
+
+    def test_expired(self):
+        now = timezone.now()
+        for env in ['', 'old', 'older', 'new']:
+            self.store.save(env, ENTRIES)
+        self.store.touch(['', 'old'], now - timedelta(days=2))
+        self.store.touch(['older'], now - timedelta(days=3))
+        self.store.touch(['missing'], now - timedelta(days=3))
+        before = now - timedelta(days=1)
+        self.assertEqual(self.store.get_expired_envs(before, 10), ['older', 'old'])
+        self.assertEqual(self.store.get_expired_envs(before, 1), ['older'])
+        self.store.delete_env('older')
+        self.assertEqual(self.store.get_expired_envs(before, 10), ['old'])
+
+    def test_documents(self):
+        self.assertIsNone(self.store.get_document('pets'))
+        self.store.set_document('pets', '{"openapi": "3.0.0"}')
+        self.store.set_document('pets', '{"openapi": "3.0.1"}')
+        self.assertEqual(self.store.get_document('pets'), '{"openapi": "3.0.1"}')
+        self.assertEqual(self.store.get_document_names(), ['pets'])
+        self.store.set_document('pets', None)
+        self.assertIsNone(self.store.get_document('pets'))
+        self.assertEqual(self.store.get_document_names(), [])
+
+
+class ORMPresetStoreTests(PresetStoreTestsMixin, TestCase):
+    def get_store(self):
+        return ORMPresetStore()
+
+    def setUp(self):
+        if not su_settings.DB_PRESET_ENABLED:
+            self.skipTest('DB presets are disabled')
+        super().setUp()
+
+    def test_long_pattern(self):
+        pattern = '/items/' + 'x' * 990
+        self.store.save('test', [('account', 'get', pattern, 200)])
+        self.store.save('test', [('account', 'get', pattern, 404), ('account', 'get', pattern[:-1], 201)])
+        self.assertEqual(self.store.get('test', 'account'), {'get#' + pattern: 404, 'get#' + pattern[:-1]: 201})
+        mock = self.store.model.objects.get(env='test', pattern=pattern)
+        self.assertEqual(mock.pattern_hash, self.store.model.hash_pattern(pattern))
+
+
+class RedisPresetStoreTests(PresetStoreTestsMixin, TestCase):
+    def get_store(self):
+        return RedisPresetStore(client=FakeRedis())
+
+    def test_single_read(self):
+        calls = []
+        client = self.store.client
+        hgetall = client.hgetall
+        client.hgetall = lambda key: calls.append(key) or hgetall(key)
+        self.store.save('test', ENTRIES)
+        self.store.get_env('test')
+        self.assertEqual(calls, ['apistubs:presets:test'])
+
+
+@override_settings(ROOT_URLCONF=urls)
+class PresetStoreSettingsTests(TestCase):
+    def override(self):
+        return su_settings.override(
+            APISTUBS_PRESET_STORE='apistubs.presets.RedisPresetStore',
+            APISTUBS_PRESET_STORE_OPTIONS={'prefix': 'tests:'},
+        )
+
+    def test_store(self):
+        with self.override():
+            store = get_preset_store()
+            self.assertIsInstance(store, RedisPresetStore)
+            self.assertIs(get_preset_store(), store)
+            self.assertEqual(store.prefix, 'tests:')
+        self.assertIsInstance(get_preset_store(), ORMPresetStore)
+
+    def test_settings_view(self):
+        if not su_settings.DB_PRESET_ENABLED:
+            return
+        url = reverse('settings_env', kwargs={'env': 'redis'})
+        with self.override():
+            get_preset_store().delete_env('redis')
+            self.client.post(url, data=json.dumps({'account': {'get#/users': 200}}), content_type='application/json')
+            response = self.client.get('%s?format=yaml' % url)
+            self.assertEqual(yaml.safe_load(b''.join(response.streaming_content)), {'account': {'get#/users': 200}})
+            self.assertEqual(get_preset_store().get('redis', 'account'), {'get#/users': 200})
+        self.assertEqual(get_preset_store().get_env('redis'), {})
@@ -0,0 +1,53 @@
+import json
+import pickle
+
+from django.core.exceptions import ImproperlyConfigured
+from django.test import SimpleTestCase
+
+from apistubs import settings as su_settings
+from apistubs.helpers import LazyMapping, freeze
+from apistubs.serializers import dumps, json_dumps, orjson
+
+__all__ = (
+    'SerializerTests',
+)
+
+
+def upper_dumps(data, pretty=False):
+    return json.dumps(data).upper()
+
+
+class SerializerTests(SimpleTestCase):
+    data = {'name': 'ы', 'items': [1, 2], 200: None}
+
+    def test_styles(self):
+        with su_settings.override(APISTUBS_JSON_STYLE='pretty'):
+            self.assertEqual(dumps(self.data), json_dumps(self.data, pretty=True))
+            self.assertIn(b'\n    "name"', dumps(self.data))
+        with su_settings.override(APISTUBS_JSON_STYLE='compact'):
+            self.assertEqual(dumps(self.data), '{"name":"ы","items":[1,2],"200":null}'.encode('utf-8'))
+        self.assertEqual(dumps(self.data, 'compact'), dumps(self.data, 'compact'))
+
+    def test_serializers(self):
+        serializers = ['json', 'apistubs.tests.test_serializers.upper_dumps']
+        if orjson is not None:
+            serializers.append('orjson')
+        for serializer in serializers:
+            with su_settings.override(APISTUBS_JSON_SERIALIZER=serializer):
+                self.assertEqual(json.loads(dumps(self.data, 'compact').lower()), json.loads(json.dumps(self.data)))
+
+    def test_invalid(self):
+        for name, value in [
+            ('APISTUBS_JSON_STYLE', 'tabs'),
+            ('APISTUBS_JSON_SERIALIZER', 'simplejson'),
+            ('APISTUBS_JSON_SERIALIZER', 'apistubs.tests.test_serializers.missing_dumps'),
+        ]:
+            with self.assertRaises(ImproperlyConfigured, msg=value):
+                with su_settings.override(**{name: value}):
+                    pass
+
+    def test_lazy(self):
+        data = freeze({'paths': LazyMapping({'/a/': pickle.dumps({'get': {}})})})
+        for serializer in ('json', 'orjson') if orjson is not None else ('json',):
+            with su_settings.override(APISTUBS_JSON_SERIALIZER=serializer):
+                self.assertEqual(json.loads(dumps(data, 'compact')), {'paths': {'/a/': {'get': {}}}})
@@ -0,0 +1,194 @@
+import os
+import json
+import threading
+
+from django.core.exceptions import ImproperlyConfigured
+from django.test import SimpleTestCase, RequestFactory
+
+from apistubs import settings as su_settings
+from apistubs.helpers import pack_lazy, unpack_lazy
+from apistubs.spec import RouteIndex, RegexRouteIndex, ParserRouteIndex, ExampleTable, select_path, spec_point
+from apistubs.warmup import warmup
+
+__all__ = (
+    'RouteIndexTests',
+    'RouteMatchersTests',
+    'ExampleTableTests',
+    'WarmupTests',
+)
+
+APP_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..' ))
+PATHS = list(json.load(open(os.path.join(APP_ROOT, 'demo', 'tests.api.json')))['paths'].keys())
+PATHS += [
+    '/a/{x}',
+    '/a/b',
+    '/v{version}.json/{id}',
+    '/parametrize/?key=value',
+    '/parametrize/?key=value&key2=value2',
+    '/parametrize/?key2=value2',
+]
+
+
+class RouteIndexTests(SimpleTestCase):
+    def test_same_as_select_path(self):
+        index = RouteIndex(PATHS)
+        for path in [
+            '/',
+            '/a/b',
+            '/a/c',
+            '/A/B',
+            '/a/b/c',
+            '/v1.json/2',
+            '/auth/sessions/333/list/',
+            '/auth/sessions/333/delete/parent/',
+            '/personal/account/nicknames/nick/',
+            '/does_not_exist/',
+        ]:
+            self.assertEqual(index.find(path), select_path(PATHS, path), path)
+
+    def test_params(self):
+        index = RouteIndex(PATHS)
+        for query in ['', 'key=value', 'key2=value2', 'key=value&key2=value2']:
+            request = RequestFactory().get('/parametrize/?' + query)
+            self.assertEqual(
+                index.find('/parametrize/', request=request),
+                select_path(PATHS, '/parametrize/', request=request),
+                query
+            )
+
+    def test_variables(self):
+        index = RouteIndex(PATHS)
+        self.assertEqual(
+            index.match('/v1.json/22'),
+            ('/v{version}.json/{id}', {'version': '1', 'id': '22'}),
+        )
+        self.assertEqual(index.match('/does_not_exist/'), None)
+
+
+class RouteMatchersTests(SimpleTestCase):
+    def test_same_as_trie(self):
+        trie = RouteIndex(PATHS)
+        for index in [RegexRouteIndex(PATHS), ParserRouteIndex(PATHS)]:
+            for path in [
+                '/',
+                '/a/b',
+                '/A/c',
+                '/v1.json/22',
+                '/auth/sessions/333/delete/',
+                '/parametrize/',
+                '/does_not_exist/',
+            ]:
+                self.assertEqual(index.match(path), trie.match(path), path)
+
+            request = RequestFactory().get('/parametrize/?key=value&key2=value2')
+            self.assertEqual(
+                index.find('/parametrize/', request=request),
+                '/parametrize/?key=value&key2=value2',
+            )
+
+    def test_unknown_matcher(self):
+        with su_settings.override(APISTUBS_SPEC_MATCHERS={'account': 'regex'}):
+            self.assertEqual(spec_point.get_matcher('account'), 'regex')
+        with self.assertRaisesMessage(ImproperlyConfigured, 'trie, regex, parser'):
+            with su_settings.override(APISTUBS_SPEC_MATCHERS={'account': 'glob'}):
+                pass
+        self.assertEqual(su_settings.SPEC_MATCHERS, {})
+
+
+class ExampleTableTests(SimpleTestCase):
+    def test_get(self):
+        spec = {'paths': {
+            '/a/': {
+                'get': {
+                    'responses': {
+                        '404': {'content': {'application/json': {'example': {'error': 'not_found'}}}},
+                        '200': {'content': {'application/json': {'examples': {
+                            'one': {'value': {'id': 1}},
+                            'two': {'value': {'id': 2}},
+                        }}}},
+                        '202': {
+                            'content': {'application/json': {'example': {}}},
+                            'headers': {'Location': {'schema': {'example': 'https://example.com/a/'}}},
+                        },
+                    },
+                },
+            },
+        }}
+        table = ExampleTable(spec)
+        self.assertEqual(table.get('/a/', 'get'), ('200', {'id': 1}, None))
+        self.assertEqual(table.get('/a/', 'get', 200, 'two'), ('200', {'id': 2}, None))
+        self.assertEqual(table.get('/a/', 'get', 200, 1), ('200', {'id': 2}, None))
+        self.assertEqual(table.get('/a/', 'get', 200, 'three'), ('200', {}, None))
+        self.assertEqual(table.get('/a/', 'get', 404), ('404', {'error': 'not_found'}, None))
+        self.assertEqual(table.get('/a/', 'get', 202), ('202', {}, 'https://example.com/a/'))
+        self.assertEqual(table.get('/a/', 'post'), None)
+        self.assertEqual(table.get('/a/', 'get', 500), None)
+
+    def test_lazy(self):
+        spec = {
+            'openapi': '3.0.0',
+            'paths': {
+                '/a/': {'get': {'responses': {'200': {'$ref': '#/components/responses/ok'}}}},
+                '/b/': {'get': {'responses': {'200': {'content': {'application/json': {'examples': {
+                    'one': {'$ref': '#/components/examples/one'},
+                }}}}}}},
+                '/c/': {'get': {'responses': {}}},
+            },
+            'components': {
+                'responses': {
+                    'ok': {'content': {'application/json': {'example': {'ok': True}}}},
+                },
+                'examples': {
+                    'one': {'value': {'id': 1}},
+                },
+                'schemas': {
+                    'Big': {'type': 'object'},
+                },
+            },
+        }
+        lazy = unpack_lazy(pack_lazy(spec))
+        self.assertEqual(json.loads(json.dumps(lazy)), spec)
+        self.assertEqual(list(RouteIndex(lazy['paths']).root.literals), [''])
+
+        table = ExampleTable(lazy)
+        self.assertEqual(table.get('/a/', 'get'), ('200', {'ok': True}, None))
+        self.assertEqual(table.get('/b/', 'get', 200, 'one'), ('200', {'id': 1}, None))
+        self.assertEqual(lazy['paths'].loaded, {'/a/', '/b/'})
+        self.assertEqual(lazy['components']['examples'].loaded, {'one'})
+        self.assertEqual(lazy['components']['schemas'].loaded, set())
+
+    def test_lazy_concurrent(self):
+        lazy = unpack_lazy(pack_lazy({'paths': {
+            '/a/': {'get': {'responses': {'200': {'content': {'application/json': {'example': {'ok': True}}}}}}},
+        }}))
+        results = []
+        threads = []
+
+        class Table(ExampleTable):
+            def add(table, *args):
+                # a lookup of another request while the pattern is compiled
+                thread = threading.Thread(target=lambda: results.append(table.get('/a/', 'get')))
+                thread.start()
+                thread.join(0.05)
+                threads.append(thread)
+                super().add(*args)
+
+        table = Table(lazy)
+        self.assertEqual(table.get('/a/', 'get'), ('200', {'ok': True}, None))
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [('200', {'ok': True}, None)])
+
+
+class WarmupTests(SimpleTestCase):
+    def test_ok(self):
+        spec_file = os.path.join(APP_ROOT, 'demo', 'tests.api.json')
+        stubs_config = os.path.join(APP_ROOT, 'demo', 'tests.stubs.yaml')
+        with su_settings.override(
+            APISTUBS_SPEC_FILES={'account': spec_file},
+            APISTUBS_STUBS_CONFIG=[stubs_config],
+            APISTUBS_STUB_FORCE_ENABLED=False,
+        ):
+            timings = warmup(workers=2)
+            self.assertEqual(set(timings), {'account', 'ministubs', stubs_config})
+            self.assertIn(('/realm/detect/', 'get', None), spec_point.get_example_table('account').responses)
@@ -0,0 +1,328 @@
+import gzip
+import os
+import tempfile
+import time
+import json
+
+from django.core.cache import cache
+from django.test import TestCase, RequestFactory, override_settings
+from django.urls import reverse
+
+from apistubs import settings as su_settings
+from apistubs import urls
+from apistubs.payload import Payload, get_accepted_encodings
+from apistubs.presets import get_preset_store
+from apistubs.spec import select_path
+from apistubs.stubs import (
+    get_stub_response,
+    get_preset_snapshot,
+    ComboSettings,
+    DBSettings,
+    Generation,
+)
+
+__all__ = (
+    'ResolutionCacheTests',
+    'PayloadTests',
+    'DBSettingsTests',
+    'PresetSnapshotTests',
+)
+
+APP_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..' ))
+PROJECT = 'account'
+
+
+class StubsTestsMixin:
+    def override(self):
+        return su_settings.override(
+            APISTUBS_SPEC_FILES={
+                PROJECT: os.path.join(APP_ROOT, 'demo', 'tests.api.json'),
+            },
+            APISTUBS_STUBS_CONFIG=[
+                os.path.join(APP_ROOT, 'demo', 'tests.stubs.json'),
+                os.path.join(APP_ROOT, 'demo', 'tests.stubs.yaml'),
+            ],
+            APISTUBS_PRINT_INFO=False
+        )
+
+    def resolve(self, path, **headers):
+        request = RequestFactory().get(path, **headers)
+        return get_stub_response(PROJECT, request, path, env='memo')
+
+    def get(self, path, **headers):
+        url = reverse('stub_env', kwargs={'env': 'memo', 'spec': PROJECT}) + path.lstrip('/')
+        return self.client.get(url, **headers)
+
+
+@override_settings(ROOT_URLCONF=urls, PROJECT=PROJECT)
+class ResolutionCacheTests(StubsTestsMixin, TestCase):
+    def test_cached(self):
+        with self.override():
+            response = self.resolve('/realm/detect/')
+            self.assertEqual(response.status, 409)
+            self.assertIs(self.resolve('/realm/detect/'), response)
+            self.assertIsNot(self.resolve('/auth/sessions/1/list/'), response)
+
+    def test_disallowed_host(self):
+        with self.override():
+            response = self.resolve('/realm/detect/', HTTP_HOST='other.example')
+            self.assertEqual(response.status, 409)
+            self.assertIs(self.resolve('/realm/detect/', HTTP_HOST='other.example'), response)
+            self.assertIsNot(self.resolve('/realm/detect/'), response)
+
+    def test_server_name(self):
+        with self.override():
+            response = self.resolve('/realm/detect/')
+            self.assertIsNot(self.resolve('/realm/detect/', SERVER_NAME='other.example'), response)
+            self.assertIsNot(self.resolve('/realm/detect/', SERVER_PORT='8000'), response)
+
+    def test_shared_headers(self):
+        with self.override():
+            response = self.resolve('/realm/detect/')
+            self.assertEqual(response.headers, {'Etag': 32423412342})
+            with self.assertRaises(TypeError):
+                response.headers['X-Other'] = '1'
+
+    def test_stub_response_headers(self):
+        with self.override():
+            self.resolve('/realm/detect/')
+            response = self.resolve(
+                '/realm/detect/',
+                HTTP_STUB_RESPONSE_STATUS='201',
+                HTTP_STUB_RESPONSE_CONTENT='{"a": 1}',
+                HTTP_STUB_RESPONSE_HEADERS='{}',
+            )
+            self.assertEqual(response.status, 201)
+            self.assertEqual(response.content, {'a': 1})
+
+    def test_invalidated(self):
+        if not su_settings.DB_PRESET_ENABLED:
+            return
+
+        with self.override():
+            self.assertEqual(self.resolve('/realm/detect/').status, 409)
+
+            self.client.post(
+                reverse('settings_env', kwargs={'env': 'memo'}),
+                data=json.dumps({PROJECT: {'get#/realm/detect/': 202}}),
+                content_type='application/json'
+            )
+            self.assertEqual(self.resolve('/realm/detect/').status, 202)
+
+            self.client.post(reverse('prompt_env', kwargs={'env': 'memo'}), data='any', content_type='text/plain')
+            self.client.delete(reverse('settings_env', kwargs={'env': 'memo'}))
+            self.assertEqual(self.resolve('/realm/detect/').status, 409)
+
+
+@override_settings(ROOT_URLCONF=urls, PROJECT=PROJECT)
+class PayloadTests(StubsTestsMixin, TestCase):
+    def test_payload_cached(self):
+        with self.override():
+            response = self.resolve('/auth/sessions/1/list/')
+            self.assertIs(response.payload, response.payload)
+            self.assertEqual(json.loads(response.payload.body), response.content)
+
+    def test_payload_shared(self):
+        with self.override():
+            first = self.resolve('/auth/sessions/1/list/')
+            second = self.resolve('/auth/sessions/2/list/')
+            self.assertIsNot(first, second)
+            self.assertIs(first.payload, second.payload)
+
+    def test_preset_payload_shared(self):
+        with self.override():
+            # with and without HEADERS, one memo entry per query string
+            for path, query in (('/realm/detect/', 'x=%s'), ('/parametrize/', 'key=value&x=%s')):
+                first, second = [
+                    get_stub_response(PROJECT, RequestFactory().get(path, QUERY_STRING=query % n), path, env='memo')
+                    for n in (1, 2)
+                ]
+                self.assertIsNot(first, second)
+                self.assertIsInstance(first.content, dict)
+                self.assertIs(first.payload, second.payload)
+
+    def test_not_modified(self):
+        with self.override():
+            response = self.get('/auth/sessions/1/list/')
+            self.assertEqual(response.status_code, 200)
+            etag = response['ETag']
+
+            response = self.get('/auth/sessions/1/list/', HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response['ETag'], etag)
+            self.assertEqual(response.content, b'')
+
+            response = self.get('/auth/sessions/1/list/', HTTP_IF_NONE_MATCH='"other"')
+            self.assertEqual(response.status_code, 200)
+
+    def test_preset_etag(self):
+        with self.override():
+            response = self.get('/realm/detect/', HTTP_IF_NONE_MATCH='32423412342')
+            self.assertEqual(response.status_code, 409)
+            self.assertEqual(response['ETag'], '32423412342')
+
+    def test_compressed(self):
+        with self.override(), su_settings.override(APISTUBS_COMPRESSION_MIN_SIZE=0):
+            response = self.get('/auth/sessions/1/list/', HTTP_ACCEPT_ENCODING='gzip')
+            self.assertFalse(response.has_header('Content-Encoding'))
+
+        compression = su_settings.override(APISTUBS_COMPRESSION=('br', 'gzip'), APISTUBS_COMPRESSION_MIN_SIZE=0)
+        with self.override(), compression:
+            response = self.get('/auth/sessions/1/list/', HTTP_ACCEPT_ENCODING='br;q=0, gzip;q=0.5')
+            self.assertEqual(response['Content-Encoding'], 'gzip')
+            stub_response = self.resolve('/auth/sessions/1/list/')
+            self.assertEqual(gzip.decompress(response.content), stub_response.payload.body)
+            self.assertIs(stub_response.payload.encode('gzip'), stub_response.payload.encode('gzip'))
+
+            response = self.get('/auth/sessions/1/list/', HTTP_ACCEPT_ENCODING='gzip;q=0')
+            self.assertFalse(response.has_header('Content-Encoding'))
+
+            with su_settings.override(APISTUBS_COMPRESSION=None, APISTUBS_COMPRESSION_MIN_SIZE=0):
+                response = self.get('/auth/sessions/1/list/', HTTP_ACCEPT_ENCODING='gzip')
+                self.assertFalse(response.has_header('Content-Encoding'))
+
+    def test_accepted_encodings(self):
+        request = RequestFactory().get('/', HTTP_ACCEPT_ENCODING='gzip;q=0.8, BR, identity;q=x')
+        self.assertEqual(get_accepted_encodings(request), {'gzip': 0.8, 'br': 1.0, 'identity': 0.0})
+        self.assertEqual(gzip.decompress(Payload(b'{}').encode('gzip')[0]), b'{}')
+
+    def test_templated_body(self):
+        headers = {
+            'HTTP_STUB_RESPONSE_STATUS': '200',
+            'HTTP_STUB_RESPONSE_CONTENT': '{"name": "{{ name }}"}',
+            'HTTP_STUB_RESPONSE_HEADERS': '{}',
+        }
+        with self.override():
+            response = self.get('/realm/detect/?name=one', **headers)
+            self.assertEqual(json.loads(response.content), {'name': '{{ name }}'})
+
+            with su_settings.override(APISTUBS_TEMPLATE_BODIES=True):
+                response = self.get('/realm/detect/?name=one', **headers)
+                self.assertEqual(json.loads(response.content), {'name': 'one'})
+                response = self.get('/auth/sessions/1/list/')
+                self.assertEqual(response.status_code, 200)
+
+
+@override_settings(ROOT_URLCONF=urls, PROJECT=PROJECT)
+class DBSettingsTests(TestCase):
+    env = 'db-cache'
+
+    def setUp(self):
+        if su_settings.DB_PRESET_ENABLED:
+            Generation.bump(self.env)
+
+    def post(self, preset):
+        self.client.post(
+            reverse('settings_env', kwargs={'env': self.env}),
+            data=json.dumps({PROJECT: preset}),
+            content_type='application/json'
+        )
+
+    def test_cached(self):
+        if not su_settings.DB_PRESET_ENABLED:
+            return
+
+        self.post({'get#/realm/detect/': 202})
+        self.assertEqual(DBSettings(PROJECT, env=self.env).values, {'get#/realm/detect/': 202})
+        with self.assertNumQueries(0):
+            self.assertEqual(DBSettings(PROJECT, env=self.env).values, {'get#/realm/detect/': 202})
+
+        self.post({'get#/realm/detect/': 201})
+        # the presets of the env, its parent is looked up by the save already
+        with self.assertNumQueries(1):
+            self.assertEqual(DBSettings(PROJECT, env=self.env).values, {'get#/realm/detect/': 201})
+
+        self.client.delete(reverse('settings_env', kwargs={'env': self.env}))
+        self.assertEqual(DBSettings(PROJECT, env=self.env).values, {})
+
+    def test_local_ttl(self):
+        if not su_settings.DB_PRESET_ENABLED:
+            return
+
+        with su_settings.override(APISTUBS_DB_PRESET_LOCAL_TTL=0.05):
+            # the counter of setUp does not expire that soon
+            cache.delete(Generation.CACHE_KEY + self.env)
+            self.post({'get#/realm/detect/': 202})
+            self.assertEqual(DBSettings(PROJECT, env=self.env).values, {'get#/realm/detect/': 202})
+            # a write of another worker, its bump is not in this process-local cache
+            get_preset_store().save(self.env, [(PROJECT, 'get', '/realm/detect/', 201)])
+            self.assertEqual(DBSettings(PROJECT, env=self.env).values, {'get#/realm/detect/': 202})
+            time.sleep(0.1)
+            self.assertEqual(DBSettings(PROJECT, env=self.env).values, {'get#/realm/detect/': 201})
+
+    def test_inherited(self):
+        if not su_settings.DB_PRESET_ENABLED:
+            return
+
+        base_url = reverse('settings_env', kwargs={'env': 'db-base'})
+        self.client.post(base_url, data=json.dumps({PROJECT: {
+            'get#/realm/detect/': 202,
+            'get#/realm/': 200,
+        }}), content_type='application/json')
+        self.client.post(
+            reverse('settings_env', kwargs={'env': self.env}) + '?parent=db-base',
+            data=json.dumps({PROJECT: {'get#/realm/': 404}}),
+            content_type='application/json'
+        )
+        values = DBSettings(PROJECT, env=self.env).values
+        self.assertEqual(values, {'get#/realm/': 404, 'get#/realm/detect/': 202})
+        self.assertEqual(list(values), ['get#/realm/', 'get#/realm/detect/'])
+        self.assertEqual(get_preset_store().get(self.env, PROJECT), {'get#/realm/': 404})
+        with self.assertNumQueries(0):
+            DBSettings(PROJECT, env=self.env)
+
+        # a parent update reaches the children, only the parent presets are read again
+        self.client.patch(base_url, data=json.dumps({PROJECT: {'get#/realm/detect/': 201}}),
+                          content_type='application/json')
+        with self.assertNumQueries(1):
+            values = DBSettings(PROJECT, env=self.env).values
+        self.assertEqual(values, {'get#/realm/': 404, 'get#/realm/detect/': 201})
+
+        # no cycles
+        response = self.client.patch(base_url + '?parent=' + self.env, data='{}', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+        # back on the YAML baseline
+        self.client.patch(
+            reverse('settings_env', kwargs={'env': self.env}) + '?parent',
+            data='{}', content_type='application/json'
+        )
+        self.assertEqual(DBSettings(PROJECT, env=self.env).values, {'get#/realm/': 404})
+
+
+class PresetSnapshotTests(TestCase):
+    def write(self, directory, name, data):
+        path = os.path.join(directory, name)
+        with open(path, 'w') as f:
+            json.dump(data, f)
+        return path
+
+    def test_merged(self):
+        with tempfile.TemporaryDirectory() as directory:
+            configs = [
+                self.write(directory, 'one.json', {PROJECT: {'get#/a/{id}/': 1}}),
+                self.write(directory, 'two.json', {PROJECT: {'get#/a/1/': 2, 'get#/b/': 3}, 'PROMPT': 'x y'}),
+            ]
+            with su_settings.override(APISTUBS_STUBS_CONFIG=configs):
+                snapshot = get_preset_snapshot(PROJECT)
+                self.assertIs(get_preset_snapshot(PROJECT), snapshot)
+                self.assertEqual(snapshot.patterns, ['/a/{id}/', '/a/1/', '/b/'])
+                self.assertEqual(snapshot.prompt, ['x', 'y'])
+                self.assertEqual(snapshot.get('get', '/a/{id}/', '/a/1/'), 1)
+                self.assertEqual(snapshot.get('get', '/b/', '/b/'), 3)
+                self.assertIsNone(snapshot.get('post', '/b/', '/b/'))
+
+    @override_settings(ROOT_URLCONF=urls, PROJECT=PROJECT)
+    def test_select_path(self):
+        configs = [
+            os.path.join(APP_ROOT, 'demo', 'tests.stubs.json'),
+            os.path.join(APP_ROOT, 'demo', 'tests.stubs.yaml'),
+        ]
+        with su_settings.override(APISTUBS_STUBS_CONFIG=configs):
+            for path in ['/auth/sessions/1/list/', '/parametrize/?key=value&key2=value2', '/realm/detect/', '/none/']:
+                request = RequestFactory().get(path, HTTP_COOKIE='get#/realm/{name}/=200')
+                settings = ComboSettings(PROJECT, request, env='snapshot')
+                self.assertEqual(
+                    settings.select_path(request.path),
+                    select_path(settings.patterns, request.path, request=request)
+                )
@@ -0,0 +1,109 @@
+import json
+
+from datetime import timedelta
+from io import StringIO
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from apistubs import settings as su_settings
+from apistubs import urls
+from apistubs.logging import RequestLog, get_log_buffer
+from apistubs.presets import get_preset_store
+from apistubs.stubs import EnvUsage, Prompt
+from apistubs.sweep import sweep_envs
+
+__all__ = (
+    'SweepTests',
+)
+
+
+PROJECT = 'account'
+
+
+@override_settings(ROOT_URLCONF=urls, PROJECT=PROJECT)
+class SweepTests(TestCase):
+    def setUp(self):
+        if not su_settings.DB_PRESET_ENABLED:
+            self.skipTest('DB presets are disabled')
+        override = su_settings.override(APISTUBS_ENV_TTL=60 * 60 * 24)
+        override.__enter__()
+        self.addCleanup(override.__exit__, None, None, None)
+        self.store = get_preset_store()
+
+    def post(self, env):
+        url = reverse('settings_env', kwargs={'env': env}) if env else reverse('settings')
+        self.client.post(url, data=json.dumps({PROJECT: {'get#/realm/': 200}}), content_type='application/json')
+
+    def expire(self, *envs):
+        self.store.touch(envs, timezone.now() - timedelta(seconds=su_settings.ENV_TTL + 1))
+
+    def test_sweep(self):
+        for env in ['', 'old', 'new']:
+            self.post(env)
+        Prompt.set_value('old', 'x')
+        RequestLog.add({'result': 'success'}, 'old')
+        self.expire('', 'old')
+
+        self.assertEqual(sweep_envs(), ['old'])
+        self.assertEqual(self.store.get_env('old'), {})
+        self.assertIsNone(Prompt.get_value('old'))
+        self.assertEqual(RequestLog.get('old'), [])
+        buffer = get_log_buffer()
+        keys = ['seq', 'floor'] + list(range(RequestLog.get_capacity('old')))
+        self.assertEqual(cache.get_many([buffer.get_key('old', key) for key in keys]), {})
+        self.assertEqual(self.store.get_env('new'), {PROJECT: {'get#/realm/': 200}})
+        self.assertEqual(self.store.get_env(''), {PROJECT: {'get#/realm/': 200}})
+
+    def test_batches(self):
+        envs = ['ci-%s' % index for index in range(5)]
+        for env in envs:
+            self.post(env)
+        self.expire(*envs)
+
+        self.assertEqual(len(sweep_envs(batch_size=2, limit=3)), 3)
+        out = StringIO()
+        call_command('apistubs_sweep', '--batch-size', '2', stdout=out)
+        self.assertIn('2 envs deleted', out.getvalue())
+        self.assertEqual(sweep_envs(), [])
+
+    def test_parent_kept(self):
+        self.post('base')
+        self.expire('base')
+        # saving a child marks its parent as used
+        self.client.post(
+            reverse('settings_env', kwargs={'env': 'ci'}) + '?parent=base',
+            data=json.dumps({PROJECT: {'get#/other/': 200}}), content_type='application/json'
+        )
+        self.assertEqual(sweep_envs(), [])
+        self.assertEqual(self.store.get_env('base'), {PROJECT: {'get#/realm/': 200}})
+
+    def test_disabled(self):
+        self.post('old')
+        self.expire('old')
+        with su_settings.override(APISTUBS_ENV_TTL=None):
+            self.assertEqual(sweep_envs(), [])
+
+    def test_touch(self):
+        self.post('ci')
+        self.post('ci-child')
+        self.client.patch(
+            reverse('settings_env', kwargs={'env': 'ci-child'}) + '?parent=ci',
+            data='{}', content_type='application/json'
+        )
+        self.expire('ci', 'ci-child')
+        EnvUsage.delete_value('ci-child')
+
+        # the child keeps its parent
+        self.assertTrue(EnvUsage.touch('ci-child'))
+        self.assertFalse(EnvUsage.touch('ci-child'))
+        self.assertEqual(sweep_envs(), [])
+
+        # one write per interval
+        self.expire('ci', 'ci-child')
+        with self.assertNumQueries(0):
+            self.client.get('/%s/' % PROJECT, HTTP_COOKIE='middleware_stubs_env=ci-child')
+        self.assertEqual(sorted(sweep_envs()), ['ci', 'ci-child'])
@@ -1,15 +1,17 @@
+import gzip
 import os
 import json
 import yaml
 
-from mock import ANY
+from mock import ANY, patch
 
 from django.test import TestCase, override_settings
 from django.urls import reverse
 
 from apistubs import settings as su_settings
-from apistubs.helpers import load_apistubs_yaml
+from apistubs.helpers import LazyMapping, load_apistubs_yaml, pack_lazy, replace_path, unpack_lazy
 from apistubs import urls
+from apistubs.views.common import SpecView, strip_figures
 
 __all__ = (
     'StubViewTests',
@@ -177,6 +179,9 @@ class ViewTestsMixin(object):
                 response = self.client.get(log_url + '?format=json')
                 content = response.content.decode()
                 content = json.loads(content)
+                ids = [item.pop('id') for item in content['log']]
+                self.assertEqual(ids, sorted(ids, reverse=True))
+                self.assertEqual(content.pop('last_id'), ids[0] if ids else None)
                 self.assertEqual(content, expected_log)
 
                 if not env_url:
@@ -185,7 +190,7 @@ class ViewTestsMixin(object):
                     log_url = reverse('log')
 
                 response = self.client.get(log_url + '?format=json')
-                self.assertEqual(json.loads(response.content.decode()), {'log': []})
+                self.assertEqual(json.loads(response.content.decode()), {'log': [], 'last_id': None})
 
 
 @override_settings(ROOT_URLCONF=urls, PROJECT=PROJECT)
@@ -473,3 +478,87 @@ class SpecViewTests(ViewTestsMixin, TestCase):
                     'tags': ANY,
                     'components': ANY,
                 })
+
+    def test_spec_host(self):
+        with self.patch_spec():
+            for host in ['one.example.com', 'two.example.com']:
+                with self.settings(ALLOWED_HOSTS=['*']):
+                    response = self.client.get(self.spec_url(), HTTP_HOST=host)
+                content = json.loads(response.content)
+                self.assertIn(host, content['servers'][0]['url'])
+
+            data = load_apistubs_yaml(su_settings.SPEC_FILES[PROJECT])
+            self.assertNotIn('example.com', data['servers'][0]['url'])
+
+    def test_spec_gzip(self):
+        with self.patch_spec(), su_settings.override(APISTUBS_COMPRESSION=('gzip',)):
+            plain = self.client.get(self.spec_url())
+            response = self.client.get(self.spec_url(), HTTP_ACCEPT_ENCODING='gzip, deflate')
+            self.assertEqual(response['Content-Encoding'], 'gzip')
+            self.assertIn('Accept-Encoding', response['Vary'])
+            self.assertEqual(gzip.decompress(response.content), plain.content)
+            self.assertNotEqual(response['ETag'], plain['ETag'])
+
+            response = self.client.get(
+                self.spec_url(), HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=response['ETag']
+            )
+            self.assertEqual(response.status_code, 304)
+
+    def test_spec_cached(self):
+        process_data = patch.object(SpecView, 'process_data', autospec=True, side_effect=SpecView.process_data)
+        with self.patch_spec(), process_data as process_data:
+            response = self.client.get(self.spec_url())
+            self.assertEqual(process_data.call_count, 1)
+
+            self.assertEqual(self.client.get(self.spec_url()).content, response.content)
+            self.assertEqual(process_data.call_count, 1)
+
+            not_modified = self.client.get(self.spec_url(), HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(not_modified.status_code, 304)
+
+            with self.settings(ALLOWED_HOSTS=['*']):
+                self.client.get(self.spec_url(), HTTP_HOST='other.example.com')
+            self.assertEqual(process_data.call_count, 2)
+
+            if su_settings.DB_PRESET_ENABLED:
+                stored = {'openapi': '3.0.0', 'info': {'title': 'stored'}, 'paths': {}}
+                self.client.post(self.index_url(), data=json.dumps(stored), content_type='application/json')
+                content = json.loads(self.client.get(self.spec_url()).content)
+                self.assertEqual(content['info'], {'title': 'stored'})
+                self.client.delete(self.index_url())
+                content = json.loads(self.client.get(self.spec_url()).content)
+                self.assertEqual(content['info'], json.loads(response.content)['info'])
+
+    def test_strip_figures(self):
+        data = {'info': {'description': 'a<figure>\n<img/></figure>b'}, 'paths': {'/': {}}}
+        stripped = strip_figures(data)
+        self.assertEqual(stripped['info']['description'], 'ab')
+        self.assertIs(stripped['paths'], data['paths'])
+        self.assertIs(strip_figures(data['paths']), data['paths'])
+
+    def test_strip_figures_lazy(self):
+        data = unpack_lazy(pack_lazy({
+            'paths': {
+                '/a/': {'get': {'description': 'a<figure></figure>'}},
+                '/b/': {'get': {}},
+            },
+            'components': {'securitySchemes': {
+                'oauth_2_0': {'flows': {'implicit': {'authorizationUrl': 'a'}}},
+                'other': {},
+            }},
+        }))
+        stripped = strip_figures(data)
+        self.assertIsInstance(stripped['paths'], LazyMapping)
+        self.assertEqual(stripped['paths'].loaded, set())
+        self.assertEqual(stripped['paths']['/a/'], {'get': {'description': 'a'}})
+        self.assertEqual(stripped['paths'].loaded, {'/a/'})
+        self.assertEqual(data['paths'].loaded, set())
+
+        flows = ('components', 'securitySchemes', 'oauth_2_0', 'flows', 'implicit')
+        replaced = replace_path(stripped, {'authorizationUrl': 'b'}, *flows)
+        schemes = replaced['components']['securitySchemes']
+        self.assertIsInstance(schemes, LazyMapping)
+        self.assertEqual(schemes.loaded, {'oauth_2_0'})
+        self.assertEqual(schemes['oauth_2_0']['flows']['implicit'], {'authorizationUrl': 'b'})
+        self.assertEqual(stripped['components']['securitySchemes']['oauth_2_0']['flows']['implicit'],
+                         {'authorizationUrl': 'a'})
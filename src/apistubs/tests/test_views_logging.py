@@ -0,0 +1,87 @@
+import json
+import threading
+import time
+import yaml
+
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from apistubs import settings as su_settings
+from apistubs import urls
+from apistubs.helpers import freeze
+from apistubs.logging import RequestLog
+
+__all__ = (
+    'LogViewTests',
+)
+
+
+@override_settings(ROOT_URLCONF=urls)
+class LogViewTests(TestCase):
+    env = 'log'
+
+    def setUp(self):
+        cache.clear()
+
+    def add(self, n):
+        return RequestLog.add({'n': n}, self.env)
+
+    def get(self, **params):
+        return self.client.get(reverse('log_env', kwargs={'env': self.env}), data=dict(params, format='json'))
+
+    def test_since(self):
+        ids = [self.add(n) for n in range(3)]
+        data = self.get().json()
+        self.assertEqual(data['log'], [{'n': 2, 'id': ids[2]}, {'n': 1, 'id': ids[1]}, {'n': 0, 'id': ids[0]}])
+        self.assertEqual(data['last_id'], ids[2])
+
+        data = self.get(since=ids[0]).json()
+        self.assertEqual([item['n'] for item in data['log']], [2, 1])
+        data = self.get(since=ids[2]).json()
+        self.assertEqual(data, {'log': [], 'last_id': ids[2]})
+        self.assertEqual(self.get(since='x').status_code, 400)
+
+    def test_wait(self):
+        since = self.add(0)
+        thread = threading.Timer(0.05, self.add, args=(1,))
+        thread.start()
+        started = time.monotonic()
+        data = self.get(since=since, wait=5).json()
+        thread.join()
+        self.assertEqual([item['n'] for item in data['log']], [1])
+        self.assertLess(time.monotonic() - started, 1)
+
+        started = time.monotonic()
+        with su_settings.override(APISTUBS_REQUEST_LOG_POLL_INTERVAL=0.01):
+            data = self.get(since=data['last_id'], wait=0.05).json()
+        self.assertEqual(data['log'], [])
+        self.assertGreaterEqual(time.monotonic() - started, 0.05)
+
+        for wait in ('nan', 'inf', '-1', 'x'):
+            self.assertEqual(self.get(wait=wait).status_code, 400)
+
+    def test_yaml(self):
+        RequestLog.add({'response': {'content': freeze({'items': [1]})}}, self.env)
+        response = self.client.get(reverse('log_env', kwargs={'env': self.env}))
+        self.assertEqual(yaml.safe_load(response.content)[0]['response'], {'content': {'items': [1]}})
+
+    def test_events(self):
+        ids = [self.add(n) for n in range(2)]
+        with su_settings.override(APISTUBS_REQUEST_LOG_STREAM_TIMEOUT=0.2, APISTUBS_REQUEST_LOG_POLL_INTERVAL=0.01):
+            response = self.client.get(
+                reverse('log_env', kwargs={'env': self.env}),
+                HTTP_ACCEPT='text/event-stream', HTTP_LAST_EVENT_ID=str(ids[0])
+            )
+            self.assertEqual(response['Content-Type'], 'text/event-stream')
+            events = iter(response.streaming_content)
+            self.assertEqual(next(events), b'retry: 1000\n\n')
+            event = next(events).decode('utf-8')
+            self.assertEqual(event.split('\n')[:2], ['id: %s' % ids[1], 'event: log'])
+            self.assertEqual(json.loads(event.split('data: ')[1]), {'n': 1, 'id': ids[1]})
+
+            threading.Timer(0.02, self.add, args=(2,)).start()
+            event = next(events).decode('utf-8')
+            self.assertEqual(json.loads(event.split('data: ')[1])['n'], 2)
+            # a keepalive, then the end of the stream
+            self.assertEqual(list(events), [b': keepalive\n\n'])
@@ -1,11 +1,16 @@
 import json
 import yaml
 
+from mock import patch
+
+from django.db import connection
 from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 
 from apistubs import settings as su_settings
 from apistubs import urls
+from apistubs.views.settings import export_yaml
 
 __all__ = (
     'SettingsViewTests',
@@ -42,7 +47,8 @@ class SettingsViewTests(TestCase):
         return self.client.post(self.get_url(env=env), data=data, content_type='application/json')
 
     def get(self, response_format='yaml', env=False):
-        return self.client.get('%s?format=%s' %(self.get_url(env=env), response_format,))
+        response = self.client.get('%s?format=%s' %(self.get_url(env=env), response_format,))
+        return b''.join(response.streaming_content)
 
     def delete(self):
         return self.client.delete(self.get_url())
@@ -53,15 +59,15 @@ class SettingsViewTests(TestCase):
 
         response = self.post(STUB_SETTINGS)
         response = self.post(STUB_SETTINGS, env=True)
-        response = self.get()
-        self.assertEqual(yaml.safe_load(response.content), STUB_SETTINGS)
-        response = self.get(env=True)
-        self.assertEqual(yaml.safe_load(response.content), STUB_SETTINGS)
-        response = self.get(response_format='json')
-        self.assertJSONEqual(response.content, STUB_SETTINGS)
+        content = self.get()
+        self.assertEqual(yaml.safe_load(content), STUB_SETTINGS)
+        content = self.get(env=True)
+        self.assertEqual(yaml.safe_load(content), STUB_SETTINGS)
+        content = self.get(response_format='json')
+        self.assertJSONEqual(content, STUB_SETTINGS)
         response = self.delete()
-        response = self.get()
-        self.assertJSONEqual(response.content, {})
+        content = self.get()
+        self.assertJSONEqual(content, {})
 
     def test_ok_yaml(self):
         if not su_settings.DB_PRESET_ENABLED:
@@ -69,7 +75,88 @@ class SettingsViewTests(TestCase):
 
         response = self.post(STUB_SETTINGS, is_yaml=True)
         response = self.post(STUB_SETTINGS, is_yaml=True, env=True)
-        response = self.get()
-        self.assertEqual(yaml.safe_load(response.content), STUB_SETTINGS)
-        response = self.get( env=True)
-        self.assertEqual(yaml.safe_load(response.content), STUB_SETTINGS)
+        content = self.get()
+        self.assertEqual(yaml.safe_load(content), STUB_SETTINGS)
+        content = self.get( env=True)
+        self.assertEqual(yaml.safe_load(content), STUB_SETTINGS)
+
+    def test_patch_duplicates(self):
+        if not su_settings.DB_PRESET_ENABLED:
+            return
+
+        self.post({PROJECT: {'get#/a': 200}})
+        self.post({PROJECT: {'GET#/a': 201, 'get#/a': 202, 'get#/b': 203}}, is_yaml=True)
+        content = self.get(response_format='json')
+        self.assertJSONEqual(content, {PROJECT: {'get#/a': 202, 'get#/b': 203}})
+
+    def test_patch_queries(self):
+        if not su_settings.DB_PRESET_ENABLED:
+            return
+
+        def patch(count):
+            preset = {PROJECT: {'get#/items/%s/' % index: index for index in range(count)}}
+            with CaptureQueriesContext(connection) as queries:
+                self.post(preset, is_yaml=True)
+            return len(queries)
+
+        # 80 rows stay in one SQLite insert (999 parameters)
+        self.assertEqual(patch(5), patch(80))
+
+        self.post({PROJECT: {'get#/items/3/': 'x', 'get#/new/': 'y'}}, is_yaml=True)
+        content = json.loads(self.get(response_format='json'))[PROJECT]
+        self.assertEqual(len(content), 81)
+        self.assertEqual((content['get#/items/3/'], content['get#/new/'], content['get#/items/4/']), ('x', 'y', 4))
+
+    def test_export_yaml(self):
+        # a key longer than a line is emitted as `? key`
+        long_name = 'x' * 200
+        rows = [
+            ('one', 'get#/a', {'200': {'text': 'line\n' * 3}}),
+            ('one', 'get#/' + long_name, 'ok'),
+            (long_name, 'get#/c', [1, 2]),
+            (long_name, 'get#/d', {}),
+        ]
+        with patch('apistubs.views.settings.EXPORT_CHUNK_SIZE', 1):
+            content = ''.join(export_yaml(iter(rows)))
+        self.assertEqual(yaml.safe_load(content), {
+            'one': {key: value for _, key, value in rows[:2]},
+            long_name: {key: value for _, key, value in rows[2:]},
+        })
+        self.assertEqual(yaml.safe_load(''.join(export_yaml(iter([])))), {})
+
+    def test_streaming(self):
+        if not su_settings.DB_PRESET_ENABLED:
+            return
+
+        preset = {
+            'one': {'get#/a': 200, 'post#/a': {'201': {'name': 'ы'}}, 'get#/b': '200-ok'},
+            'two': {'get#/c': {'200': [1, 2]}, 'delete#/c': 204},
+        }
+        lines = ''.join(
+            json.dumps({service: {key: value}}) + '\n'
+            for service in preset for key, value in preset[service].items()
+        )
+        with patch('apistubs.views.settings.IMPORT_BATCH_SIZE', 2), \
+                patch('apistubs.views.settings.EXPORT_CHUNK_SIZE', 2):
+            self.client.post(
+                self.get_url() + '?format=ndjson',
+                data=lines + json.dumps({'one': {'get#/a': 202}}) + '\n',
+                content_type='application/json'
+            )
+            expected = dict(preset, one=dict(preset['one'], **{'get#/a': 202}))
+            self.assertEqual(json.loads(self.get(response_format='json')), expected)
+            self.assertEqual(yaml.safe_load(self.get()), expected)
+            self.assertEqual(
+                [json.loads(line) for line in self.get(response_format='ndjson').splitlines()],
+                [{'one': {'post#/a': {'201': {'name': 'ы'}}}}, {'one': {'get#/b': '200-ok'}},
+                 {'one': {'get#/a': 202}}, {'two': {'get#/c': {'200': [1, 2]}}}, {'two': {'delete#/c': 204}}]
+            )
+
+            self.client.patch(
+                self.get_url(),
+                data='one:\n  get#/b: 500\n---\ntwo:\n  get#/d: 200\n',
+                content_type='application/x-yaml'
+            )
+            content = yaml.safe_load(self.get())
+            self.assertEqual(content['one']['get#/b'], 500)
+            self.assertEqual(content['two']['get#/d'], 200)
@@ -8,7 +8,6 @@ from django.http import (
     HttpResponse,
     Http404,
 )
-from django.utils import timezone
 from django import forms
 from django.views import View
 from django.views.generic import TemplateView
@@ -17,8 +16,18 @@ from django.http import HttpResponse, Http404
 from django.conf import settings as app_settings
 
 from apistubs import settings as su_settings
-from apistubs.helpers import get_path
+from apistubs.helpers import (
+    get_path,
+    replace_path,
+    FrozenDict,
+    FrozenList,
+    LazyMapping,
+    LRUCache,
+)
+from apistubs.payload import Payload, payload_response
+from apistubs.presets import get_preset_store
 from apistubs.spec import spec_point
+from apistubs.stubs import Generation
 
 __all__ = (
     'IndexView',
@@ -28,8 +37,47 @@ __all__ = (
 )
 
 
-if su_settings.DB_PRESET_ENABLED:
-    from apistubs.dbpreset.models import Mock
+# Generation env of the spec storage
+STORAGE_ENV = 'storage:'
+
+FIGURE_RE = re.compile('<figure>.*?</figure>', re.DOTALL)
+
+# stripped spec documents by (spec_file, spec generation)
+spec_documents = LRUCache(16)
+# rendered api.json payloads by SpecView.get_cache_key()
+rendered_specs = LRUCache(64)
+
+
+def strip_figures(data):
+    """
+    Drops <figure> blocks from the document strings, unchanged parts are shared
+    and lazy mappings strip their values as they are loaded
+    """
+    # TODO: fix images paths
+    if isinstance(data, LazyMapping):
+        return data.derive(strip_figures)
+    if isinstance(data, str):
+        if '<figure>' not in data:
+            return data
+        return FIGURE_RE.sub('', data)
+    if isinstance(data, dict):
+        changed = {}
+        for key, value in data.items():
+            stripped = strip_figures(value)
+            if stripped is not value:
+                changed[key] = stripped
+        if not changed:
+            return data
+        result = dict(data.items())
+        result.update(changed)
+        return FrozenDict(result)
+    if isinstance(data, list):
+        result = [strip_figures(value) for value in data]
+        if all(a is b for a, b in zip(result, data)):
+            return data
+        return FrozenList(result)
+    return data
+
 
 class IndexView(TemplateView):
     template_name = 'apistubs/index.html'
@@ -46,35 +94,10 @@ class IndexView(TemplateView):
         data['STATIC_URL'] = app_settings.STATIC_URL
         return data
 
-    MOCK_MODEL_ENV_PREFIX = 'storage:'
-    MOCK_MODEL_METHOD = 'spec'
-
-    def get_env(self, name):
-        return self.MOCK_MODEL_ENV_PREFIX + name
-
-    def get_spec(self, name):
-        value = Mock.objects.filter(env=self.get_env(name))
-        if not value:
-            return None, None
-        item = value[0]
-        return item.content, item
-
     def save_spec(self, name, value):
-        if not value:
-            return Mock.objects.filter(env=self.get_env(name)).delete()
-        _, item = self.get_spec(name)
-        if item:
-            item.content = value
-            return item.save()
-        Mock.objects.create(
-            index=-1,
-            headers={},
-            status=0,
-            env=self.get_env(name),
-            method=self.MOCK_MODEL_METHOD,
-            content=value,
-            created_at=timezone.now()
-        )
+        get_preset_store().set_document(name, value)
+        # SpecView renders depend on every stored spec (ministubs lists them)
+        Generation.bump(STORAGE_ENV)
 
     def post(self, request, *args, **kwargs):
         if not su_settings.DB_PRESET_ENABLED or 'spec' not in kwargs:
@@ -117,77 +140,105 @@ class OAuth2RedirectView(TemplateView):
 class SpecView(View):
     def get(self, request, *args, **kwargs):
         spec_name = kwargs.get('spec', 'ministubs')
-        data, item = self.get_spec(spec_name)
-        if not data:
-            if spec_name not in su_settings.SPEC_FILES:
-                raise Http404
-            spec_file = spec_point.get_spec_file(spec_name)
-            data = spec_point.get_data(spec_file)
+        key = self.get_cache_key(spec_name)
+        payload = rendered_specs.get(key)
+        if payload is None:
+            payload = Payload.from_content(self.render(spec_name, *args, **kwargs))
+            rendered_specs.set(key, payload)
 
-        self.process_data(data, spec_name, *args, **kwargs)
-        data = json.dumps(data, indent=4, ensure_ascii=False)
-
-        # TODO: fix images paths
-        data = re.sub(re.compile('<figure>.*?</figure>'), '', data)
-
-        response = HttpResponse(data, content_type='application/json')
+        response = payload_response(request, payload)
         response['Access-Control-Allow-Origin'] = '*'
         return response
 
-    MOCK_MODEL_ENV_PREFIX = 'storage:'
+    def get_cache_key(self, spec_name):
+        spec_file = spec_point.get_spec_file(spec_name)
+        storage = None
+        if su_settings.DB_PRESET_ENABLED:
+            storage = Generation.get_value(STORAGE_ENV)
+        return (
+            su_settings.revision,
+            spec_name,
+            self.request.get_host(),
+            self.request.scheme,
+            spec_file,
+            spec_point.get_generation(spec_file),
+            storage,
+        )
 
-    def get_env(self, name):
-        return self.MOCK_MODEL_ENV_PREFIX + name
+    def render(self, spec_name, *args, **kwargs):
+        data = self.get_spec(spec_name)
+        if data:
+            data = strip_figures(data)
+        else:
+            if spec_name not in su_settings.SPEC_FILES:
+                raise Http404
+            data = self.get_document(spec_point.get_spec_file(spec_name))
+        return self.process_data(data, spec_name, *args, **kwargs)
+
+    def get_document(self, spec_file):
+        key = (spec_file, spec_point.get_generation(spec_file))
+        data = spec_documents.get(key)
+        if data is None:
+            data = strip_figures(spec_point.get_data(spec_file))
+            spec_documents.set(key, data)
+        return data
 
     def get_spec(self, name):
         if not su_settings.DB_PRESET_ENABLED:
-            return None, None
-        value = Mock.objects.filter(env=self.get_env(name))
-        if not value:
-            return None, None
-        item = value[0]
-        data = item.content
+            return None
+        data = get_preset_store().get_document(name)
         if isinstance(data, str):
             data = json.loads(data)
-        return data, item
+        return data
 
     def process_data(self, data, spec_name, *args, **kwargs):
+        """
+        Per-request changes on top of the shared spec, returns a new document
+        """
         spec_name = kwargs.get('spec', 'ministubs')
 
+        servers = data.get('servers')
         if (
-            data['servers'] and
-            isinstance(data['servers'], list) and
-            isinstance(data['servers'][0], dict) and
-            'url' in data['servers'][0] and
-            isinstance(data['servers'][0]['url'], str)
+            servers and
+            isinstance(servers, list) and
+            isinstance(servers[0], dict) and
+            'url' in servers[0] and
+            isinstance(servers[0]['url'], str)
         ):
-            server_url_parsed = list(urlsplit(data['servers'][0]['url']))
+            server_url_parsed = list(urlsplit(servers[0]['url']))
             server_url_parsed[1] = self.request.get_host()
-            data['servers'][0] = {
+            data = replace_path(data, {
                 'url': urlunsplit(server_url_parsed),
-            }
+            }, 'servers', 0)
 
         if su_settings.AUTHORIZATION_URL or su_settings.TOKEN_URL:
-            oauth_flows = get_path(data, 'components', 'securitySchemes', 'oauth_2_0', 'flows')
+            flows = ('components', 'securitySchemes', 'oauth_2_0', 'flows')
+            oauth_flows = get_path(data, *flows)
             if oauth_flows:
                 implicit = get_path(oauth_flows, 'implicit')
                 if implicit and su_settings.AUTHORIZATION_URL:
-                    implicit['authorizationUrl'] = su_settings.AUTHORIZATION_URL
+                    implicit = dict(implicit, authorizationUrl=su_settings.AUTHORIZATION_URL)
+                    data = replace_path(data, implicit, *flows, 'implicit')
                 authorization_code = get_path(oauth_flows, 'authorizationCode')
                 if authorization_code and su_settings.TOKEN_URL:
-                    authorization_code['authorizationUrl'] = su_settings.AUTHORIZATION_URL
-                    authorization_code['tokenUrl'] = su_settings.TOKEN_URL
+                    authorization_code = dict(
+                        authorization_code,
+                        authorizationUrl=su_settings.AUTHORIZATION_URL,
+                        tokenUrl=su_settings.TOKEN_URL,
+                    )
+                    data = replace_path(data, authorization_code, *flows, 'authorizationCode')
 
         if spec_name == 'ministubs':
             specs = []
             if su_settings.DB_PRESET_ENABLED:
-                items = Mock.objects.filter(env__startswith=self.MOCK_MODEL_ENV_PREFIX)
-                specs += [item.env[len(self.MOCK_MODEL_ENV_PREFIX):] for item in items]
+                specs += get_preset_store().get_document_names()
             specs += su_settings.SPEC_FILES.keys()
             specs.sort()
-            data['paths']['/{service}/']['get']['parameters'][0]['description'] = '<b>Specifications:</b><ol>%s</ol>' % (
+            data = replace_path(data, '<b>Specifications:</b><ol>%s</ol>' % (
                 ''.join([
                     '<li><a target="_blank" href="%s/">%s</a></li>' % (key, key,)
                     for key in specs
                 ])
-            )
+            ), 'paths', '/{service}/', 'get', 'parameters', 0, 'description')
+
+        return data
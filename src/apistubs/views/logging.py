@@ -1,32 +1,104 @@
+import math
+import time
 import yaml
 
-from django.http import JsonResponse, HttpResponse
+from django.http import (
+    HttpResponse,
+    HttpResponseBadRequest,
+    StreamingHttpResponse,
+)
 from django.views import View
 from django.views.decorators.csrf import csrf_exempt
 
+from apistubs import settings as su_settings
 from apistubs.logging import RequestLog
+from apistubs.serializers import dumps, json_response
 
 __all__ = (
     'LogView',
 )
 
 
+KEEPALIVE_INTERVAL = 15
+
+
+def get_log(entries):
+    return [dict(item, id=sequence) for sequence, item in entries]
+
+
+def iter_events(env, since, timeout):
+    """
+    Server-Sent Events of the env log, the oldest first, until `timeout` seconds
+    pass: clients (EventSource) reconnect with Last-Event-ID and go on from there
+    """
+    deadline = time.monotonic() + timeout
+    yield 'retry: 1000\n\n'
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        entries = RequestLog.wait(env, since=since, timeout=min(remaining, KEEPALIVE_INTERVAL))
+        if not entries:
+            yield ': keepalive\n\n'
+            continue
+        for item in reversed(get_log(entries)):
+            yield 'id: %s\nevent: log\ndata: %s\n\n' % (item['id'], dumps(item, 'compact').decode('utf-8'))
+        since = entries[0][0]
+
+
 class LogView(View):
+    """
+    Log of an env, the newest first. Every item has a growing `id`:
+    `?since=<id>` returns only the newer ones, `&wait=<seconds>` long-polls
+    for them and `?format=sse` (or Accept: text/event-stream) streams them
+    """
     @csrf_exempt
     def dispatch(self, request, *args, **kwargs):
         return super(LogView, self).dispatch(request, *args, **kwargs)
 
     def get(self, request, *args, **kwargs):
         env = kwargs.get('env', '')
+        try:
+            since = self.get_since(request)
+            wait = self.get_wait(request)
+        except ValueError:
+            return HttpResponseBadRequest('Invalid since or wait')
+
         response_format = request.GET.get('format')
+        if response_format == 'sse' or 'text/event-stream' in request.headers.get('Accept', ''):
+            response = StreamingHttpResponse(
+                iter_events(env, since, su_settings.REQUEST_LOG_STREAM_TIMEOUT),
+                content_type='text/event-stream'
+            )
+            response['Cache-Control'] = 'no-cache'
+            response['X-Accel-Buffering'] = 'no'
+            return response
+
+        entries = RequestLog.wait(env, since=since, timeout=wait)
         if response_format == 'json':
-            return JsonResponse({
-                'log': RequestLog.get(env),
-            })
-        return HttpResponse(yaml.safe_dump(RequestLog.get(env)), content_type='text/plain')
+            data = {
+                'log': get_log(entries),
+                'last_id': entries[0][0] if entries else since,
+            }
+            if su_settings.REQUEST_LOG_ASYNC:
+                data['dropped'] = RequestLog.get_dropped()
+            return json_response(data)
+        return HttpResponse(yaml.safe_dump(get_log(entries)), content_type='text/plain')
+
+    def get_since(self, request):
+        since = request.GET.get('since') or request.headers.get('Last-Event-ID')
+        if not since:
+            return None
+        return int(since)
+
+    def get_wait(self, request):
+        wait = float(request.GET.get('wait') or 0)
+        if not math.isfinite(wait) or wait < 0:
+            raise ValueError(wait)
+        return min(wait, su_settings.REQUEST_LOG_WAIT_MAX)
 
     @csrf_exempt
     def delete(self, request, *args, **kwargs):
         env = kwargs.get('env', '')
         RequestLog.clear(env)
-        return JsonResponse({})
+        return json_response({})
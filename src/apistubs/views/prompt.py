@@ -18,10 +18,8 @@ from django.utils.safestring import SafeText
 
 from apistubs import settings as su_settings
 from apistubs.logging import RequestLog
-from apistubs.stubs import YamlSettings, Prompt
-
-if su_settings.DB_PRESET_ENABLED:
-    from apistubs.dbpreset.models import Mock
+from apistubs.presets import get_preset_store
+from apistubs.stubs import YamlSettings, Prompt, get_env_chain
 
 __all__ = (
     'clean_prompt',
@@ -44,16 +42,17 @@ def clean_prompt(prompt: bytes | str | None) -> List[str]:
 
 
 def db_settings(env: str) -> Dict[str, Dict[str, Any]]:
-    settings: Dict[str, Dict[str, Any]] = {}
     if not su_settings.DB_PRESET_ENABLED:
-        return settings
-
-    for response in Mock.objects.order_by('index').filter(env=env):
-        settings.setdefault(response.spec_name, {})
-        settings[response.spec_name][
-            '#'.join([response.method, response.pattern])
-        ] = response.get_content()
-    return settings
+        return {}
+    store = get_preset_store()
+    presets: Dict[str, Dict[str, Any]] = {}
+    # overrides of the env first, then what is inherited from the parents
+    for chain_env, _ in get_env_chain(env):
+        for spec_name, values in store.get_env(chain_env).items():
+            spec_presets = presets.setdefault(spec_name, {})
+            for key, value in values.items():
+                spec_presets.setdefault(key, value)
+    return presets
 
 
 class PromptForm(forms.Form):
@@ -1,18 +1,29 @@
+import io
 import json
 import yaml
 import re
 
 from django.conf import settings as app_settings
+from django.db import transaction
 from django.http import (
     HttpResponse,
-    JsonResponse,
+    HttpResponseBadRequest,
     HttpResponseRedirect,
+    StreamingHttpResponse,
 )
 from django.views import View
 from django.views.decorators.csrf import csrf_exempt
 
 from apistubs.dbpreset.models import Mock
 from apistubs.helpers import clear_comments
+from apistubs.presets import get_preset_store
+from apistubs.serializers import dumps, json_response
+from apistubs.stubs import EnvUsage, Generation, get_env_chain
+
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
 
 __all__ = (
     'SettingsView',
@@ -20,6 +31,140 @@ __all__ = (
 )
 
 
+EXPORT_CHUNK_SIZE = 2000
+# memory is bounded by a line/document only for NDJSON and multi-document YAML,
+# a plain JSON or YAML body is read and parsed at once
+IMPORT_BATCH_SIZE = 1000
+KEEP_PARENT = object()
+
+EXPORT_CONTENT_TYPES = {
+    'json': 'text/json',
+    'ndjson': 'application/x-ndjson',
+    'yaml': 'text/plain',
+}
+IMPORT_FORMATS = {
+    'application/x-ndjson': 'ndjson',
+    'application/x-yaml': 'yaml',
+    'application/yaml': 'yaml',
+    'text/yaml': 'yaml',
+}
+
+
+def iter_groups(rows, size):
+    # consecutive rows of a spec, at most `size` at a time
+    spec_name, values = None, {}
+    for row_spec_name, key, content in rows:
+        if values and (row_spec_name != spec_name or len(values) >= size):
+            yield spec_name, values
+            values = {}
+        spec_name = row_spec_name
+        values[key] = content
+    if values:
+        yield spec_name, values
+
+
+def iter_node_events(dumper, node):
+    # what dumper.serialize() emits for the node, without anchors
+    if isinstance(node, yaml.ScalarNode):
+        implicit = (
+            node.tag == dumper.resolve(yaml.ScalarNode, node.value, (True, False)),
+            node.tag == dumper.resolve(yaml.ScalarNode, node.value, (False, True)),
+        )
+        yield yaml.ScalarEvent(None, node.tag, implicit, node.value, style=node.style)
+    elif isinstance(node, yaml.SequenceNode):
+        implicit = node.tag == dumper.resolve(yaml.SequenceNode, node.value, True)
+        yield yaml.SequenceStartEvent(None, node.tag, implicit, flow_style=node.flow_style)
+        for item in node.value:
+            yield from iter_node_events(dumper, item)
+        yield yaml.SequenceEndEvent()
+    else:
+        implicit = node.tag == dumper.resolve(yaml.MappingNode, node.value, True)
+        yield yaml.MappingStartEvent(None, node.tag, implicit, flow_style=node.flow_style)
+        for key, value in node.value:
+            yield from iter_node_events(dumper, key)
+            yield from iter_node_events(dumper, value)
+        yield yaml.MappingEndEvent()
+
+
+def emit_data(dumper, data):
+    for event in iter_node_events(dumper, dumper.represent_data(data)):
+        dumper.emit(event)
+    dumper.represented_objects = {}
+
+
+def export_yaml(rows):
+    """
+    One YAML document, the emitter gets the spec mappings piece by piece
+    and its output is sent as it comes
+    """
+    stream = io.StringIO()
+    dumper = SafeDumper(stream, sort_keys=False)
+
+    def flush():
+        chunk = stream.getvalue()
+        stream.seek(0)
+        stream.truncate()
+        return chunk
+
+    for event in (yaml.StreamStartEvent(), yaml.DocumentStartEvent(), yaml.MappingStartEvent(None, None, True)):
+        dumper.emit(event)
+    current = None
+    for spec_name, values in iter_groups(rows, EXPORT_CHUNK_SIZE):
+        if spec_name != current:
+            if current is not None:
+                dumper.emit(yaml.MappingEndEvent())
+            emit_data(dumper, spec_name)
+            dumper.emit(yaml.MappingStartEvent(None, None, True))
+            current = spec_name
+        for key, content in values.items():
+            emit_data(dumper, key)
+            emit_data(dumper, content)
+        chunk = flush()
+        if chunk:
+            yield chunk
+    if current is not None:
+        dumper.emit(yaml.MappingEndEvent())
+    for event in (yaml.MappingEndEvent(), yaml.DocumentEndEvent(), yaml.StreamEndEvent()):
+        dumper.emit(event)
+    yield flush()
+
+
+def export_json(rows):
+    current = None
+    yield b'{'
+    for spec_name, values in iter_groups(rows, EXPORT_CHUNK_SIZE):
+        if spec_name != current:
+            if current is not None:
+                yield b'},'
+            yield dumps(spec_name, 'compact') + b':{'
+        else:
+            yield b','
+        current = spec_name
+        yield dumps(values, 'compact')[1:-1]
+    if current is not None:
+        yield b'}'
+    yield b'}'
+
+
+def export_ndjson(rows):
+    for spec_name, key, content in rows:
+        yield dumps({spec_name: {key: content}}, 'compact') + b'\n'
+
+
+EXPORTERS = {
+    'json': export_json,
+    'ndjson': export_ndjson,
+    'yaml': export_yaml,
+}
+
+
+def iter_ndjson(stream):
+    for line in stream:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
 class SettingsView(View):
     @csrf_exempt
     def dispatch(self, request, *args, **kwargs):
@@ -51,104 +196,110 @@ class SettingsView(View):
     def get(self, request, *args, **kwargs):
         env = kwargs.get('env', '')
         response_format = request.GET.get('format')
-        responses = {}
-        for response in Mock.objects.order_by('index').filter(env=env).all():
-            responses.setdefault(response.spec_name, {})
-            responses[response.spec_name][
-                '#'.join([response.method, response.pattern])
-            ] = response.get_content()
+        if response_format not in EXPORTERS:
+            response_format = 'yaml'
 
-        if response_format == 'json':
-            return HttpResponse(json.dumps(responses), content_type='text/json')
-
-        return HttpResponse(yaml.safe_dump(responses, sort_keys=False), content_type='text/plain')
+        return StreamingHttpResponse(
+            EXPORTERS[response_format](get_preset_store().iter_env(env)),
+            content_type=EXPORT_CONTENT_TYPES[response_format]
+        )
 
     def post(self, request, *args, **kwargs):
         env = kwargs.get('env', '')
-        try:
-            preset = json.loads(request.body)
-        except json.JSONDecodeError:
-            preset = yaml.safe_load(request.body)
+        # a replaced env is back on the YAML baseline unless `?parent=` is given
+        parent = request.GET.get('parent') or None
+        if not self.is_valid_parent(env, parent):
+            return HttpResponseBadRequest('Invalid parent')
+        presets = (
+            {service: preset[service] for service in preset if service.lower() == service}
+            for preset in self.load_presets(request)
+        )
+        self.save_presets(presets, env, replace=True, batch_size=self.get_batch_size(request), parent=parent)
+        return HttpResponse()
 
-        if not preset:
-            preset = {}
+    def patch(self, request, *args, **kwargs):
+        env = kwargs.get('env', '')
+        parent = KEEP_PARENT
+        if 'parent' in request.GET:
+            parent = request.GET['parent'] or None
+            if not self.is_valid_parent(env, parent):
+                return HttpResponseBadRequest('Invalid parent')
+        self.save_presets(self.load_presets(request), env, batch_size=self.get_batch_size(request), parent=parent)
+        return HttpResponse()
 
-        preset.pop('apistubs', None)
-        clear_comments(preset)
+    def is_valid_parent(self, env, parent):
+        """
+        `parent` is an env name or None for the YAML baseline
+        """
+        if parent is None:
+            return True
+        if not re.fullmatch(r'[-.\w]+', parent):
+            return False
+        # no cycles
+        return env not in [chain_env for chain_env, _ in get_env_chain(parent)]
 
-        mocks = []
-        index = 0
-        for service in preset:
-            if service.lower() != service:
-                continue
+    def get_import_format(self, request):
+        return request.GET.get('format') or IMPORT_FORMATS.get(request.content_type)
 
-            for pt in preset[service]:
-                method, pattern = pt.split('#')
-                preset_value = preset[service][pt]
-
-                mocks.append(Mock(
-                    index=index,
-                    spec_name=service,
-                    method=method,
-                    pattern=pattern,
-                    status=0,
-                    content=Mock.prep_content(preset_value),
-                    headers={},
-                    env=env
-                ))
-                index += 1
-
-        Mock.objects.filter(env=env).delete()
-        Mock.objects.bulk_create(mocks)
-        return HttpResponse()
-        return JsonResponse(preset)
+    def get_batch_size(self, request):
+        # a plain body is parsed at once anyway, keep it in a single upsert
+        if self.get_import_format(request) in ('ndjson', 'yaml'):
+            return IMPORT_BATCH_SIZE
+        return None
 
-    def patch(self, request, *args, **kwargs):
-        env = kwargs.get('env', '')
-        try:
-            preset = json.loads(request.body)
-        except json.JSONDecodeError:
-            preset = yaml.safe_load(request.body)
+    def load_presets(self, request):
+        """
+        Preset documents of the request body: NDJSON lines and YAML
+        documents are parsed from the stream one by one, a plain body at once
+        """
+        import_format = self.get_import_format(request)
+        if import_format == 'ndjson':
+            presets = iter_ndjson(request)
+        elif import_format == 'yaml':
+            presets = yaml.load_all(request, Loader=SafeLoader)
+        else:
+            try:
+                presets = [json.loads(request.body)]
+            except json.JSONDecodeError:
+                presets = [yaml.safe_load(request.body)]
 
-        clear_comments(preset)
-        self.operation_patch(preset, env)
-        return HttpResponse()
-        return JsonResponse(preset)
+        for preset in presets:
+            if not preset:
+                continue
+            preset.pop('apistubs', None)
+            clear_comments(preset)
+            yield preset
 
     def operation_patch(self, preset, env):
-        mocks = []
-        index = 0
-        for service in preset:
-            for pt in preset[service]:
-                method, pattern = pt.split('#')
-                method = method.lower()
-                preset_value = preset[service][pt]
-
-                mocks.append(Mock(
-                    index=index,
-                    spec_name=service,
-                    method=method,
-                    pattern=pattern,
-                    status=0,
-                    content=preset_value,
-                    headers={},
-                    env=env
-                ))
-                index += 1
-
-                Mock.objects.filter(
-                    spec_name=service,
-                    pattern=pattern,
-                    method=method,
-                    env=env
-                ).delete()
-
-        Mock.objects.bulk_create(mocks)
-        return JsonResponse(preset)
+        self.save_presets([preset], env)
+        return json_response(preset)
+
+    def iter_entries(self, presets):
+        for preset in presets:
+            for service in preset:
+                for pt in preset[service]:
+                    method, pattern = pt.split('#')
+                    yield service, method.lower(), pattern, preset[service][pt]
+
+    def save_presets(self, presets, env, replace=False, batch_size=None, parent=KEEP_PARENT):
+        """
+        Endpoints take the index of their position in the presets,
+        `replace` drops the rest of the env. Endpoints of the `parent`
+        env the presets do not override are inherited
+        """
+        store = get_preset_store()
+        store.save(env, self.iter_entries(presets), replace=replace, batch_size=batch_size)
+        if parent is not KEEP_PARENT:
+            store.set_parent(env, parent)
+        # after the write, so workers never cache the old presets as the new generation
+        Generation.bump(env)
+        # a parent is not swept while a child is saved or used
+        EnvUsage.touch_chain(env)
 
     def delete(self, request, *args, **kwargs):
         env = kwargs.get('env', '')
-        Mock.objects.filter(env=env).delete()
+        get_preset_store().delete_env(env)
+        Generation.bump(env)
         return HttpResponse()
 
 
@@ -169,7 +320,7 @@ class SpecSettingsView(View):
                 'headers': response.headers,
                 'content': response.content,
             })
-        return JsonResponse({
+        return json_response({
             'responses': responses,
         })
 
@@ -178,26 +329,35 @@ class SpecSettingsView(View):
         # TODO: validation + documentation
         spec_name = kwargs.get('spec', app_settings.PROJECT)
         responses = json.loads(request.body)['responses']
-        mocks = []
+        mocks = {}
         for index, item in enumerate(responses):
-            mocks.append(Mock(
+            method = item['method'].lower()
+            mocks[(method, item['pattern'])] = Mock(
                 index=index,
                 spec_name=spec_name,
-                method=item['method'].lower(),
+                method=method,
                 pattern=item['pattern'],
+                pattern_hash=Mock.hash_pattern(item['pattern']),
                 status=item['status'],
                 content=item.get('content', {}),
                 headers=item.get('headers', {}),
-            ))
+            )
 
-        Mock.objects.filter(spec_name=spec_name).delete()
-        Mock.objects.bulk_create(mocks)
-        return JsonResponse({
+        with transaction.atomic():
+            envs = set(Mock.objects.filter(spec_name=spec_name).values_list('env', flat=True))
+            Mock.objects.filter(spec_name=spec_name).delete()
+            Mock.objects.bulk_create(mocks.values())
+        for env in envs | {''}:
+            Generation.bump(env)
+        return json_response({
             'responses': responses,
         })
 
     @csrf_exempt
     def delete(self, request, *args, **kwargs):
         spec_name = kwargs.get('spec', app_settings.PROJECT)
+        envs = set(Mock.objects.filter(spec_name=spec_name).values_list('env', flat=True))
         Mock.objects.filter(spec_name=spec_name).delete()
+        for env in envs:
+            Generation.bump(env)
         return HttpResponse()
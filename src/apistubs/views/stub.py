@@ -1,8 +1,7 @@
-import json
 import sys
 
 from django.views import View
-from django.http import HttpResponse, HttpResponseNotFound
+from django.http import HttpResponseNotFound
 from django.conf import settings as app_settings
 from django.views.decorators.csrf import csrf_exempt
 
@@ -10,6 +9,7 @@ from apistubs import VERSION
 from apistubs.stubs import get_stub_response
 from apistubs.helpers import render_params
 from apistubs.logging import RequestLog
+from apistubs.payload import Payload, payload_response
 
 __all__ = (
     'StubView',
@@ -17,6 +17,9 @@ __all__ = (
 )
 
 
+NOT_SPECIFIED = Payload.from_content({'error': 'not_secified'})
+
+
 class BaseStubViewMixin:
     base_path = 'stub/'
 
@@ -35,7 +38,7 @@ class BaseStubViewMixin:
                 data=request.POST.dict(), params=request.GET.dict(), headers=dict(request.headers),
                 env=env, request=request
             )
-            return HttpResponseNotFound(json.dumps({'error': 'not_secified'}, indent=4, ensure_ascii=False))
+            return HttpResponseNotFound(NOT_SPECIFIED.body)
 
         status, payload, headers = stub_response.status, stub_response.content, stub_response.headers
 
@@ -47,14 +50,15 @@ class BaseStubViewMixin:
             response_headers=headers, env=env, request=request
         )
 
-        if not isinstance(payload, str):
-            payload = json.dumps(payload, indent=4, ensure_ascii=False)
-
-        response = HttpResponse(payload, status=status, content_type='application/json')
+        response_headers = {}
         for key in headers:
             header = str(headers[key]).strip()
             header = render_params(header, request)
-            response[key] = header
+            response_headers[key] = header
+
+        response = payload_response(
+            request, stub_response.render(request), status=int(status), headers=response_headers
+        )
 
         response['X-Stub-Mocked'] = 'on'
         response['X-Stub-Version'] = VERSION
@@ -0,0 +1,91 @@
+import logging
+import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from apistubs import settings as su_settings
+from apistubs.helpers import load_apistubs_yaml, read_apistubs_yaml
+from apistubs.spec import spec_point
+from apistubs.stubs import get_preset_snapshot, get_stubs_configs
+
+__all__ = (
+    'warmup',
+)
+
+logger = logging.getLogger('apistubs')
+
+
+def prime_disk_cache(path, lazy=False):
+    # runs in a child process, the parent then loads the pickle
+    read_apistubs_yaml(path, lazy=lazy)
+
+
+def warmup_spec(spec_name):
+    started = time.monotonic()
+    spec_file = spec_point.get_spec_file(spec_name)
+    spec_point.get_data(spec_file)
+    spec_point.get_route_index(spec_name)
+    spec_point.get_example_table(spec_name)
+    get_preset_snapshot(spec_name)
+    if su_settings.STUB_FORCE_ENABLED:
+        from apistubs.openapi.middleware import get_finder
+        try:
+            get_finder(spec_file)
+        except Exception:
+            logger.warning('apistubs warm-up: no openapi finder for %s', spec_name, exc_info=True)
+    return spec_name, time.monotonic() - started
+
+
+def warmup_stubs_config(path):
+    started = time.monotonic()
+    try:
+        load_apistubs_yaml(path)
+    except FileNotFoundError:
+        pass
+    return path, time.monotonic() - started
+
+
+def warmup(workers=None, executor=None):
+    """
+    Loads every SPEC_FILES and STUBS_CONFIG entry and builds route indexes,
+    example tables, preset snapshots and (with STUB_FORCE_ENABLED) openapi finders.
+    Returns {name: seconds}.
+    """
+    workers = workers or su_settings.WARMUP_WORKERS or min(8, os.cpu_count() or 1)
+    executor = executor or su_settings.WARMUP_EXECUTOR
+    started = time.monotonic()
+
+    spec_names = list(su_settings.SPEC_FILES)
+    stubs_configs = [stubs_config for stubs_config in get_stubs_configs() if stubs_config]
+
+    if executor == 'process' and su_settings.CACHE_DIR:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            spec_files = [spec_point.get_spec_file(spec_name) for spec_name in spec_names]
+            futures = [
+                pool.submit(prime_disk_cache, spec_file, spec_point.is_lazy(spec_file))
+                for spec_file in spec_files
+            ]
+            futures += [
+                pool.submit(prime_disk_cache, stubs_config)
+                for stubs_config in stubs_configs
+                if os.path.exists(stubs_config)
+            ]
+            for future in futures:
+                future.result()
+
+    timings = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(warmup_spec, spec_name) for spec_name in spec_names]
+        futures += [pool.submit(warmup_stubs_config, stubs_config) for stubs_config in stubs_configs]
+        for future in futures:
+            try:
+                name, seconds = future.result()
+            except Exception:
+                logger.exception('apistubs warm-up failed')
+                continue
+            timings[name] = seconds
+            logger.info('apistubs warm-up: %s in %.3fs', name, seconds)
+
+    logger.info('apistubs warm-up: done in %.3fs', time.monotonic() - started)
+    return timings